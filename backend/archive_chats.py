@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Chat Archive Script for Tiny Café
+Moves chat messages older than CHAT_ARCHIVE_AFTER_DAYS (default 180) into
+compressed segments under CHAT_ARCHIVE_DIR, or chat_archive_blobs if unset
+"""
+
+import asyncio
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+from dotenv import load_dotenv
+from pathlib import Path
+
+from chat_archive import BlobSegmentStore, ChatArchiver, FileSegmentStore
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+async def archive():
+    # Connect to MongoDB
+    mongo_url = os.environ['MONGO_URL']
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[os.environ['DB_NAME']]
+    
+    archive_dir = os.environ.get('CHAT_ARCHIVE_DIR', '')
+    store = FileSegmentStore(archive_dir) if archive_dir else BlobSegmentStore(db)
+    archiver = ChatArchiver(
+        db,
+        store,
+        after_days=float(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', '180')),
+        segment_size=int(os.environ.get('CHAT_ARCHIVE_SEGMENT_SIZE', '1000'))
+    )
+    
+    print("=" * 60)
+    print(f"Archiving chat history ({store.kind} store)")
+    print("=" * 60)
+    
+    result = await archiver.run()
+    print(f"\n   ✓ Moved {result['messages_moved']} messages from {result['chats']} chats "
+          f"into {result['segments_written']} segments in {result['seconds']}s")
+    if archiver.stored_bytes:
+        print(f"   ✓ {archiver.raw_bytes} bytes compressed to {archiver.stored_bytes}")
+    if result['hot_before'] and result['hot_after']:
+        for field in ("count", "data_bytes", "index_bytes"):
+            print(f"   - chat_messages {field}: {result['hot_before'][field]} -> {result['hot_after'][field]}")
+    
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(archive())
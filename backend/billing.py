@@ -0,0 +1,147 @@
+"""
+Stripe webhook pipeline
+Verified events are recorded once in stripe_events (unique event_id) and
+acknowledged immediately; a background worker claims and applies them.
+Redelivered events hit the unique index and are skipped, and events left
+pending by a crash are picked up again by the periodic sweep.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[dict], Awaitable[None]]
+
+
+class WebhookProcessor:
+    def __init__(self, db, max_attempts: int = 5, sweep_seconds: float = 60.0, stale_seconds: float = 300.0):
+        self.db = db
+        self.max_attempts = max_attempts
+        self.sweep_seconds = sweep_seconds
+        self.stale_seconds = stale_seconds
+        self._handlers: Dict[str, EventHandler] = {}
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self.received = 0
+        self.duplicates = 0
+        self.applied = 0
+        self.failed = 0
+        self.apply_seconds = 0.0
+
+    def on(self, event_type: str):
+        """Register the handler for one Stripe event type"""
+        def decorator(handler: EventHandler) -> EventHandler:
+            self._handlers[event_type] = handler
+            return handler
+        return decorator
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def record(self, event: dict) -> bool:
+        """Store a verified event for processing; False if it was already received"""
+        self.received += 1
+        if event["type"] not in self._handlers:
+            return True
+        try:
+            await self.db.stripe_events.insert_one({
+                "event_id": event["id"],
+                "type": event["type"],
+                "event": event,
+                "status": "pending",
+                "attempts": 0,
+                "received_at": datetime.now(timezone.utc).isoformat(),
+            })
+        except DuplicateKeyError:
+            self.duplicates += 1
+            return False
+        self._queue.put_nowait(event["id"])
+        return True
+
+    async def _run(self):
+        await self._sweep()
+        while True:
+            try:
+                event_id = await asyncio.wait_for(self._queue.get(), self.sweep_seconds)
+            except asyncio.TimeoutError:
+                await self._sweep()
+                continue
+            try:
+                await self._apply(event_id)
+            except Exception as e:
+                logger.error(f"Stripe event {event_id} could not be applied: {e}")
+
+    async def _sweep(self):
+        """Requeue events another worker or an earlier process left unfinished"""
+        stale = (datetime.now(timezone.utc) - timedelta(seconds=self.stale_seconds)).isoformat()
+        try:
+            cursor = self.db.stripe_events.find(
+                {
+                    "$or": [
+                        {"status": {"$in": ["pending", "failed"]}, "received_at": {"$lt": stale}},
+                        {"status": "processing", "claimed_at": {"$lt": stale}},
+                    ],
+                    "attempts": {"$lt": self.max_attempts},
+                },
+                {"_id": 0, "event_id": 1}
+            )
+            async for doc in cursor:
+                self._queue.put_nowait(doc["event_id"])
+        except Exception as e:
+            logger.error(f"Stripe event sweep failed: {e}")
+
+    async def _apply(self, event_id: str):
+        now = datetime.now(timezone.utc)
+        stale = (now - timedelta(seconds=self.stale_seconds)).isoformat()
+        # Claiming makes each event apply once even with several workers sweeping
+        doc = await self.db.stripe_events.find_one_and_update(
+            {
+                "event_id": event_id,
+                "attempts": {"$lt": self.max_attempts},
+                "$or": [
+                    {"status": {"$in": ["pending", "failed"]}},
+                    {"status": "processing", "claimed_at": {"$lt": stale}},
+                ],
+            },
+            {"$set": {"status": "processing", "claimed_at": now.isoformat()}, "$inc": {"attempts": 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not doc:
+            return
+        started = time.monotonic()
+        try:
+            await self._handlers[doc["type"]](doc["event"])
+        except Exception as e:
+            self.failed += 1
+            await self.db.stripe_events.update_one(
+                {"event_id": event_id}, {"$set": {"status": "failed", "error": str(e)}}
+            )
+            raise
+        self.applied += 1
+        self.apply_seconds += time.monotonic() - started
+        await self.db.stripe_events.update_one(
+            {"event_id": event_id},
+            {"$set": {"status": "processed", "processed_at": datetime.now(timezone.utc).isoformat()}}
+        )
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "applied": self.applied,
+            "failed": self.failed,
+            "avg_apply_ms": round(1000 * self.apply_seconds / self.applied, 3) if self.applied else 0.0,
+        }
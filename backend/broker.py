@@ -0,0 +1,249 @@
+"""
+Pub/sub broker for cross-worker WebSocket delivery
+Every worker subscribes to the per-user channels of the sockets it holds and
+publishes messages for everyone else. InMemoryBroker serves a single process;
+RedisBroker speaks RESP to Redis or anything compatible with its
+PUBLISH/SUBSCRIBE commands.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+MessageHandler = Callable[[str, str], None]
+
+
+def user_channel(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+class Broker:
+    """Common bookkeeping; messages carry their publish time for latency stats"""
+
+    def __init__(self):
+        self.handler: Optional[MessageHandler] = None
+        self._channel_handlers: Dict[str, MessageHandler] = {}
+        self.channels: Set[str] = set()
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.latency_seconds = 0.0
+        self.max_latency_seconds = 0.0
+        self._started_at = time.monotonic()
+
+    def set_handler(self, handler: MessageHandler):
+        self.handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def listen(self, channel: str, handler: MessageHandler):
+        """Route one channel to its own handler instead of the default one"""
+        self._channel_handlers[channel] = handler
+        self.subscribe(channel)
+
+    def subscribe(self, channel: str):
+        self.channels.add(channel)
+
+    def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+
+    def publish(self, channel: str, payload: str):
+        """Queue a payload for a channel without waiting on the network"""
+        raise NotImplementedError
+
+    def _wrap(self, payload: str) -> str:
+        self.published += 1
+        return f"{time.time():.6f}|{payload}"
+
+    def _dispatch(self, channel: str, data: str):
+        sent_at, _, payload = data.partition("|")
+        try:
+            latency = max(0.0, time.time() - float(sent_at))
+        except ValueError:
+            latency, payload = 0.0, data
+        self.received += 1
+        self.latency_seconds += latency
+        self.max_latency_seconds = max(self.max_latency_seconds, latency)
+        handler = self._channel_handlers.get(channel, self.handler)
+        if handler and channel in self.channels:
+            handler(channel, payload)
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        return {
+            "backend": type(self).__name__,
+            "channels": len(self.channels),
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+            "publish_rate": round(self.published / elapsed, 2),
+            "avg_latency_ms": round(1000 * self.latency_seconds / self.received, 3) if self.received else 0.0,
+            "max_latency_ms": round(1000 * self.max_latency_seconds, 3),
+        }
+
+
+class InMemoryBroker(Broker):
+    """Single-process broker; only channels held by this process receive anything"""
+
+    def publish(self, channel: str, payload: str):
+        if channel in self.channels:
+            self._dispatch(channel, self._wrap(payload))
+
+
+# ==================== RESP ====================
+
+def encode_command(*args: str) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg.encode()
+        parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(parts)
+
+
+class RespError(Exception):
+    pass
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Broker connection closed")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode()
+    if kind == b"-":
+        return RespError(body.decode())
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2].decode()
+    if kind == b"*":
+        count = int(body)
+        if count < 0:
+            return None
+        return [await read_reply(reader) for _ in range(count)]
+    raise ConnectionError(f"Unexpected broker reply: {line!r}")
+
+
+class RedisBroker(Broker):
+    """RESP pub/sub over two connections: one pipelined publisher, one subscriber"""
+
+    def __init__(self, url: str, queue_size: int = 10000, reconnect_delay: float = 1.0):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.reconnect_delay = reconnect_delay
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._sub_writer: Optional[asyncio.StreamWriter] = None
+        self._tasks: List[asyncio.Task] = []
+        self.reconnects = 0
+
+    async def start(self):
+        self._tasks = [
+            asyncio.create_task(self._run(self._publisher)),
+            asyncio.create_task(self._run(self._subscriber)),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def subscribe(self, channel: str):
+        if channel not in self.channels:
+            super().subscribe(channel)
+            self._send_sub("SUBSCRIBE", channel)
+
+    def unsubscribe(self, channel: str):
+        if channel in self.channels:
+            super().unsubscribe(channel)
+            self._send_sub("UNSUBSCRIBE", channel)
+
+    def publish(self, channel: str, payload: str):
+        try:
+            self._outbox.put_nowait(encode_command("PUBLISH", channel, self._wrap(payload)))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _send_sub(self, *command: str):
+        # While disconnected the channel set is replayed on reconnect
+        if self._sub_writer is not None:
+            self._sub_writer.write(encode_command(*command))
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(encode_command("AUTH", self.password))
+            reply = await read_reply(reader)
+            if isinstance(reply, RespError):
+                writer.close()
+                raise reply
+        return reader, writer
+
+    async def _run(self, loop: Callable[[], Awaitable[None]]):
+        while True:
+            try:
+                await loop()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.reconnects += 1
+                logger.error(f"Broker connection lost: {e}")
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _publisher(self):
+        reader, writer = await self._connect()
+        drain = asyncio.create_task(self._discard_replies(reader))
+        try:
+            while True:
+                batch = [await self._outbox.get()]
+                while not self._outbox.empty() and len(batch) < 512:
+                    batch.append(self._outbox.get_nowait())
+                writer.write(b"".join(batch))
+                await writer.drain()
+        finally:
+            drain.cancel()
+            writer.close()
+
+    async def _discard_replies(self, reader: asyncio.StreamReader):
+        while True:
+            reply = await read_reply(reader)
+            if isinstance(reply, RespError):
+                logger.error(f"Broker publish failed: {reply}")
+
+    async def _subscriber(self):
+        reader, writer = await self._connect()
+        try:
+            # Always hold one subscription so the connection stays in pub/sub mode
+            writer.write(encode_command("SUBSCRIBE", "broker:heartbeat", *self.channels))
+            self._sub_writer = writer
+            while True:
+                reply = await read_reply(reader)
+                if isinstance(reply, list) and len(reply) == 3 and reply[0] == "message":
+                    self._dispatch(reply[1], reply[2])
+        finally:
+            self._sub_writer = None
+            writer.close()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "outbox": self._outbox.qsize(), "reconnects": self.reconnects}
+
+
+def create_broker(url: str = "") -> Broker:
+    if url.startswith("redis://"):
+        return RedisBroker(url)
+    return InMemoryBroker()
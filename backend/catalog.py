@@ -0,0 +1,156 @@
+"""
+Static catalog for the shop, music, badges, achievements and daily quests
+Definitions are loaded once per process; shop and music responses are
+prerendered per (unlock level, language) and served with an ETag
+"""
+
+import hashlib
+import json
+import logging
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from cache import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+LANGUAGES = ("tr", "en")
+
+DEFAULT_SHOP_ITEMS = [
+    # Hot Drinks
+    {"item_id": "latte", "name_tr": "Sıcak Latte", "name_en": "Hot Latte", "description_tr": "Kremsi ve sıcacık", "description_en": "Creamy and warm", "price": 30, "category": "drinks", "image_url": "/assets/drinks/latte.jpg", "locked": False, "unlock_level": 1},
+    {"item_id": "cappuccino", "name_tr": "Cappuccino", "name_en": "Cappuccino", "description_tr": "Köpüklü kahve keyfi", "description_en": "Foamy coffee delight", "price": 35, "category": "drinks", "image_url": "/assets/drinks/cappuccino.jpg", "locked": False, "unlock_level": 1},
+    {"item_id": "mocha", "name_tr": "Mocha", "name_en": "Mocha", "description_tr": "Çikolatalı keyif", "description_en": "Chocolate delight", "price": 40, "category": "drinks", "image_url": "/assets/drinks/mocha.jpg", "locked": False, "unlock_level": 1},
+    {"item_id": "matcha", "name_tr": "Matcha Latte", "name_en": "Matcha Latte", "description_tr": "Yeşil çay enerjisi", "description_en": "Green tea energy", "price": 35, "category": "drinks", "image_url": "/assets/drinks/matcha.jpg", "locked": True, "unlock_level": 3},
+    {"item_id": "hot_chocolate", "name_tr": "Sıcak Çikolata", "name_en": "Hot Chocolate", "description_tr": "Tatlı sıcaklık", "description_en": "Sweet warmth", "price": 30, "category": "drinks", "image_url": "/assets/drinks/hot-chocolate.jpg", "locked": False, "unlock_level": 1},
+    {"item_id": "chai_latte", "name_tr": "Chai Latte", "name_en": "Chai Latte", "description_tr": "Baharatlı sıcaklık", "description_en": "Spiced warmth", "price": 35, "category": "drinks", "image_url": "/assets/drinks/chai-latte.jpg", "locked": True, "unlock_level": 4},
+    {"item_id": "espresso", "name_tr": "Espresso", "name_en": "Espresso", "description_tr": "Yoğun enerji", "description_en": "Intense energy", "price": 25, "category": "drinks", "image_url": "/assets/drinks/espresso.jpg", "locked": False, "unlock_level": 2},
+    {"item_id": "caramel_latte", "name_tr": "Karamelli Latte", "name_en": "Caramel Latte", "description_tr": "Tatlı karamel tadı", "description_en": "Sweet caramel taste", "price": 40, "category": "drinks", "image_url": "/assets/drinks/caramel-latte.jpg", "locked": True, "unlock_level": 5},
+    # Cold Drinks
+    {"item_id": "strawberry_smoothie", "name_tr": "Çilekli Smoothie", "name_en": "Strawberry Smoothie", "description_tr": "Ferahlatıcı meyve", "description_en": "Refreshing fruit", "price": 45, "category": "drinks", "image_url": "/assets/drinks/strawberry-smoothie.jpg", "locked": True, "unlock_level": 4},
+    {"item_id": "lemonade", "name_tr": "Limonata", "name_en": "Lemonade", "description_tr": "Serinletici", "description_en": "Cooling refreshment", "price": 25, "category": "drinks", "image_url": "/assets/drinks/lemonade.jpg", "locked": False, "unlock_level": 2},
+    # Desserts
+    {"item_id": "croissant", "name_tr": "Kruvasan", "name_en": "Croissant", "description_tr": "Tereyağlı lezzet", "description_en": "Buttery delight", "price": 30, "category": "treats", "image_url": "/assets/desserts/croissant.jpg", "locked": False, "unlock_level": 1},
+    {"item_id": "blueberry_donut", "name_tr": "Yaban Mersinli Donut", "name_en": "Blueberry Donut", "description_tr": "Meyveli tatlı", "description_en": "Fruity sweetness", "price": 25, "category": "treats", "image_url": "/assets/desserts/blueberry-donut.jpg", "locked": False, "unlock_level": 1},
+    {"item_id": "strawberry_donut", "name_tr": "Çilekli Donut", "name_en": "Strawberry Donut", "description_tr": "Tatlı bir mola", "description_en": "A sweet break", "price": 25, "category": "treats", "image_url": "/assets/desserts/strawberry-donut.jpg", "locked": False, "unlock_level": 1},
+    {"item_id": "cupcake", "name_tr": "Cupcake", "name_en": "Cupcake", "description_tr": "Minik mutluluk", "description_en": "Tiny happiness", "price": 30, "category": "treats", "image_url": "/assets/desserts/cupcake.jpg", "locked": False, "unlock_level": 1},
+    {"item_id": "macaron", "name_tr": "Makaron", "name_en": "Macaron", "description_tr": "Fransız şıklığı", "description_en": "French elegance", "price": 35, "category": "treats", "image_url": "/assets/desserts/macaron.jpg", "locked": True, "unlock_level": 3},
+    {"item_id": "chocolate_cake", "name_tr": "Çikolatalı Pasta", "name_en": "Chocolate Cake", "description_tr": "Çikolata cenneti", "description_en": "Chocolate heaven", "price": 50, "category": "treats", "image_url": "/assets/desserts/chocolate-cake.jpg", "locked": True, "unlock_level": 5},
+    {"item_id": "cheesecake", "name_tr": "Cheesecake Brownie", "name_en": "Cheesecake Brownie", "description_tr": "Kremsi lezzet", "description_en": "Creamy delight", "price": 45, "category": "treats", "image_url": "/assets/desserts/cheesecake-brownie.jpg", "locked": True, "unlock_level": 4},
+    {"item_id": "ice_cream", "name_tr": "Dondurma", "name_en": "Ice Cream", "description_tr": "Serinletici tatlı", "description_en": "Cool sweetness", "price": 30, "category": "treats", "image_url": "/assets/desserts/ice-cream.jpg", "locked": False, "unlock_level": 2},
+    {"item_id": "profiterole", "name_tr": "Profiterol", "name_en": "Profiterole", "description_tr": "Çikolatalı şölen", "description_en": "Chocolate feast", "price": 55, "category": "treats", "image_url": "/assets/desserts/profiterole.jpg", "locked": True, "unlock_level": 6},
+    {"item_id": "creme_brulee", "name_tr": "Krem Brûlée", "name_en": "Crème Brûlée", "description_tr": "Karamelize lezzet", "description_en": "Caramelized delight", "price": 50, "category": "treats", "image_url": "/assets/desserts/Creme-Brulee.jpg", "locked": True, "unlock_level": 5},
+]
+
+DEFAULT_MUSIC_TRACKS = [
+    {"track_id": "lofi_chill", "name": "Cozy Cafe Vibes", "artist": "LoFi Dreams", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-1.mp3", "category": "lofi", "locked": False, "unlock_level": 1},
+    {"track_id": "ambient_rain", "name": "Rainy Day Study", "artist": "Ambient Sounds", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-2.mp3", "category": "ambient", "locked": False, "unlock_level": 1},
+    {"track_id": "piano_soft", "name": "Soft Piano Dreams", "artist": "Classical Focus", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-3.mp3", "category": "classical", "locked": False, "unlock_level": 1},
+    {"track_id": "nature_forest", "name": "Forest Whispers", "artist": "Nature Sounds", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-4.mp3", "category": "nature", "locked": True, "unlock_level": 3},
+    {"track_id": "jazz_smooth", "name": "Midnight Jazz", "artist": "Jazz Cafe", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-5.mp3", "category": "jazz", "locked": True, "unlock_level": 5},
+    {"track_id": "electronic_focus", "name": "Deep Focus Electronic", "artist": "Focus Beats", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-6.mp3", "category": "electronic", "locked": True, "unlock_level": 7},
+]
+
+BADGES = [
+    {"badge_id": "first_focus", "name_tr": "İlk Adım", "name_en": "First Step", "description_tr": "İlk odaklanma seansını tamamla", "description_en": "Complete your first focus session", "icon": "🌟", "requirement_type": "total_minutes", "requirement_value": 1},
+    {"badge_id": "hour_hero", "name_tr": "Saat Kahramanı", "name_en": "Hour Hero", "description_tr": "Toplam 1 saat odaklan", "description_en": "Focus for 1 hour total", "icon": "⏰", "requirement_type": "total_minutes", "requirement_value": 60},
+    {"badge_id": "streak_starter", "name_tr": "Seri Başlangıcı", "name_en": "Streak Starter", "description_tr": "3 günlük seri yap", "description_en": "Achieve a 3-day streak", "icon": "🔥", "requirement_type": "streak", "requirement_value": 3},
+    {"badge_id": "streak_master", "name_tr": "Seri Ustası", "name_en": "Streak Master", "description_tr": "7 günlük seri yap", "description_en": "Achieve a 7-day streak", "icon": "💪", "requirement_type": "streak", "requirement_value": 7},
+    {"badge_id": "level_5", "name_tr": "Seviye 5", "name_en": "Level 5", "description_tr": "Seviye 5'e ulaş", "description_en": "Reach level 5", "icon": "🏆", "requirement_type": "level", "requirement_value": 5},
+    {"badge_id": "shopaholic", "name_tr": "Alışveriş Delisi", "name_en": "Shopaholic", "description_tr": "10 ürün satın al", "description_en": "Purchase 10 items", "icon": "🛍️", "requirement_type": "purchases", "requirement_value": 10},
+    {"badge_id": "social_butterfly", "name_tr": "Sosyal Kelebek", "name_en": "Social Butterfly", "description_tr": "5 arkadaş ekle", "description_en": "Add 5 friends", "icon": "🦋", "requirement_type": "friends", "requirement_value": 5},
+]
+
+ACHIEVEMENTS = [
+    {"id": "first_focus", "name_tr": "İlk Adım", "name_en": "First Step", "desc_tr": "İlk odaklanma seansını tamamla", "desc_en": "Complete your first focus session", "icon": "🌟", "type": "total_minutes", "target": 1, "reward": 50},
+    {"id": "hour_hero", "name_tr": "Saat Kahramanı", "name_en": "Hour Hero", "desc_tr": "Toplam 1 saat odaklan", "desc_en": "Focus for 1 hour total", "icon": "⏰", "type": "total_minutes", "target": 60, "reward": 100},
+    {"id": "focus_master", "name_tr": "Odak Ustası", "name_en": "Focus Master", "desc_tr": "Toplam 10 saat odaklan", "desc_en": "Focus for 10 hours total", "icon": "🎯", "type": "total_minutes", "target": 600, "reward": 500},
+    {"id": "streak_3", "name_tr": "Seri Başlangıcı", "name_en": "Streak Starter", "desc_tr": "3 günlük seri yap", "desc_en": "Achieve 3-day streak", "icon": "🔥", "type": "streak", "target": 3, "reward": 75},
+    {"id": "streak_7", "name_tr": "Haftalık Savaşçı", "name_en": "Weekly Warrior", "desc_tr": "7 günlük seri yap", "desc_en": "Achieve 7-day streak", "icon": "💪", "type": "streak", "target": 7, "reward": 200},
+    {"id": "streak_30", "name_tr": "Aylık Efsane", "name_en": "Monthly Legend", "desc_tr": "30 günlük seri yap", "desc_en": "Achieve 30-day streak", "icon": "👑", "type": "streak", "target": 30, "reward": 1000},
+    {"id": "level_5", "name_tr": "Çırak", "name_en": "Apprentice", "desc_tr": "Seviye 5'e ulaş", "desc_en": "Reach level 5", "icon": "⭐", "type": "level", "target": 5, "reward": 150},
+    {"id": "level_10", "name_tr": "Uzman", "name_en": "Expert", "desc_tr": "Seviye 10'a ulaş", "desc_en": "Reach level 10", "icon": "🏆", "type": "level", "target": 10, "reward": 400},
+    {"id": "collector", "name_tr": "Koleksiyoncu", "name_en": "Collector", "desc_tr": "10 ürün satın al", "desc_en": "Purchase 10 items", "icon": "🛍️", "type": "purchases", "target": 10, "reward": 200},
+    {"id": "social", "name_tr": "Sosyal Kelebek", "name_en": "Social Butterfly", "desc_tr": "5 arkadaş ekle", "desc_en": "Add 5 friends", "icon": "🦋", "type": "friends", "target": 5, "reward": 150},
+]
+
+
+DAILY_QUEST_TEMPLATES = [
+    {"quest_id": "daily_focus_30", "type": "focus_time", "title_tr": "30 Dakika Odaklan", "title_en": "Focus for 30 Minutes", "description_tr": "Bugün toplam 30 dakika çalış", "description_en": "Study for 30 minutes total today", "target": 30, "reward_credits": 50, "reward_xp": 100},
+    {"quest_id": "daily_todo_3", "type": "complete_todos", "title_tr": "3 Görev Tamamla", "title_en": "Complete 3 Tasks", "description_tr": "Bugün 3 yapılacak görevi tamamla", "description_en": "Complete 3 to-do items today", "target": 3, "reward_credits": 30, "reward_xp": 60},
+    {"quest_id": "daily_streak", "type": "maintain_streak", "title_tr": "Seri Devam", "title_en": "Keep Streak", "description_tr": "Günlük serini devam ettir", "description_en": "Continue your daily streak", "target": 1, "reward_credits": 20, "reward_xp": 40},
+]
+
+QUEST_TEMPLATES = {quest["quest_id"]: quest for quest in DAILY_QUEST_TEMPLATES}
+
+
+def localize(doc: dict, lang: Optional[str]) -> dict:
+    """Keep only the `_<lang>` half of bilingual fields; lang=None keeps both"""
+    if lang is None:
+        return dict(doc)
+    drop = tuple(f"_{other}" for other in LANGUAGES if other != lang)
+    return {k: v for k, v in doc.items() if not k.endswith(drop)}
+
+
+def render(payload) -> Tuple[bytes, str]:
+    """Serialize a response body once and derive its ETag"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return body, '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+class Catalog:
+    """Process-wide cache of catalog definitions and their prerendered bodies"""
+
+    def __init__(self, db):
+        self.db = db
+        self.shop_items: Dict[str, dict] = {}
+        self._levels: Dict[str, List[int]] = {}
+        # Badges never touch the database, so they are rendered up front
+        self._static = {
+            ("badges", 1, lang): render([localize(b, lang) for b in BADGES])
+            for lang in (None,) + LANGUAGES
+        }
+        self._rendered: Dict[tuple, Tuple[bytes, str]] = dict(self._static)
+        self._flight = SingleFlight()
+        self._loaded = False
+
+    async def ensure_loaded(self):
+        if not self._loaded:
+            await self._flight.do("load", self._load)
+
+    async def _load(self):
+        shop = await self._load_collection(self.db.shop_items, DEFAULT_SHOP_ITEMS)
+        music = await self._load_collection(self.db.music_tracks, DEFAULT_MUSIC_TRACKS)
+
+        self.shop_items = {item["item_id"]: item for item in shop}
+        rendered = dict(self._static)
+        for name, docs in (("shop", shop), ("music", music)):
+            levels = sorted({doc.get("unlock_level", 1) for doc in docs} | {1})
+            self._levels[name] = levels
+            # Lock state only changes at unlock levels, so one body per level covers every user
+            for level in levels:
+                for lang in (None,) + LANGUAGES:
+                    rendered[(name, level, lang)] = render([
+                        {**localize(doc, lang), "locked": doc.get("unlock_level", 1) > level}
+                        for doc in docs
+                    ])
+        self._rendered = rendered
+        self._loaded = True
+        logger.info(f"Catalog loaded: {len(shop)} shop items, {len(music)} music tracks")
+
+    async def _load_collection(self, collection, defaults: List[dict]) -> List[dict]:
+        docs = await collection.find({}, {"_id": 0}).to_list(1000)
+        if not docs:
+            # insert_many mutates its input with _id, so seed from copies
+            await collection.insert_many([dict(doc) for doc in defaults])
+            docs = [dict(doc) for doc in defaults]
+        return docs
+
+    def render(self, name: str, level: int = 1, lang: Optional[str] = None) -> Tuple[bytes, str]:
+        levels = self._levels.get(name, [1])
+        level = levels[max(bisect_right(levels, level) - 1, 0)]
+        return self._rendered[(name, level, lang)]
+
+    def achievements(self, lang: Optional[str] = None) -> List[dict]:
+        """Fresh copies of the achievement definitions, ready for per-user progress"""
+        return [localize(ach, lang) for ach in ACHIEVEMENTS]
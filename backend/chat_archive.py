@@ -0,0 +1,320 @@
+"""
+Cold storage for old chat history
+Messages older than a cutoff move out of chat_messages into gzip-compressed,
+append-only segments of up to `segment_size` messages per chat, stored as
+files or as documents in chat_archive_blobs. chat_archive_segments indexes
+each segment by its first and last (created_at, message_id) key so history
+pages can continue into the archive. Archived messages leave the chat
+search index, so search only covers history newer than the cutoff.
+
+Every worker may run the archiver, so each chat is archived under a lease
+in chat_archive_leases; a chat whose lease another worker holds is skipped
+until the next run.
+"""
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from bson import Binary
+from pymongo.errors import DuplicateKeyError
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[str, str]  # (created_at, message_id)
+
+
+def message_key(message: dict) -> Key:
+    return message["created_at"], message["message_id"]
+
+
+def keyset(fields: Tuple[str, str], op: str, key: Key) -> dict:
+    """Compare a (timestamp, id) field pair against a key in keyset order"""
+    at, id_ = fields
+    return {"$or": [{at: {op: key[0]}}, {at: key[0], id_: {op: key[1]}}]}
+
+
+MESSAGE_KEY = ("created_at", "message_id")
+FIRST_KEY = ("first_at", "first_id")
+LAST_KEY = ("last_at", "last_id")
+
+
+def encode_segment(messages: List[dict]) -> bytes:
+    lines = "\n".join(json.dumps(m, separators=(",", ":"), ensure_ascii=False) for m in messages)
+    return gzip.compress(lines.encode(), compresslevel=6)
+
+
+def decode_segment(data: bytes) -> List[dict]:
+    return [json.loads(line) for line in gzip.decompress(data).decode().splitlines() if line]
+
+
+# ==================== STORES ====================
+
+class FileSegmentStore:
+    """One file per segment under <root>/<chat_id>/"""
+
+    kind = "file"
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def _write(self, path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    async def put(self, segment_id: str, chat_id: str, data: bytes) -> str:
+        location = f"{chat_id.replace('/', '_')}/{segment_id}.jsonl.gz"
+        await asyncio.to_thread(self._write, self.root / location, data)
+        return location
+
+    async def get(self, location: str) -> bytes:
+        return await asyncio.to_thread((self.root / location).read_bytes)
+
+
+class BlobSegmentStore:
+    """Segments as binary documents in chat_archive_blobs"""
+
+    kind = "blob"
+
+    def __init__(self, db):
+        self.db = db
+
+    async def put(self, segment_id: str, chat_id: str, data: bytes) -> str:
+        await self.db.chat_archive_blobs.insert_one({"segment_id": segment_id, "chat_id": chat_id, "data": Binary(data)})
+        return segment_id
+
+    async def get(self, location: str) -> bytes:
+        doc = await self.db.chat_archive_blobs.find_one({"segment_id": location}, {"_id": 0, "data": 1})
+        if not doc:
+            raise FileNotFoundError(f"Archive segment {location} is missing")
+        return bytes(doc["data"])
+
+
+# ==================== ARCHIVER ====================
+
+class ChatArchiver:
+    def __init__(self, db, store, after_days: float = 180, segment_size: int = 1000, interval: float = 3600, lease_seconds: float = 300):
+        self.db = db
+        self.store = store
+        self.after_days = after_days
+        self.segment_size = segment_size
+        self.interval = interval
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex
+        self._segments = TTLCache(maxsize=64, ttl=600)
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.chats_skipped = 0
+        self.messages_moved = 0
+        self.segments_written = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.last_run: dict = {}
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run()
+            except Exception as e:
+                logger.error(f"Chat archive run failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run(self, cutoff: Optional[str] = None) -> dict:
+        """Archive every message created before the cutoff; returns what moved"""
+        started = time.perf_counter()
+        cutoff = cutoff or (datetime.now(timezone.utc) - timedelta(days=self.after_days)).isoformat()
+        before = await self._collection_sizes()
+        moved = segments = skipped = 0
+        pipeline = [{"$match": {"created_at": {"$lt": cutoff}}}, {"$group": {"_id": "$chat_id"}}]
+        chat_ids = [doc["_id"] async for doc in self.db.chat_messages.aggregate(pipeline, allowDiskUse=True)]
+        for chat_id in chat_ids:
+            if not await self._claim(chat_id):
+                skipped += 1
+                continue
+            try:
+                chat_moved, chat_segments = await self._archive_chat(chat_id, cutoff)
+            finally:
+                await self.db.chat_archive_leases.delete_one({"_id": chat_id, "owner": self.owner})
+            moved += chat_moved
+            segments += chat_segments
+        self.chats_skipped += skipped
+        after = await self._collection_sizes()
+        self.runs += 1
+        self.last_run = {
+            "cutoff": cutoff,
+            "chats": len(chat_ids),
+            "chats_skipped": skipped,
+            "messages_moved": moved,
+            "segments_written": segments,
+            "seconds": round(time.perf_counter() - started, 3),
+            "hot_before": before,
+            "hot_after": after,
+        }
+        if moved:
+            logger.info(f"Archived {moved} chat messages from {len(chat_ids)} chats into {segments} segments")
+        return self.last_run
+
+    async def _archive_chat(self, chat_id: str, cutoff: str) -> Tuple[int, int]:
+        last = await self.db.chat_archive_segments.find_one(
+            {"chat_id": chat_id}, {"_id": 0, "last_at": 1, "last_id": 1}, sort=[("last_at", -1), ("last_id", -1)]
+        )
+        if last:
+            # Left behind by a run that stopped between writing a segment and deleting its messages
+            await self.db.chat_messages.delete_many(
+                {"chat_id": chat_id, **keyset(MESSAGE_KEY, "$lte", (last["last_at"], last["last_id"]))}
+            )
+
+        moved = segments = 0
+        while True:
+            if segments and not await self._claim(chat_id):
+                # Took longer than the lease and another worker has the chat now
+                logger.warning(f"Lost the archive lease for chat {chat_id}")
+                return moved, segments
+            batch = await self.db.chat_messages.find(
+                {"chat_id": chat_id, "created_at": {"$lt": cutoff}}
+            ).sort([("created_at", 1), ("message_id", 1)]).limit(self.segment_size).to_list(length=self.segment_size)
+            if not batch:
+                return moved, segments
+            ids = [m.pop("_id") for m in batch]
+            for m in batch:
+                # Archived history is not searchable; the normalized copy is dropped
+                m.pop("search_text", None)
+            data = encode_segment(batch)
+            raw_bytes = sum(len(json.dumps(m)) for m in batch)
+            segment_id = str(uuid.uuid4())
+            location = await self.store.put(segment_id, chat_id, data)
+            first_at, first_id = message_key(batch[0])
+            last_at, last_id = message_key(batch[-1])
+            await self.db.chat_archive_segments.insert_one({
+                "segment_id": segment_id,
+                "chat_id": chat_id,
+                "store": self.store.kind,
+                "location": location,
+                "first_at": first_at,
+                "first_id": first_id,
+                "last_at": last_at,
+                "last_id": last_id,
+                "count": len(batch),
+                "raw_bytes": raw_bytes,
+                "stored_bytes": len(data),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+            })
+            # Only after the segment is durable and indexed do the hot copies go
+            await self.db.chat_messages.delete_many({"_id": {"$in": ids}})
+            moved += len(batch)
+            segments += 1
+            self.messages_moved += len(batch)
+            self.segments_written += 1
+            self.stored_bytes += len(data)
+            self.raw_bytes += raw_bytes
+
+    async def _claim(self, chat_id: str) -> bool:
+        """Take or extend this archiver's lease on a chat; False while another worker holds it"""
+        now = datetime.now(timezone.utc)
+        try:
+            await self.db.chat_archive_leases.update_one(
+                {"_id": chat_id, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now.isoformat()}}]},
+                {"$set": {"owner": self.owner, "expires_at": (now + timedelta(seconds=self.lease_seconds)).isoformat()}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # The lease document exists and belongs to someone else
+            return False
+        return True
+
+    async def _collection_sizes(self) -> dict:
+        try:
+            stats = await self.db.command("collStats", "chat_messages")
+        except Exception:
+            return {}
+        return {
+            "count": stats.get("count", 0),
+            "data_bytes": stats.get("size", 0),
+            "index_bytes": stats.get("totalIndexSize", 0),
+        }
+
+    # ==================== READS ====================
+
+    async def _load(self, segment: dict) -> List[dict]:
+        messages = self._segments.get(segment["segment_id"])
+        if messages is None:
+            messages = decode_segment(await self.store.get(segment["location"]))
+            self._segments.set(segment["segment_id"], messages)
+        return messages
+
+    async def read_before(self, chat_id: str, key: Optional[Key], limit: int) -> List[dict]:
+        """Up to `limit` archived messages older than key, in chronological order"""
+        query = {"chat_id": chat_id}
+        if key:
+            query.update(keyset(FIRST_KEY, "$lt", key))
+        found: List[dict] = []
+        cursor = self.db.chat_archive_segments.find(query, {"_id": 0}).sort([("last_at", -1), ("last_id", -1)])
+        async for segment in cursor:
+            older = [m for m in await self._load(segment) if key is None or message_key(m) < key]
+            found = older[-(limit - len(found)):] + found
+            if len(found) >= limit:
+                break
+        return found
+
+    async def read_after(self, chat_id: str, key: Key, limit: int) -> List[dict]:
+        """Up to `limit` archived messages newer than key, in chronological order"""
+        query = {"chat_id": chat_id, **keyset(LAST_KEY, "$gt", key)}
+        found: List[dict] = []
+        cursor = self.db.chat_archive_segments.find(query, {"_id": 0}).sort([("first_at", 1), ("first_id", 1)])
+        async for segment in cursor:
+            found += [m for m in await self._load(segment) if message_key(m) > key][:limit - len(found)]
+            if len(found) >= limit:
+                break
+        return found
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "messages_moved": self.messages_moved,
+            "segments_written": self.segments_written,
+            "chats_skipped": self.chats_skipped,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "compression_ratio": round(self.raw_bytes / self.stored_bytes, 2) if self.stored_bytes else 0.0,
+            "segment_cache": self._segments.stats(),
+            "last_run": self.last_run,
+        }
+
+
+def create_archiver(db) -> Optional[ChatArchiver]:
+    """Archiver configured from the environment, or None when archiving is off"""
+    after_days = os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', '')
+    if not after_days:
+        return None
+    archive_dir = os.environ.get('CHAT_ARCHIVE_DIR', '')
+    store = FileSegmentStore(archive_dir) if archive_dir else BlobSegmentStore(db)
+    return ChatArchiver(
+        db,
+        store,
+        after_days=float(after_days),
+        segment_size=int(os.environ.get('CHAT_ARCHIVE_SEGMENT_SIZE', '1000')),
+        interval=float(os.environ.get('CHAT_ARCHIVE_INTERVAL', '3600')),
+        lease_seconds=float(os.environ.get('CHAT_ARCHIVE_LEASE_SECONDS', '300'))
+    )
@@ -0,0 +1,203 @@
+"""
+Materialized chat inbox (chat_inbox)
+One document per (user, chat) holding the last message, the unread count,
+the member count and the user's read watermark. Updated on every send so the
+chat list is a single indexed query and reading a chat is a single write.
+
+Clients name a one-to-one chat friend_<peer>, which differs between its two
+members, so it is stored under one id for both (dm:<user>:<user>, sorted)
+and translated back for each viewer.
+"""
+
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from pymongo import ReturnDocument, UpdateOne
+
+PREVIEW_FIELDS = ("created_at", "message_id", "sender_id", "sender_name", "message")
+FRIEND_PREFIX = "friend_"
+DIRECT_PREFIX = "dm:"
+
+
+def direct_chat_id(user_a: str, user_b: str) -> str:
+    """Stored id of the one-to-one chat between two users, the same from either side"""
+    low, high = sorted((user_a, user_b))
+    return f"{DIRECT_PREFIX}{low}:{high}"
+
+
+def storage_chat_id(chat_id: str, user_id: str) -> str:
+    """The stored id for a chat id as user_id's client sends it"""
+    if chat_id.startswith(FRIEND_PREFIX):
+        return direct_chat_id(user_id, chat_id[len(FRIEND_PREFIX):])
+    return chat_id
+
+
+def client_chat_id(chat_id: str, user_id: str) -> str:
+    """The id user_id's client knows a stored chat by"""
+    if not chat_id.startswith(DIRECT_PREFIX):
+        return chat_id
+    pair = chat_id[len(DIRECT_PREFIX):]
+    # Strip the viewer's own half; the peer id may contain anything
+    if pair.startswith(f"{user_id}:"):
+        return FRIEND_PREFIX + pair[len(user_id) + 1:]
+    return FRIEND_PREFIX + pair[:-(len(user_id) + 1)]
+
+
+def preview(message: dict) -> dict:
+    # created_at leads so $max on the subdocument keeps the newest message
+    return {field: message[field] for field in PREVIEW_FIELDS}
+
+
+async def record_message(db, message: dict, participants: List[str], members_count: int):
+    """Fan a new message out to every participant's inbox entry"""
+    last = preview(message)
+    now = datetime.now(timezone.utc).isoformat()
+    ops = []
+    for user_id in participants:
+        update = {
+            "$max": {"last_message": last},
+            "$set": {"members_count": members_count, "updated_at": now},
+        }
+        if user_id == message["sender_id"]:
+            # Sending implies having read everything up to this message
+            update["$max"]["last_read_at"] = message["created_at"]
+            update["$set"]["unread_count"] = 0
+        else:
+            update["$inc"] = {"unread_count": 1}
+            update["$setOnInsert"] = {"last_read_at": ""}
+        ops.append(UpdateOne({"user_id": user_id, "chat_id": message["chat_id"]}, update, upsert=True))
+    if ops:
+        await db.chat_inbox.bulk_write(ops, ordered=False)
+
+
+async def add_members(db, chat_id: str, user_ids: List[str], members_count: int):
+    """Create empty inbox entries so a new chat shows up before its first message"""
+    now = datetime.now(timezone.utc).isoformat()
+    ops = [
+        UpdateOne(
+            {"user_id": user_id, "chat_id": chat_id},
+            {
+                "$set": {"members_count": members_count, "updated_at": now},
+                "$setOnInsert": {"unread_count": 0, "last_read_at": ""},
+            },
+            upsert=True
+        )
+        for user_id in user_ids
+    ]
+    if ops:
+        await db.chat_inbox.bulk_write(ops, ordered=False)
+
+
+async def get_watermark(db, user_id: str, chat_id: str) -> str:
+    entry = await db.chat_inbox.find_one({"user_id": user_id, "chat_id": chat_id}, {"_id": 0, "last_read_at": 1})
+    return (entry or {}).get("last_read_at", "")
+
+
+async def mark_read(db, user_id: str, chat_id: str, read_up_to: str) -> str:
+    """Advance the read watermark and return it; never moves backwards"""
+    entry = await db.chat_inbox.find_one_and_update(
+        {"user_id": user_id, "chat_id": chat_id},
+        [{"$set": {
+            "last_read_at": {"$max": [{"$ifNull": ["$last_read_at", ""]}, read_up_to]},
+            # A message that landed after the page was read keeps the chat unread
+            "unread_count": {"$cond": [
+                {"$gt": [{"$ifNull": ["$last_message.created_at", ""]}, read_up_to]},
+                "$unread_count",
+                0
+            ]},
+        }}],
+        projection={"_id": 0, "last_read_at": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return entry["last_read_at"] if entry else read_up_to
+
+
+async def list_inbox(db, user_id: str, limit: int = 50) -> List[dict]:
+    entries = await db.chat_inbox.find(
+        {"user_id": user_id}, {"_id": 0}
+    ).sort("last_message.created_at", -1).to_list(length=limit)
+    for entry in entries:
+        entry["chat_id"] = client_chat_id(entry["chat_id"], user_id)
+    return entries
+
+
+async def migrate_direct_chats(db) -> int:
+    """Move messages stored under the sender's friend_<recipient> id to the shared dm: id"""
+    moved = 0
+    pipeline = [
+        {"$match": {"chat_id": {"$regex": f"^{FRIEND_PREFIX}"}}},
+        {"$group": {"_id": {"chat_id": "$chat_id", "sender_id": "$sender_id"}}},
+    ]
+    async for group in db.chat_messages.aggregate(pipeline, allowDiskUse=True):
+        chat_id, sender_id = group["_id"]["chat_id"], group["_id"]["sender_id"]
+        result = await db.chat_messages.update_many(
+            {"chat_id": chat_id, "sender_id": sender_id},
+            {"$set": {"chat_id": storage_chat_id(chat_id, sender_id)}}
+        )
+        moved += result.modified_count
+    # Entries under the old ids are rebuilt under the new ones
+    await db.chat_inbox.delete_many({"chat_id": {"$regex": f"^{FRIEND_PREFIX}"}})
+    return moved
+
+
+async def rebuild_all(db, batch_size: int = 1000) -> int:
+    """Backfill inbox entries from chat_messages, carrying over the legacy read flags"""
+    chats: Dict[str, dict] = {}
+    pipeline = [
+        {"$sort": {"created_at": 1}},
+        {"$group": {
+            "_id": {"chat_id": "$chat_id", "sender_id": "$sender_id"},
+            "last": {"$last": "$$ROOT"},
+            "unread": {"$sum": {"$cond": [{"$eq": ["$read", True]}, 0, 1]}},
+        }},
+    ]
+    async for doc in db.chat_messages.aggregate(pipeline, allowDiskUse=True):
+        chat = chats.setdefault(doc["_id"]["chat_id"], {"last": None, "unread": {}, "sent_at": {}})
+        sender_id = doc["_id"]["sender_id"]
+        chat["unread"][sender_id] = doc["unread"]
+        chat["sent_at"][sender_id] = doc["last"]["created_at"]
+        if chat["last"] is None or doc["last"]["created_at"] > chat["last"]["created_at"]:
+            chat["last"] = doc["last"]
+
+    groups = {}
+    async for group in db.chat_groups.find({}, {"_id": 0, "group_id": 1, "members": 1}):
+        groups[f"group_{group['group_id']}"] = group.get("members", [])
+
+    now = datetime.now(timezone.utc).isoformat()
+    ops, total = [], 0
+    for chat_id, chat in chats.items():
+        participants = set(chat["unread"])
+        if chat_id in groups:
+            participants.update(groups[chat_id])
+            members_count = len(groups[chat_id])
+        elif chat_id.startswith(DIRECT_PREFIX):
+            sender_id = next(iter(chat["unread"]))
+            participants.add(client_chat_id(chat_id, sender_id)[len(FRIEND_PREFIX):])
+            members_count = 2
+        else:
+            members_count = len(participants)
+        total_unread = sum(chat["unread"].values())
+        for user_id in participants:
+            ops.append(UpdateOne(
+                {"user_id": user_id, "chat_id": chat_id},
+                {"$set": {
+                    "last_message": preview(chat["last"]),
+                    "unread_count": total_unread - chat["unread"].get(user_id, 0),
+                    "members_count": members_count,
+                    "last_read_at": chat["sent_at"].get(user_id, ""),
+                    "updated_at": now,
+                }},
+                upsert=True
+            ))
+            if len(ops) >= batch_size:
+                await db.chat_inbox.bulk_write(ops, ordered=False)
+                total += len(ops)
+                ops = []
+    if ops:
+        await db.chat_inbox.bulk_write(ops, ordered=False)
+        total += len(ops)
+    return total
+
+
+def is_read(message: dict, user_id: str, watermark: Optional[str]) -> bool:
+    return message["sender_id"] == user_id or message["created_at"] <= (watermark or "")
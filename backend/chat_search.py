@@ -0,0 +1,81 @@
+"""
+Chat message search
+Each message stores a normalized `search_text` covered by a MongoDB text
+index. Normalization applies Turkish casing (I/ı, İ/i) and folds Turkish
+letters to ASCII so queries match with or without diacritics; the index
+uses language "none" so Turkish and English words are not stemmed.
+
+Only messages still in chat_messages are searchable: history the chat
+archiver has moved into compressed segments (CHAT_ARCHIVE_AFTER_DAYS) is
+readable through chat history but does not appear in search results.
+"""
+
+import logging
+import re
+from typing import List
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+_TURKISH_CASE = str.maketrans({"I": "ı", "İ": "i"})
+_FOLD = str.maketrans({"ç": "c", "ğ": "g", "ı": "i", "ö": "o", "ş": "s", "ü": "u", "â": "a", "î": "i", "û": "u"})
+_NON_WORD = re.compile(r"[^\w]+")
+
+MAX_QUERY_TERMS = 10
+INDEX_NOT_FOUND = 27
+
+
+def normalize(text: str) -> str:
+    """Lowercase with Turkish rules, fold diacritics, collapse punctuation to spaces"""
+    folded = text.translate(_TURKISH_CASE).lower().translate(_FOLD)
+    return _NON_WORD.sub(" ", folded).strip()
+
+
+def search_document(message: dict) -> dict:
+    """The stored form of a chat message"""
+    return {**message, "search_text": normalize(message["message"])}
+
+
+async def user_chat_ids(db, user_id: str) -> List[str]:
+    # Every chat the user takes part in has an inbox entry
+    return await db.chat_inbox.distinct("chat_id", {"user_id": user_id})
+
+
+async def search(db, chat_ids: List[str], query: str, page: int, limit: int) -> dict:
+    """One page of messages in the given chats, best match first"""
+    terms = normalize(query).split()[:MAX_QUERY_TERMS]
+    if not terms or not chat_ids:
+        return {"results": [], "page": page, "has_more": False}
+    cursor = db.chat_messages.find(
+        {"$text": {"$search": " ".join(terms)}, "chat_id": {"$in": chat_ids}},
+        {"_id": 0, "search_text": 0, "score": {"$meta": "textScore"}}
+    ).sort([("score", {"$meta": "textScore"}), ("created_at", -1)]).skip((page - 1) * limit).limit(limit + 1)
+    try:
+        results = await cursor.to_list(length=limit + 1)
+    except OperationFailure as e:
+        if e.code != INDEX_NOT_FOUND and "text index required" not in str(e):
+            raise
+        logger.error("Chat search needs the chat_messages text index; run migrate_database.py")
+        raise HTTPException(status_code=503, detail="Chat search is not available yet")
+    return {"results": results[:limit], "page": page, "has_more": len(results) > limit}
+
+
+async def backfill(db, batch_size: int = 1000) -> int:
+    """Add search_text to messages stored before search existed"""
+    ops, total = [], 0
+    cursor = db.chat_messages.find(
+        {"search_text": {"$exists": False}}, {"_id": 1, "message": 1}
+    ).batch_size(batch_size)
+    async for doc in cursor:
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"search_text": normalize(doc.get("message", ""))}}))
+        if len(ops) >= batch_size:
+            await db.chat_messages.bulk_write(ops, ordered=False)
+            total += len(ops)
+            ops = []
+    if ops:
+        await db.chat_messages.bulk_write(ops, ordered=False)
+        total += len(ops)
+    return total
@@ -0,0 +1,178 @@
+"""
+Per-user counters document (user_counters)
+Maintained with $inc on each relevant write so stats, achievement progress
+and quota checks are a single indexed read. reconcile_user / reconcile_all
+recompute the counters from the source collections and are safe on a live
+database: a recount is only written if the counters still hold the values
+read before counting, so an $inc that lands meanwhile sends the user round
+again instead of being overwritten. The unique user_id index (migration
+step 10) is what turns a lost race into a retry. One gap remains: a request
+whose source write was counted but whose $inc lands after the recount is
+written counts twice, until the next reconcile.
+"""
+
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+COUNTER_FIELDS = ("focus_sessions", "purchases", "friends", "badges", "groups_created")
+RECONCILE_ATTEMPTS = 5
+
+
+def _guard(user_id: str, doc: Optional[dict]) -> dict:
+    """Filter matching the counters only while they still hold the values in doc"""
+    doc = doc or {}
+    return {"user_id": user_id, **{field: doc.get(field) for field in COUNTER_FIELDS}}
+
+
+async def _count_user(db, user_id: str) -> Dict[str, int]:
+    return {
+        "focus_sessions": await db.focus_sessions.count_documents({"user_id": user_id, "status": "completed"}),
+        "purchases": await db.purchases.count_documents({"user_id": user_id}),
+        "friends": await db.friendships.count_documents({
+            "$or": [{"user_id": user_id}, {"friend_id": user_id}],
+            "status": "accepted"
+        }),
+        "badges": await db.user_badges.count_documents({"user_id": user_id}),
+        "groups_created": await db.chat_groups.count_documents({"created_by": user_id}),
+    }
+
+
+async def reconcile_user(db, user_id: str) -> Dict[str, int]:
+    """Recompute one user's counters from the source collections"""
+    for _ in range(RECONCILE_ATTEMPTS):
+        current = await db.user_counters.find_one({"user_id": user_id}, {"_id": 0})
+        counts = await _count_user(db, user_id)
+        try:
+            result = await db.user_counters.update_one(
+                _guard(user_id, current),
+                {"$set": {**counts, "reconciled_at": datetime.now(timezone.utc).isoformat()}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # The counters moved while counting; count again
+            continue
+        if result.matched_count or result.upserted_id is not None:
+            return counts
+    # Left unreconciled, so the next read tries again
+    logger.warning(f"Counters for {user_id} kept changing; reconcile skipped")
+    return counts
+
+
+async def get_counters(db, user_id: str) -> Dict[str, int]:
+    doc = await db.user_counters.find_one({"user_id": user_id}, {"_id": 0})
+    # Counters that were never reconciled only hold increments seen since they were created
+    if not doc or "reconciled_at" not in doc:
+        return await reconcile_user(db, user_id)
+    return {field: doc.get(field, 0) for field in COUNTER_FIELDS}
+
+
+async def increment(db, user_id: str, **deltas: int) -> Dict[str, int]:
+    """Apply deltas after the source write and return the counters it produced"""
+    doc = await db.user_counters.find_one_and_update(
+        {"user_id": user_id},
+        {"$inc": deltas},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if "reconciled_at" not in doc:
+        # The source write is already visible, so a recount includes it
+        return await reconcile_user(db, user_id)
+    return {field: doc.get(field, 0) for field in COUNTER_FIELDS}
+
+
+async def reserve(db, user_id: str, field: str, limit: Optional[int] = None) -> bool:
+    """Atomically take one unit of a quota counter before the source write happens"""
+    doc = await db.user_counters.find_one_and_update(
+        {"user_id": user_id},
+        {"$inc": {field: 1}},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if "reconciled_at" not in doc:
+        # The recount can't see the pending write, so take the unit again on top of it
+        await reconcile_user(db, user_id)
+        doc = await increment(db, user_id, **{field: 1})
+    if limit is not None and doc.get(field, 0) > limit:
+        await release(db, user_id, field)
+        return False
+    return True
+
+
+async def release(db, user_id: str, field: str):
+    """Give back a unit taken by reserve() when the source write didn't happen"""
+    await db.user_counters.update_one({"user_id": user_id}, {"$inc": {field: -1}})
+
+
+async def _grouped_counts(collection, pipeline) -> Dict[str, int]:
+    counts = {}
+    async for doc in collection.aggregate(pipeline + [{"$group": {"_id": "$_uid", "n": {"$sum": 1}}}], allowDiskUse=True):
+        counts[doc["_id"]] = doc["n"]
+    return counts
+
+
+async def reconcile_all(db, batch_size: int = 1000) -> int:
+    """Backfill counters for every user with one aggregation per source collection"""
+    # Counters as they stood before counting; users whose counters move meanwhile are recounted alone
+    before = {}
+    projection = {"_id": 0, "user_id": 1, **{field: 1 for field in COUNTER_FIELDS}}
+    async for doc in db.user_counters.find({}, projection).batch_size(batch_size):
+        before[doc["user_id"]] = doc
+
+    sources = {
+        "focus_sessions": await _grouped_counts(db.focus_sessions, [
+            {"$match": {"status": "completed"}}, {"$project": {"_uid": "$user_id"}}
+        ]),
+        "purchases": await _grouped_counts(db.purchases, [{"$project": {"_uid": "$user_id"}}]),
+        "friends": await _grouped_counts(db.friendships, [
+            {"$match": {"status": "accepted"}},
+            {"$project": {"_uid": ["$user_id", "$friend_id"]}},
+            {"$unwind": "$_uid"}
+        ]),
+        "badges": await _grouped_counts(db.user_badges, [{"$project": {"_uid": "$user_id"}}]),
+        "groups_created": await _grouped_counts(db.chat_groups, [{"$project": {"_uid": "$created_by"}}]),
+    }
+
+    reconciled_at = datetime.now(timezone.utc).isoformat()
+    user_ids, ops, conflicts, total = [], [], [], 0
+    async for user in db.users.find({}, {"_id": 0, "user_id": 1}).batch_size(batch_size):
+        user_id = user["user_id"]
+        counts = {field: sources[field].get(user_id, 0) for field in COUNTER_FIELDS}
+        user_ids.append(user_id)
+        ops.append(UpdateOne(
+            _guard(user_id, before.get(user_id)),
+            {"$set": {**counts, "reconciled_at": reconciled_at}},
+            upsert=True
+        ))
+        if len(ops) >= batch_size:
+            conflicts += await _write_guarded(db, user_ids, ops)
+            total += len(ops)
+            user_ids, ops = [], []
+    if ops:
+        conflicts += await _write_guarded(db, user_ids, ops)
+        total += len(ops)
+    for user_id in conflicts:
+        await reconcile_user(db, user_id)
+    if conflicts:
+        logger.info(f"Recounted {len(conflicts)} users whose counters changed during reconcile")
+    return total
+
+
+async def _write_guarded(db, user_ids: List[str], ops: List[UpdateOne]) -> List[str]:
+    """Apply guarded recounts; returns the users whose guard no longer matched"""
+    try:
+        await db.user_counters.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        # A guard miss turns the upsert into an insert that hits the unique user_id index
+        errors = e.details.get("writeErrors") or []
+        if e.details.get("writeConcernErrors") or any(error.get("code") != 11000 for error in errors):
+            raise
+        return [user_ids[error["index"]] for error in errors]
+    return []
@@ -0,0 +1,156 @@
+"""
+Premium entitlements
+Premium state is cached per user with its expiry as a timestamp, so checks
+compare two floats instead of parsing premium_expires_at, and a cached
+entitlement lapses on time by itself. Webhook handlers invalidate a user's
+entry when their premium changes; with a broker the invalidation reaches
+every worker, and the cache TTL bounds staleness if one is lost. A
+background sweeper walks premium_subscriptions by its expires_at index and
+batch-clears is_premium for users whose last active subscription has run
+out; cancellations go through the same check.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Iterable, NamedTuple, Optional
+
+from broker import Broker
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+INVALIDATE_CHANNEL = "entitlements:invalidate"
+
+
+class Entitlement(NamedTuple):
+    is_premium: bool
+    expires_at: Optional[str]
+    expires_ts: Optional[float]
+
+    def active(self, now: float) -> bool:
+        return self.is_premium and (self.expires_ts is None or self.expires_ts >= now)
+
+
+def parse_expiry(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+class Entitlements:
+    def __init__(self, db, broker: Optional[Broker] = None, cache_size: int = 10000, cache_ttl: float = 300.0, sweep_seconds: float = 300.0, batch_size: int = 500):
+        self.db = db
+        self.broker = broker
+        self.sweep_seconds = sweep_seconds
+        self.batch_size = batch_size
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._task: Optional[asyncio.Task] = None
+        self.sweeps = 0
+        self.expired_subscriptions = 0
+        self.expired_users = 0
+        self.revoked_users = 0
+        self.last_sweep: dict = {}
+
+    def get(self, user: dict) -> Entitlement:
+        """Cached entitlement for a user, built from the document on a miss"""
+        entitlement = self._cache.get(user['user_id'])
+        if entitlement is None:
+            expires_at = user.get('premium_expires_at')
+            entitlement = Entitlement(bool(user.get('is_premium')), expires_at, parse_expiry(expires_at))
+            self._cache.set(user['user_id'], entitlement)
+        return entitlement
+
+    def invalidate(self, *user_ids: str):
+        """Drop cached entitlements here and, through the broker, on every other worker"""
+        for user_id in user_ids:
+            self._cache.pop(user_id)
+            if self.broker:
+                self.broker.publish(INVALIDATE_CHANNEL, user_id)
+
+    def _on_invalidate(self, channel: str, user_id: str):
+        self._cache.pop(user_id)
+
+    def is_premium(self, user: dict) -> bool:
+        return self.get(user).active(time.time())
+
+    async def start(self):
+        if self.broker:
+            self.broker.listen(INVALIDATE_CHANNEL, self._on_invalidate)
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Premium expiry sweep failed: {e}")
+            await asyncio.sleep(self.sweep_seconds)
+
+    async def sweep(self) -> dict:
+        """Expire every active subscription past its expires_at; returns what changed"""
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc).isoformat()
+        subscriptions = users = 0
+        while True:
+            batch = await self.db.premium_subscriptions.find(
+                {"status": "active", "expires_at": {"$lt": now}},
+                {"_id": 1, "user_id": 1}
+            ).sort("expires_at", 1).limit(self.batch_size).to_list(length=self.batch_size)
+            if not batch:
+                break
+            await self.db.premium_subscriptions.update_many(
+                {"_id": {"$in": [doc["_id"] for doc in batch]}, "status": "active"},
+                {"$set": {"status": "expired"}}
+            )
+            subscriptions += len(batch)
+            users += await self.revoke({doc["user_id"] for doc in batch}, now)
+        self.sweeps += 1
+        self.expired_subscriptions += subscriptions
+        self.expired_users += users
+        self.last_sweep = {
+            "at": now,
+            "subscriptions": subscriptions,
+            "users": users,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        if subscriptions:
+            logger.info(f"Expired {subscriptions} premium subscriptions for {users} users")
+        return self.last_sweep
+
+    async def revoke(self, user_ids: Iterable[str], ended_at: str) -> int:
+        """Clear is_premium for users left without a running subscription, if their premium ends by ended_at"""
+        user_ids = list(user_ids)
+        now = datetime.now(timezone.utc).isoformat()
+        # A renewal may have left a newer subscription running for the same user
+        renewed = await self.db.premium_subscriptions.distinct(
+            "user_id", {"user_id": {"$in": user_ids}, "status": "active", "expires_at": {"$gte": now}}
+        )
+        renewed = set(renewed)
+        revoked = [user_id for user_id in user_ids if user_id not in renewed]
+        if not revoked:
+            return 0
+        # A checkout completing meanwhile moves premium_expires_at past ended_at
+        result = await self.db.users.update_many(
+            {"user_id": {"$in": revoked}, "is_premium": True, "premium_expires_at": {"$not": {"$gt": ended_at}}},
+            {"$set": {"is_premium": False}}
+        )
+        self.revoked_users += result.modified_count
+        self.invalidate(*revoked)
+        return result.modified_count
+
+    def stats(self) -> dict:
+        return {
+            "cache": self._cache.stats(),
+            "sweeps": self.sweeps,
+            "expired_subscriptions": self.expired_subscriptions,
+            "expired_users": self.expired_users,
+            "revoked_users": self.revoked_users,
+            "last_sweep": self.last_sweep,
+        }
@@ -0,0 +1,189 @@
+"""
+In-process domain event bus
+Handlers run on background workers after the publishing request has returned.
+Every subscription has its own bounded queue, drains it in batches and retries
+failed batches with exponential backoff. A batch that still fails is handed
+over again one event at a time, so a single bad event fails alone. Retries
+run again from the first event, so handlers must be idempotent; counters
+that can't be are updated by the request alongside the source write instead.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Type
+
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
+
+# ==================== EVENTS ====================
+
+class Event(BaseModel):
+    user_id: str
+    occurred_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
+class FocusCompleted(Event):
+    session_id: str
+    minutes: int
+    credits_earned: int
+    total_focus_minutes: int
+    streak_days: int
+    level: int
+    previous_level: int
+
+class TodoCompleted(Event):
+    todo_id: str
+
+class ItemPurchased(Event):
+    item_id: str
+    price: int
+    purchases: int  # the user's purchase count including this one
+
+class FriendAdded(Event):
+    friend_id: str
+    friends: int         # user_id's friend count including this friendship
+    friend_friends: int  # friend_id's friend count including this friendship
+
+Handler = Callable[[List[Event]], Awaitable[None]]
+
+# ==================== BUS ====================
+
+class Subscription:
+    """One handler for one event type, with its own queue and worker"""
+
+    def __init__(self, name: str, handler: Handler, maxsize: int, batch_size: int):
+        self.name = name
+        self.handler = handler
+        self.batch_size = batch_size
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.task: Optional[asyncio.Task] = None
+        self.handled = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self.handler_seconds = 0.0
+        self.max_handler_seconds = 0.0
+        self.max_lag_seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "handled": self.handled,
+            "failed": self.failed,
+            "retries": self.retries,
+            "avg_handler_ms": round(1000 * self.handler_seconds / self.batches, 3) if self.batches else 0.0,
+            "max_handler_ms": round(1000 * self.max_handler_seconds, 3),
+            "max_lag_ms": round(1000 * self.max_lag_seconds, 3),
+        }
+
+
+class EventBus:
+    def __init__(self, maxsize: int = 10000, batch_size: int = 100, max_retries: int = 3, retry_backoff: float = 0.5):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._subscriptions: Dict[Type[Event], List[Subscription]] = {}
+        self._running = False
+
+    def subscribe(self, event_type: Type[Event], handler: Handler, batch_size: Optional[int] = None):
+        sub = Subscription(
+            f"{event_type.__name__}:{handler.__name__}", handler, self.maxsize, batch_size or self.batch_size
+        )
+        self._subscriptions.setdefault(event_type, []).append(sub)
+        if self._running:
+            sub.task = asyncio.create_task(self._worker(sub))
+        return handler
+
+    def on(self, event_type: Type[Event], batch_size: Optional[int] = None):
+        """Decorator form of subscribe()"""
+        def decorator(handler: Handler) -> Handler:
+            return self.subscribe(event_type, handler, batch_size)
+        return decorator
+
+    async def publish(self, event: Event):
+        """Queue an event for every subscriber; waits only when a queue is full"""
+        for sub in self._subscriptions.get(type(event), ()):
+            item = (time.monotonic(), event)
+            try:
+                sub.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                # Backpressure: the publisher slows down instead of dropping work
+                await sub.queue.put(item)
+
+    async def start(self):
+        self._running = True
+        for subs in self._subscriptions.values():
+            for sub in subs:
+                if sub.task is None:
+                    sub.task = asyncio.create_task(self._worker(sub))
+
+    async def stop(self, timeout: float = 5.0):
+        """Let workers drain what is queued, then cancel them"""
+        self._running = False
+        subs = [sub for group in self._subscriptions.values() for sub in group]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(sub.queue.join() for sub in subs)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Event bus stopped with undelivered events")
+        for sub in subs:
+            if sub.task:
+                sub.task.cancel()
+                sub.task = None
+
+    async def _worker(self, sub: Subscription):
+        while True:
+            batch = [await sub.queue.get()]
+            while len(batch) < sub.batch_size and not sub.queue.empty():
+                batch.append(sub.queue.get_nowait())
+            try:
+                await self._deliver(sub, batch)
+            finally:
+                for _ in batch:
+                    sub.queue.task_done()
+
+    async def _deliver(self, sub: Subscription, batch: list):
+        error = await self._attempt(sub, batch, self.max_retries)
+        if error is None:
+            return
+        if len(batch) == 1:
+            sub.failed += 1
+            logger.error(f"Event handler {sub.name} failed after {self.max_retries + 1} attempts: {error}")
+            return
+        logger.warning(
+            f"Event handler {sub.name} failed a batch of {len(batch)} after {self.max_retries + 1} attempts "
+            f"({error}); delivering its events one at a time"
+        )
+        for item in batch:
+            # The batch retries already waited out transient errors; what fails now is the event
+            error = await self._attempt(sub, [item], 0)
+            if error is not None:
+                event = item[1]
+                sub.failed += 1
+                logger.error(f"Event handler {sub.name} failed for {type(event).__name__} of {event.user_id}: {error}")
+
+    async def _attempt(self, sub: Subscription, batch: list, retries: int) -> Optional[Exception]:
+        """Run the handler on batch with up to `retries` retries; returns the last error, if any"""
+        events = [event for _, event in batch]
+        for attempt in range(retries + 1):
+            started = time.monotonic()
+            try:
+                await sub.handler(events)
+            except Exception as e:
+                if attempt == retries:
+                    return e
+                sub.retries += 1
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+                continue
+            elapsed = time.monotonic() - started
+            sub.batches += 1
+            sub.handled += len(events)
+            sub.handler_seconds += elapsed
+            sub.max_handler_seconds = max(sub.max_handler_seconds, elapsed)
+            sub.max_lag_seconds = max(sub.max_lag_seconds, time.monotonic() - batch[0][0])
+            return None
+
+    def stats(self) -> dict:
+        return {sub.name: sub.stats() for subs in self._subscriptions.values() for sub in subs}
@@ -0,0 +1,123 @@
+"""
+Group-commit buffer for high-rate inserts
+Documents arriving within a few milliseconds of each other are written with
+one ordered insert_many. Every caller waits until the batch holding its
+document has been acknowledged, so a successful insert() means the same as
+a successful insert_one().
+"""
+
+import asyncio
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from pymongo.errors import BulkWriteError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommitWriter:
+    def __init__(self, collection, max_delay: float = 0.005, max_batch: int = 500):
+        self.collection = collection
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._pending: List[Tuple[dict, asyncio.Future, float]] = []
+        self._wake = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.inserted = 0
+        self.failed = 0
+        self.max_wait_seconds = 0.0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop batching and write whatever is still buffered"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        while self._pending:
+            await self._flush()
+
+    async def insert(self, doc: dict):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((doc, future, time.monotonic()))
+        self._wake.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        await future
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            if len(self._pending) < self.max_batch:
+                # Hold the batch open briefly so concurrent senders can join it
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"Group commit flush failed: {e}")
+            if len(self._pending) < self.max_batch:
+                self._full.clear()
+            if not self._pending:
+                self._wake.clear()
+
+    async def _flush(self):
+        batch = self._pending[:self.max_batch]
+        self._pending = self._pending[self.max_batch:]
+        if not batch:
+            return
+        self.batches += 1
+        try:
+            await self.collection.insert_many([doc for doc, _, _ in batch], ordered=True)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors") or []
+            if e.details.get("writeConcernErrors") or not errors:
+                # No per-document outcome; the batch can't be reported as durable
+                self._fail(batch, e)
+                return
+            # Ordered: everything before the first error is written, nothing after it was tried
+            error = errors[0]
+            index = error["index"]
+            self._resolve(batch[:index])
+            self._fail(batch[index:index + 1], OperationFailure(error.get("errmsg", "Write failed"), error.get("code")))
+            self._pending = batch[index + 1:] + self._pending
+            if self._pending:
+                self._wake.set()
+        except Exception as e:
+            self._fail(batch, e)
+        except BaseException:
+            # Cancelled mid-write (stop()): the outcome is unknown, but no sender may wait forever
+            self._fail(batch, OperationFailure("Group commit stopped before the batch was acknowledged"))
+            raise
+        else:
+            self._resolve(batch)
+
+    def _resolve(self, batch):
+        now = time.monotonic()
+        for _, future, queued_at in batch:
+            self.max_wait_seconds = max(self.max_wait_seconds, now - queued_at)
+            if not future.done():
+                future.set_result(None)
+        self.inserted += len(batch)
+
+    def _fail(self, batch, error: Exception):
+        for _, future, _ in batch:
+            if not future.done():
+                future.set_exception(error)
+        self.failed += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "avg_batch": round(self.inserted / self.batches, 2) if self.batches else 0.0,
+            "max_wait_ms": round(1000 * self.max_wait_seconds, 3),
+        }
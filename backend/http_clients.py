@@ -0,0 +1,181 @@
+"""
+Pooled outbound HTTP clients, one per upstream
+Each upstream keeps a single application-lifetime httpx.AsyncClient, so
+connections and TLS sessions are reused, with its own timeouts and
+connection limits (HTTP/2 when the h2 package is installed). A circuit
+breaker answers 503 straight away after repeated failures instead of
+tying requests up in timeouts, then lets one probe through to test
+recovery. Base URLs come from the environment so local stub servers
+can stand in for the real services.
+"""
+
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+import httpx
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures; half-opens after `reset_seconds`"""
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            # Exactly one request tests the upstream; the rest keep failing fast
+            self.probing = True
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        if self.opened_at is None:
+            return 0
+        return max(1, int(self.reset_seconds - (time.monotonic() - self.opened_at)))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probing:
+                self.opens += 1
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+class Upstream:
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        timeout: float = 10.0,
+        connect_timeout: float = 3.0,
+        max_connections: int = 50,
+        max_keepalive: int = 20,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30.0
+    ):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout, pool=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.statuses: Dict[str, int] = {}
+        self.request_seconds = 0.0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, timeout=self.timeout, limits=self.limits, http2=HTTP2
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send a request; 503 when the circuit is open or the upstream can't be reached"""
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail=f"{self.name} is temporarily unavailable",
+                headers={"Retry-After": str(self.breaker.retry_after())}
+            )
+        self.requests += 1
+        started = time.monotonic()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError as e:
+            self.errors += 1
+            self.breaker.record_failure()
+            logger.warning(f"{self.name} request {method} {path} failed: {e!r}")
+            raise HTTPException(status_code=503, detail=f"{self.name} is temporarily unavailable")
+        except BaseException:
+            # Cancelled mid-flight: say nothing about health but free the probe slot
+            self.breaker.probing = False
+            raise
+        finally:
+            self.request_seconds += time.monotonic() - started
+        status = str(response.status_code)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        # A 4xx is the caller's problem, not a sign the upstream is unhealthy
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "http2": HTTP2,
+            "circuit": self.breaker.state,
+            "circuit_opens": self.breaker.opens,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "by_status": dict(self.statuses),
+            "avg_request_ms": round(1000 * self.request_seconds / self.requests, 3) if self.requests else 0.0,
+        }
+
+
+def create_upstream(name: str, env_prefix: str, default_base_url: str, timeout: float = 10.0) -> Upstream:
+    """Upstream configured from <PREFIX>_BASE_URL, _TIMEOUT, _MAX_CONNECTIONS and circuit settings"""
+    def env(key: str, default: str) -> str:
+        return os.environ.get(f"{env_prefix}_{key}", default)
+    
+    return Upstream(
+        name,
+        env("BASE_URL", default_base_url),
+        timeout=float(env("TIMEOUT", str(timeout))),
+        connect_timeout=float(env("CONNECT_TIMEOUT", "3")),
+        max_connections=int(env("MAX_CONNECTIONS", "50")),
+        max_keepalive=int(env("MAX_KEEPALIVE", "20")),
+        failure_threshold=int(env("CIRCUIT_FAILURES", "5")),
+        reset_seconds=float(env("CIRCUIT_RESET_SECONDS", "30"))
+    )
@@ -0,0 +1,332 @@
+"""
+Materialized focus-minutes leaderboard
+Keeps all-time, weekly and daily rankings in memory, updated incrementally as
+focus sessions complete and resynced from MongoDB in the background
+"""
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from cache import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+WINDOWS = ("all", "weekly", "daily")
+
+PROFILE_FIELDS = {"_id": 0, "user_id": 1, "name": 1, "picture": 1, "level": 1, "total_focus_minutes": 1, "streak_days": 1}
+
+
+class SortedKeys:
+    """
+    Bucketed sorted list with a Fenwick tree over bucket sizes
+    Insert, remove and rank touch one bucket of at most 2 * load keys plus
+    O(log n) tree nodes, so updates stay cheap at any number of members.
+    """
+
+    def __init__(self, keys=(), load: int = 512):
+        self.load = load
+        keys = sorted(keys)
+        self._buckets: List[list] = [keys[i:i + load] for i in range(0, len(keys), load)]
+        self._maxes: List[tuple] = [bucket[-1] for bucket in self._buckets]
+        self._len = len(keys)
+        self._reindex()
+
+    def _reindex(self):
+        """Rebuild the Fenwick tree after buckets are split or removed"""
+        tree = [0] * (len(self._buckets) + 1)
+        for i, bucket in enumerate(self._buckets, start=1):
+            tree[i] += len(bucket)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _update(self, index: int, delta: int):
+        index += 1
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index += index & -index
+
+    def _before(self, index: int) -> int:
+        """Number of keys in the buckets before index"""
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    def add(self, key):
+        if not self._buckets:
+            self._buckets, self._maxes, self._len = [[key]], [key], 1
+            self._reindex()
+            return
+        index = min(bisect_left(self._maxes, key), len(self._buckets) - 1)
+        bucket = self._buckets[index]
+        insort(bucket, key)
+        self._maxes[index] = bucket[-1]
+        self._len += 1
+        if len(bucket) > 2 * self.load:
+            self._buckets[index:index + 1] = [bucket[:self.load], bucket[self.load:]]
+            self._maxes[index:index + 1] = [bucket[self.load - 1], bucket[-1]]
+            self._reindex()
+        else:
+            self._update(index, 1)
+
+    def remove(self, key):
+        index = bisect_left(self._maxes, key)
+        bucket = self._buckets[index]
+        del bucket[bisect_left(bucket, key)]
+        self._len -= 1
+        if bucket:
+            self._maxes[index] = bucket[-1]
+            self._update(index, -1)
+        else:
+            del self._buckets[index]
+            del self._maxes[index]
+            self._reindex()
+
+    def index(self, key) -> int:
+        """0-based position of a key that is present"""
+        index = bisect_left(self._maxes, key)
+        return self._before(index) + bisect_left(self._buckets[index], key)
+
+    def head(self, n: int) -> list:
+        keys = []
+        for bucket in self._buckets:
+            if len(keys) >= n:
+                break
+            keys.extend(bucket[:n - len(keys)])
+        return keys
+
+    def __len__(self) -> int:
+        return self._len
+
+
+class RankedSet:
+    """Members ordered by score (desc); updates and rank lookups are O(log n) plus one bucket"""
+
+    def __init__(self):
+        self._keys = SortedKeys()  # (-score, member)
+        self._scores: Dict[str, int] = {}
+
+    def load(self, pairs):
+        self._scores = dict(pairs)
+        self._keys = SortedKeys((-score, member) for member, score in self._scores.items())
+
+    def incr(self, member: str, delta: int) -> int:
+        """Add delta to member's score and return its new 0-based rank"""
+        old = self._scores.get(member)
+        if old is not None:
+            self._keys.remove((-old, member))
+        score = (old or 0) + delta
+        self._scores[member] = score
+        self._keys.add((-score, member))
+        return self._keys.index((-score, member))
+
+    def score(self, member: str) -> Optional[int]:
+        return self._scores.get(member)
+
+    def rank(self, member: str) -> Optional[int]:
+        score = self._scores.get(member)
+        if score is None:
+            return None
+        return self._keys.index((-score, member))
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        return [(member, -neg) for neg, member in self._keys.head(n)]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+def window_keys(now: datetime) -> Dict[str, str]:
+    """Identify the current daily and weekly (Monday-based) windows"""
+    today = now.date()
+    return {
+        "all": "all",
+        "weekly": (today - timedelta(days=today.weekday())).isoformat(),
+        "daily": today.isoformat(),
+    }
+
+
+class Leaderboard:
+    """In-memory leaderboard service backed by users and focus_sessions"""
+
+    def __init__(self, db, resync_seconds: float = 300, top_cache_limit: int = 100):
+        self.db = db
+        self.resync_seconds = resync_seconds
+        self.top_cache_limit = top_cache_limit
+        self._sets: Dict[str, RankedSet] = {w: RankedSet() for w in WINDOWS}
+        self._keys: Dict[str, str] = {}
+        self._top_cache: Dict[Tuple[str, int], list] = {}
+        # Bumped whenever a window's cached heads are dropped, so a load that raced one isn't stored
+        self._generation: Dict[str, int] = {w: 0 for w in WINDOWS}
+        self._flight = SingleFlight()
+        self._journal: Optional[List[Tuple[str, int, datetime, Optional[int]]]] = None
+        self._loaded = False
+        self._task: Optional[asyncio.Task] = None
+        self.updates = 0
+        self.last_build_seconds = 0.0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._resync_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def ensure_loaded(self):
+        if not self._loaded:
+            await self._flight.do("build", self._build)
+
+    async def _resync_loop(self):
+        while True:
+            try:
+                await self._flight.do("build", self._build)
+            except Exception as e:
+                logger.error(f"Leaderboard build failed: {e}")
+            await asyncio.sleep(self.resync_seconds)
+
+    async def _build(self):
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        keys = window_keys(now)
+        read_point = now.isoformat()
+        # Updates recorded while the snapshot is read are replayed onto it, minus
+        # the ones the snapshot already saw (see the replay below)
+        self._journal = []
+        try:
+            all_time, seen = [], {}
+            cursor = self.db.users.find(
+                {"total_focus_minutes": {"$gt": 0}},
+                {"_id": 0, "user_id": 1, "total_focus_minutes": 1, "focus_seq": 1}
+            ).batch_size(10000)
+            async for doc in cursor:
+                all_time.append((doc["user_id"], doc["total_focus_minutes"]))
+                seen[doc["user_id"]] = doc.get("focus_seq", 0)
+
+            weekly, daily = [], []
+            pipeline = [
+                {"$match": {"status": "completed", "ended_at": {"$gte": keys["weekly"], "$lt": read_point}}},
+                {"$group": {
+                    "_id": "$user_id",
+                    "weekly": {"$sum": "$actual_minutes"},
+                    "daily": {"$sum": {"$cond": [{"$gte": ["$ended_at", keys["daily"]]}, "$actual_minutes", 0]}},
+                }},
+            ]
+            async for doc in self.db.focus_sessions.aggregate(pipeline, allowDiskUse=True):
+                if doc["weekly"]:
+                    weekly.append((doc["_id"], doc["weekly"]))
+                if doc["daily"]:
+                    daily.append((doc["_id"], doc["daily"]))
+
+            sets = {w: RankedSet() for w in WINDOWS}
+            sets["all"].load(all_time)
+            sets["weekly"].load(weekly)
+            sets["daily"].load(daily)
+            journal = self._journal
+        finally:
+            self._journal = None
+
+        self._sets, self._keys = sets, keys
+        for window in WINDOWS:
+            self._drop_top_cache(window)
+        self._loaded = True
+        for user_id, minutes, when, seq in journal:
+            # The user document carries the sequence number of the last completion it
+            # includes; the windows cover exactly the sessions ended before read_point
+            windows = ()
+            if seq is None or seq > seen.get(user_id, 0):
+                windows += ("all",)
+            if when.isoformat() >= read_point:
+                windows += ("weekly", "daily")
+            self._apply(user_id, minutes, when, windows)
+        self.last_build_seconds = time.perf_counter() - started
+        logger.info(f"Leaderboard built: {len(sets['all'])} ranked users in {self.last_build_seconds:.2f}s")
+
+    def _roll_windows(self, now: datetime):
+        keys = window_keys(now)
+        for window in ("weekly", "daily"):
+            if self._keys.get(window) != keys[window]:
+                self._sets[window] = RankedSet()
+                self._keys[window] = keys[window]
+                self._drop_top_cache(window)
+
+    def _drop_top_cache(self, window: str):
+        self._generation[window] += 1
+        for key in [k for k in self._top_cache if k[0] == window]:
+            del self._top_cache[key]
+
+    def record_minutes(self, user_id: str, minutes: int, when: Optional[datetime] = None, seq: Optional[int] = None):
+        """Credit focus minutes to every window; seq is the user's focus_seq after this completion"""
+        if minutes <= 0:
+            return
+        when = when or datetime.now(timezone.utc)
+        if self._journal is not None:
+            self._journal.append((user_id, minutes, when, seq))
+        self._apply(user_id, minutes, when, WINDOWS)
+
+    def _apply(self, user_id: str, minutes: int, when: datetime, windows: Tuple[str, ...]):
+        if not windows:
+            return
+        self._roll_windows(when)
+        self.updates += 1
+        for window in windows:
+            rank = self._sets[window].incr(user_id, minutes)
+            # Only movements inside the cached head invalidate it
+            if rank < self.top_cache_limit:
+                self._drop_top_cache(window)
+
+    async def top(self, window: str, limit: int = 20) -> list:
+        await self.ensure_loaded()
+        self._roll_windows(datetime.now(timezone.utc))
+        cached = self._top_cache.get((window, limit))
+        if cached is not None:
+            return cached
+        # Concurrent identical requests share one profile fetch
+        return await self._flight.do(("top", window, limit), lambda: self._load_top(window, limit))
+
+    async def _load_top(self, window: str, limit: int) -> list:
+        generation = self._generation[window]
+        head = self._sets[window].top(limit)
+        profiles = {}
+        if head:
+            cursor = self.db.users.find({"user_id": {"$in": [m for m, _ in head]}}, PROFILE_FIELDS)
+            async for doc in cursor:
+                profiles[doc["user_id"]] = doc
+
+        entries = []
+        for rank, (user_id, minutes) in enumerate(head, start=1):
+            profile = profiles.get(user_id)
+            if not profile:
+                continue
+            entries.append({**profile, "rank": rank, "minutes": minutes})
+        if limit <= self.top_cache_limit and generation == self._generation[window]:
+            self._top_cache[(window, limit)] = entries
+        return entries
+
+    async def rank_of(self, window: str, user_id: str) -> dict:
+        await self.ensure_loaded()
+        self._roll_windows(datetime.now(timezone.utc))
+        ranked = self._sets[window]
+        rank = ranked.rank(user_id)
+        return {
+            "window": window,
+            "rank": rank + 1 if rank is not None else None,
+            "minutes": ranked.score(user_id) or 0,
+            "total_ranked": len(ranked),
+        }
+
+    def stats(self) -> dict:
+        return {
+            "ranked": {w: len(s) for w, s in self._sets.items()},
+            "updates": self.updates,
+            "cached_heads": len(self._top_cache),
+            "last_build_seconds": round(self.last_build_seconds, 3),
+            "coalesced": self._flight.stats(),
+        }
@@ -10,6 +10,9 @@ import os
 from dotenv import load_dotenv
 from pathlib import Path
 
+from chat_inbox import migrate_direct_chats, rebuild_all
+from chat_search import backfill as backfill_search
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
@@ -110,6 +113,144 @@ async def migrate():
     except Exception as e:
         print(f"   - Indexes already exist or error: {e}")
     
+    # 8. Leaderboard window rebuilds
+    print("\n8. Creating focus_sessions indexes...")
+    try:
+        await db.focus_sessions.create_index([("status", 1), ("ended_at", 1)])
+        await db.users.create_index("total_focus_minutes")
+        print("   ✓ focus_sessions indexes created")
+    except Exception as e:
+        print(f"   - Indexes already exist or error: {e}")
+    
+    # 9. Badge and achievement awards are idempotent on these keys
+    print("\n9. Creating award indexes...")
+    try:
+        await db.user_badges.create_index([("user_id", 1), ("badge_id", 1)], unique=True)
+        await db.user_achievements.create_index([("user_id", 1), ("achievement_id", 1)], unique=True)
+        print("   ✓ Award indexes created")
+    except Exception as e:
+        print(f"   - Indexes already exist or error: {e}")
+    
+    # 10. Per-user counters (backfill with reconcile_counters.py)
+    print("\n10. Creating user_counters index...")
+    try:
+        await db.user_counters.create_index("user_id", unique=True)
+        print("   ✓ user_counters index created")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 11. One quest document per user per day
+    print("\n11. Creating user_daily_quests index...")
+    try:
+        await db.user_daily_quests.create_index([("user_id", 1), ("date", 1)], unique=True)
+        print("   ✓ user_daily_quests index created")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 12. Keyset pagination for chat history
+    print("\n12. Creating chat history index...")
+    try:
+        await db.chat_messages.create_index([("chat_id", 1), ("created_at", -1), ("message_id", -1)])
+        print("   ✓ chat_messages (chat_id, created_at, message_id) index created")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 13. Materialized chat inbox with per-user read watermarks
+    print("\n13. Creating chat_inbox collection...")
+    try:
+        await db.chat_inbox.create_index([("user_id", 1), ("chat_id", 1)], unique=True)
+        await db.chat_inbox.create_index([("user_id", 1), ("last_message.created_at", -1)])
+        # One-to-one chats used to be stored under the sender's friend_<recipient> id
+        moved = await migrate_direct_chats(db)
+        total = await rebuild_all(db)
+        print(f"   ✓ chat_inbox indexes created, {moved} direct messages re-keyed, {total} entries backfilled")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 14. Chat archive segment index
+    print("\n14. Creating chat archive indexes...")
+    try:
+        await db.chat_archive_segments.create_index("segment_id", unique=True)
+        await db.chat_archive_segments.create_index([("chat_id", 1), ("last_at", -1), ("last_id", -1)])
+        await db.chat_archive_segments.create_index([("chat_id", 1), ("first_at", 1), ("first_id", 1)])
+        await db.chat_archive_blobs.create_index("segment_id", unique=True)
+        print("   ✓ chat_archive_segments and chat_archive_blobs indexes created")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 15. Chat message search
+    print("\n15. Creating chat search index...")
+    try:
+        total = await backfill_search(db)
+        await db.chat_messages.create_index(
+            [("search_text", "text")], default_language="none", name="chat_messages_search"
+        )
+        print(f"   ✓ chat_messages text index created, {total} messages backfilled")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 16. Push campaigns
+    print("\n16. Creating push_campaigns collection...")
+    try:
+        await db.push_campaigns.create_index("campaign_id", unique=True)
+        await db.push_subscriptions.create_index("subscription.endpoint")
+        print("   ✓ push_campaigns and push_subscriptions endpoint indexes created")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 17. Stripe checkout reuse and webhook deduplication
+    print("\n17. Creating billing indexes...")
+    try:
+        await db.premium_checkouts.create_index("session_id", unique=True)
+        await db.premium_checkouts.create_index([("user_id", 1), ("plan", 1), ("status", 1), ("created_at", -1)])
+        await db.stripe_events.create_index("event_id", unique=True)
+        await db.stripe_events.create_index([("status", 1), ("received_at", 1)])
+        await db.premium_subscriptions.create_index("checkout_session_id", unique=True, sparse=True)
+        print("   ✓ premium_checkouts, stripe_events and premium_subscriptions indexes created")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 18. Premium expiry sweep walks active subscriptions by expiry
+    print("\n18. Creating premium expiry index...")
+    try:
+        await db.premium_subscriptions.create_index([("status", 1), ("expires_at", 1)])
+        print("   ✓ premium_subscriptions (status, expires_at) index created")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 19. Spotify token renewal scans users by token expiry
+    print("\n19. Creating Spotify token expiry index...")
+    try:
+        await db.users.create_index([("spotify_expires_at", 1), ("user_id", 1)], sparse=True)
+        print("   ✓ users (spotify_expires_at, user_id) index created")
+    except Exception as e:
+        print(f"   - Index already exists or error: {e}")
+    
+    # 20. One session per user, found by token; login's replace-by-user upsert relies on both being unique
+    print("\n20. Creating user_sessions indexes...")
+    try:
+        removed = 0
+        for field in ("user_id", "session_token"):
+            # Keep the newest row for each value; older ones are sessions login used to leave behind
+            duplicates = db.user_sessions.aggregate([
+                {"$sort": {"created_at": -1}},
+                {"$group": {"_id": f"${field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+                {"$match": {"count": {"$gt": 1}}}
+            ], allowDiskUse=True)
+            async for group in duplicates:
+                result = await db.user_sessions.delete_many({"_id": {"$in": group["ids"][1:]}})
+                removed += result.deleted_count
+        indexes = await db.user_sessions.index_information()
+        for name in ("user_id_1", "session_token_1"):
+            # An earlier run created these without the unique option
+            if name in indexes and not indexes[name].get("unique"):
+                await db.user_sessions.drop_index(name)
+        await db.user_sessions.create_index("user_id", unique=True)
+        await db.user_sessions.create_index("session_token", unique=True)
+        print(f"   ✓ user_sessions unique indexes created, {removed} duplicate sessions removed")
+    except Exception as e:
+        print(f"   - Indexes already exist or error: {e}")
+    
     print("\n" + "=" * 60)
     print("Migration Completed Successfully! ✓")
     print("=" * 60)
@@ -0,0 +1,241 @@
+"""
+Bulk push campaigns
+Streams push_subscriptions in _id order, keeps the subscribers that match
+the campaign's cohort and sends them in parallel from a process pool, where
+each process encrypts and posts its share under a per-origin rate limit.
+Progress is checkpointed in push_campaigns after every batch so an
+interrupted campaign resumes from the last finished batch.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Set
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+GONE_STATUSES = (404, 410)
+
+CAMPAIGNS = {
+    "streak_at_risk": {
+        "tr": {"title": "Serin tehlikede! 🔥", "body": "Serini korumak için bugün kısa bir odak seansı yap."},
+        "en": {"title": "Your streak is at risk! 🔥", "body": "Do a short focus session today to keep your streak."},
+    },
+    "daily_quest_ready": {
+        "tr": {"title": "Günlük görevler hazır ☕", "body": "Bugünün görevleri seni bekliyor."},
+        "en": {"title": "Daily quests are ready ☕", "body": "Today's quests are waiting for you."},
+    },
+}
+
+
+# ==================== COHORTS ====================
+
+async def cohort(db, kind: str, user_ids: List[str], now: datetime) -> Dict[str, str]:
+    """Users from this batch who belong to the campaign, mapped to their language"""
+    today = now.date()
+    yesterday = today - timedelta(days=1)
+    query = {"user_id": {"$in": user_ids}}
+    if kind == "streak_at_risk":
+        # Studied yesterday but not yet today; last_study_date may be an ISO string or a date
+        start = datetime.combine(yesterday, datetime.min.time(), timezone.utc)
+        query.update({"streak_days": {"$gt": 0}, "$or": [
+            {"last_study_date": {"$gte": yesterday.isoformat(), "$lt": today.isoformat()}},
+            {"last_study_date": {"$gte": start, "$lt": start + timedelta(days=1)}},
+        ]})
+    users = {
+        doc["user_id"]: doc.get("language") or "tr"
+        async for doc in db.users.find(query, {"_id": 0, "user_id": 1, "language": 1})
+    }
+    if kind == "daily_quest_ready" and users:
+        # Skip users who already opened today's quests
+        seen = await db.user_daily_quests.distinct(
+            "user_id", {"user_id": {"$in": list(users)}, "date": today.isoformat()}
+        )
+        for user_id in seen:
+            users.pop(user_id, None)
+    return users
+
+
+# ==================== SENDER PROCESS ====================
+
+_buckets: Dict[str, list] = {}
+
+
+def _throttle(origin: str, rate: float):
+    """Per-process token bucket for one push service origin"""
+    now = time.monotonic()
+    tokens, updated = _buckets.get(origin, [rate, now])
+    tokens = min(rate, tokens + (now - updated) * rate)
+    if tokens < 1:
+        time.sleep((1 - tokens) / rate)
+        now = time.monotonic()
+        tokens = 1
+    _buckets[origin] = [tokens - 1, now]
+
+
+def send_chunk(jobs: List[dict], vapid_private_key: str, vapid_claims: dict, origin_rate: float, timeout: float) -> List[tuple]:
+    """Runs in a pool process: encrypt and POST each job, returning (user_id, endpoint, status)"""
+    import requests
+    from pywebpush import WebPushException, webpush
+
+    session = requests.Session()
+    results = []
+    for job in jobs:
+        endpoint = job["subscription"].get("endpoint", "")
+        _throttle(urlparse(endpoint).netloc, origin_rate)
+        try:
+            response = webpush(
+                subscription_info=job["subscription"],
+                data=job["data"],
+                vapid_private_key=vapid_private_key,
+                vapid_claims=dict(vapid_claims),
+                timeout=timeout,
+                requests_session=session
+            )
+            status = response.status_code
+        except WebPushException as e:
+            status = e.response.status_code if e.response is not None else "error"
+        except requests.RequestException:
+            status = "network"
+        results.append((job["user_id"], endpoint, status))
+    return results
+
+
+# ==================== RUNNER ====================
+
+class CampaignRunner:
+    def __init__(
+        self,
+        db,
+        vapid_private_key: str,
+        vapid_claims: dict,
+        processes: int = 4,
+        batch_size: int = 1000,
+        origin_rate: float = 500.0,
+        timeout: float = 10.0
+    ):
+        self.db = db
+        self.vapid_private_key = vapid_private_key
+        self.vapid_claims = vapid_claims
+        self.processes = processes
+        self.batch_size = batch_size
+        # The per-origin budget is split evenly between the sender processes
+        self.origin_rate = origin_rate / processes
+        self.timeout = timeout
+
+    async def create(self, kind: str) -> str:
+        if kind not in CAMPAIGNS:
+            raise ValueError(f"Unknown campaign {kind}")
+        campaign_id = str(uuid.uuid4())
+        now = datetime.now(timezone.utc)
+        await self.db.push_campaigns.insert_one({
+            "campaign_id": campaign_id,
+            "kind": kind,
+            "status": "pending",
+            "cohort_date": now.isoformat(),
+            "cursor": None,
+            "scanned": 0,
+            "sent": 0,
+            "failed": 0,
+            "pruned": 0,
+            "by_status": {},
+            "send_seconds": 0.0,
+            "created_at": now.isoformat(),
+        })
+        return campaign_id
+
+    async def run(self, campaign_id: str) -> dict:
+        """Run or resume a campaign until its cohort is exhausted"""
+        campaign = await self.db.push_campaigns.find_one({"campaign_id": campaign_id}, {"_id": 0})
+        if not campaign:
+            raise ValueError(f"Campaign {campaign_id} not found")
+        if campaign["status"] == "completed":
+            return campaign
+        # The cohort is evaluated as of creation so a resumed run targets the same day
+        now = datetime.fromisoformat(campaign["cohort_date"])
+        messages = {lang: json.dumps(text) for lang, text in CAMPAIGNS[campaign["kind"]].items()}
+        await self._checkpoint(campaign_id, {"status": "running"})
+
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            query = {"_id": {"$gt": campaign["cursor"]}} if campaign["cursor"] else {}
+            cursor = self.db.push_subscriptions.find(
+                query, {"user_id": 1, "subscription": 1}
+            ).sort("_id", 1).batch_size(self.batch_size)
+            batch = []
+            async for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= self.batch_size:
+                    await self._run_batch(loop, pool, campaign, now, messages, batch)
+                    batch = []
+            if batch:
+                await self._run_batch(loop, pool, campaign, now, messages, batch)
+
+        await self._checkpoint(campaign_id, {"status": "completed", "completed_at": datetime.now(timezone.utc).isoformat()})
+        return await self.report(campaign_id)
+
+    async def _run_batch(self, loop, pool, campaign: dict, now: datetime, messages: Dict[str, str], batch: List[dict]):
+        languages = await cohort(self.db, campaign["kind"], [d["user_id"] for d in batch], now)
+        jobs = [
+            {"user_id": d["user_id"], "subscription": d["subscription"], "data": messages.get(languages[d["user_id"]], messages["tr"])}
+            for d in batch if d["user_id"] in languages
+        ]
+
+        started = time.monotonic()
+        statuses: Counter = Counter()
+        gone: Set[str] = set()
+        if jobs:
+            chunks = [jobs[i::self.processes] for i in range(self.processes) if jobs[i::self.processes]]
+            results = await asyncio.gather(*(
+                loop.run_in_executor(
+                    pool, send_chunk, chunk, self.vapid_private_key, self.vapid_claims, self.origin_rate, self.timeout
+                )
+                for chunk in chunks
+            ))
+            for chunk_results in results:
+                for user_id, endpoint, status in chunk_results:
+                    statuses[str(status)] += 1
+                    if status in GONE_STATUSES:
+                        gone.add(endpoint)
+        elapsed = time.monotonic() - started
+
+        pruned = 0
+        if gone:
+            result = await self.db.push_subscriptions.delete_many({"subscription.endpoint": {"$in": list(gone)}})
+            pruned = result.deleted_count
+        sent = sum(n for status, n in statuses.items() if status.isdigit() and int(status) < 300)
+        await self.db.push_campaigns.update_one(
+            {"campaign_id": campaign["campaign_id"]},
+            {
+                "$set": {"cursor": batch[-1]["_id"], "updated_at": datetime.now(timezone.utc).isoformat()},
+                "$inc": {
+                    "scanned": len(batch),
+                    "sent": sent,
+                    "failed": len(jobs) - sent,
+                    "pruned": pruned,
+                    "send_seconds": elapsed,
+                    **{f"by_status.{status}": n for status, n in statuses.items()},
+                },
+            }
+        )
+
+    async def _checkpoint(self, campaign_id: str, fields: dict):
+        await self.db.push_campaigns.update_one(
+            {"campaign_id": campaign_id},
+            {"$set": {**fields, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+
+    async def report(self, campaign_id: str) -> Optional[dict]:
+        campaign = await self.db.push_campaigns.find_one({"campaign_id": campaign_id}, {"_id": 0, "cursor": 0})
+        if campaign:
+            attempts = campaign["sent"] + campaign["failed"]
+            rate = attempts / campaign["send_seconds"] if campaign["send_seconds"] else 0.0
+            campaign["sends_per_second"] = round(rate, 2)
+            campaign["sends_per_second_per_core"] = round(rate / self.processes, 2)
+        return campaign
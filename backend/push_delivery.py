@@ -0,0 +1,165 @@
+"""
+Web push delivery off the event loop
+Notifications go into a bounded queue; async workers hand each one to a
+thread pool where pywebpush encrypts and posts it. Transient failures
+(429, 5xx, network errors) are retried with exponential backoff and
+subscriptions the push service reports gone (404/410) are deleted.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import requests
+from pywebpush import WebPushException, webpush
+
+logger = logging.getLogger(__name__)
+
+GONE_STATUSES = (404, 410)
+
+
+class PushJob(NamedTuple):
+    user_id: str
+    subscription: dict
+    data: str
+    attempt: int = 0
+
+
+class PushDelivery:
+    def __init__(
+        self,
+        db,
+        vapid_private_key: str,
+        vapid_claims: dict,
+        workers: int = 8,
+        queue_size: int = 10000,
+        max_retries: int = 3,
+        retry_backoff: float = 1.0,
+        timeout: float = 10.0
+    ):
+        self.db = db
+        self.vapid_private_key = vapid_private_key
+        self.vapid_claims = vapid_claims
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks = []
+        self._local = threading.local()
+        self.statuses: Counter = Counter()
+        self.enqueued = 0
+        self.rejected = 0
+        self.retries = 0
+        self.pruned = 0
+        self.send_seconds = 0.0
+        self.sends = 0
+
+    async def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="webpush")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5.0):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Push delivery stopped with {self.queue.qsize()} notifications queued")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def enqueue(self, user_id: str, subscription: dict, data: str) -> bool:
+        """Queue a notification; False when the queue is full"""
+        try:
+            self.queue.put_nowait(PushJob(user_id, subscription, data))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def _session(self) -> requests.Session:
+        # One pooled HTTP session per worker thread
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _send(self, job: PushJob) -> tuple:
+        """Runs in the thread pool: encrypt and POST, returning (status, retry_after)"""
+        try:
+            response = webpush(
+                subscription_info=job.subscription,
+                data=job.data,
+                vapid_private_key=self.vapid_private_key,
+                # pywebpush fills in aud/exp per endpoint, so each send gets its own copy
+                vapid_claims=dict(self.vapid_claims),
+                timeout=self.timeout,
+                requests_session=self._session()
+            )
+            return response.status_code, None
+        except WebPushException as e:
+            if e.response is None:
+                return "error", None
+            return e.response.status_code, e.response.headers.get("Retry-After")
+        except requests.RequestException:
+            return "network", None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            try:
+                started = time.monotonic()
+                status, retry_after = await loop.run_in_executor(self._executor, self._send, job)
+                self.send_seconds += time.monotonic() - started
+                self.sends += 1
+                self.statuses[str(status)] += 1
+                await self._settle(job, status, retry_after)
+            except Exception as e:
+                logger.error(f"Push delivery to {job.user_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _settle(self, job: PushJob, status, retry_after: Optional[str]):
+        if status in GONE_STATUSES:
+            # Match the endpoint so a newer subscription for the same user survives
+            result = await self.db.push_subscriptions.delete_one({
+                "user_id": job.user_id,
+                "subscription.endpoint": job.subscription.get("endpoint")
+            })
+            self.pruned += result.deleted_count
+        elif status in ("network", 429) or (isinstance(status, int) and status >= 500):
+            if job.attempt >= self.max_retries:
+                logger.warning(f"Giving up on push to {job.user_id} after {job.attempt + 1} attempts ({status})")
+                return
+            delay = self.retry_backoff * 2 ** job.attempt
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            self.retries += 1
+            asyncio.get_running_loop().call_later(delay, self._requeue, job._replace(attempt=job.attempt + 1))
+
+    def _requeue(self, job: PushJob):
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "pruned": self.pruned,
+            "by_status": dict(self.statuses),
+            "avg_send_ms": round(1000 * self.send_seconds / self.sends, 3) if self.sends else 0.0,
+        }
@@ -0,0 +1,242 @@
+"""
+Token-bucket rate limiting per (route, key)
+Buckets live in process memory by default. With a shared RESP backend
+(Redis or compatible) every worker draws from the same bucket; checks from
+concurrent requests are pipelined on one connection, and if the backend is
+unreachable the process-local buckets take over.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+from fastapi import HTTPException
+
+from broker import RespError, encode_command, read_reply
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class Limit(NamedTuple):
+    rate: float  # tokens refilled per second
+    burst: int   # bucket capacity
+
+
+# A bucket admits at most burst + rate * T calls in any T seconds. Chat keeps
+# the old anti-spam cap of 3 messages in any 5s window: 2 at once, then one
+# more every 5 seconds
+LIMITS: Dict[str, Limit] = {
+    "chat_send": Limit(rate=1 / 5, burst=2),
+    "test_login": Limit(rate=5 / 60, burst=5),
+    "community_invite": Limit(rate=10 / 60, burst=10),
+    "notifications_send": Limit(rate=10 / 60, burst=10),
+}
+
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+
+class LocalBuckets:
+    """Buckets in an LRU; an entry idle long enough to refill completely is as good as absent"""
+
+    def __init__(self, maxsize: int = 100000):
+        self._buckets = TTLCache(maxsize=maxsize, ttl=3600)
+
+    def take(self, key: str, limit: Limit, now: float) -> Tuple[bool, float]:
+        tokens, updated = self._buckets.get(key) or (limit.burst, now)
+        tokens = min(limit.burst, tokens + max(0.0, now - updated) * limit.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets.set(key, (tokens, now), ttl=limit.burst / limit.rate)
+        return allowed, tokens
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class BackingOff(ConnectionError):
+    pass
+
+
+class RespConnection(NamedTuple):
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    pending: Deque[asyncio.Future]  # one per command written, in reply order
+    replies: asyncio.Task
+
+
+class RespBuckets:
+    """Token buckets evaluated atomically on a shared RESP server, pipelined on one connection"""
+
+    def __init__(self, url: str, timeout: float = 0.5, backoff: float = 1.0, max_backoff: float = 30.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._conn: Optional[RespConnection] = None
+        self._connect_lock = asyncio.Lock()
+        self._failures = 0
+        self._retry_at = 0.0
+
+    def _check_backoff(self):
+        if time.monotonic() < self._retry_at:
+            # Recently failed: don't hold requests up on another attempt
+            raise BackingOff("Shared rate limit backend is backing off")
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(encode_command("AUTH", self.password))
+            reply = await read_reply(reader)
+            if isinstance(reply, RespError):
+                writer.close()
+                raise reply
+        return reader, writer
+
+    async def _connection(self) -> RespConnection:
+        if self._conn is None:
+            async with self._connect_lock:
+                self._check_backoff()
+                if self._conn is None:
+                    try:
+                        # Bounded so a blackholed host costs one timeout, not a TCP connect timeout
+                        reader, writer = await asyncio.wait_for(self._open(), self.timeout)
+                    except Exception:
+                        self._failed()
+                        raise
+                    pending: Deque[asyncio.Future] = deque()
+                    replies = asyncio.create_task(self._read_replies(reader, pending))
+                    self._conn = RespConnection(reader, writer, pending, replies)
+        return self._conn
+
+    async def _read_replies(self, reader: asyncio.StreamReader, pending: Deque[asyncio.Future]):
+        """Hand each reply to the command written in the same position"""
+        try:
+            while True:
+                reply = await read_reply(reader)
+                future = pending.popleft()
+                if not future.done():
+                    future.set_result(reply)
+        except Exception as e:
+            if self._conn is not None and self._conn.pending is pending:
+                self._drop(self._conn, e)
+
+    def _drop(self, conn: RespConnection, error: Exception):
+        """Close a broken connection and fail every command still waiting on it"""
+        if self._conn is conn:
+            self._conn = None
+            self._failed()
+        conn.writer.close()
+        if conn.replies is not asyncio.current_task():
+            conn.replies.cancel()
+        while conn.pending:
+            future = conn.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(f"Shared rate limit backend connection lost: {error!r}"))
+
+    def _failed(self):
+        self._retry_at = time.monotonic() + min(self.max_backoff, self.backoff * 2 ** self._failures)
+        self._failures += 1
+
+    async def take(self, key: str, limit: Limit, now: float) -> Tuple[bool, float]:
+        self._check_backoff()
+        conn = await self._connection()
+        future = asyncio.get_running_loop().create_future()
+        # No await between queueing and writing, so replies line up with pending
+        conn.pending.append(future)
+        conn.writer.write(encode_command(
+            "EVAL", TOKEN_BUCKET_SCRIPT, "1", f"ratelimit:{key}",
+            repr(limit.rate), str(limit.burst), f"{now:.6f}"
+        ))
+        try:
+            reply = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError as e:
+            self._drop(conn, e)
+            raise
+        self._failures = 0
+        if isinstance(reply, RespError):
+            raise reply
+        return bool(reply[0]), float(reply[1])
+
+
+class RateLimiter:
+    def __init__(self, shared: Optional[RespBuckets] = None, limits: Optional[Dict[str, Limit]] = None):
+        self.shared = shared
+        self.limits = limits or LIMITS
+        self.local = LocalBuckets()
+        self.allowed = 0
+        self.limited = 0
+        self.shared_errors = 0
+
+    async def check(self, route: str, key: str) -> float:
+        """0 if the call may proceed, otherwise seconds until a token is available"""
+        limit = self.limits[route]
+        bucket_key = f"{route}:{key}"
+        now = time.time()
+        if self.shared:
+            try:
+                allowed, tokens = await self.shared.take(bucket_key, limit, now)
+                return self._result(allowed, tokens, limit)
+            except BackingOff:
+                self.shared_errors += 1
+            except Exception as e:
+                self.shared_errors += 1
+                logger.warning(f"Shared rate limit backend unavailable, using local buckets: {e}")
+        allowed, tokens = self.local.take(bucket_key, limit, time.monotonic())
+        return self._result(allowed, tokens, limit)
+
+    def _result(self, allowed: bool, tokens: float, limit: Limit) -> float:
+        if allowed:
+            self.allowed += 1
+            return 0.0
+        self.limited += 1
+        return max(0.0, (1 - tokens) / limit.rate)
+
+    async def enforce(self, route: str, key: str):
+        """Raise 429 with Retry-After when the bucket for (route, key) is empty"""
+        retry_after = await self.check(route, key)
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+
+    def stats(self) -> dict:
+        return {
+            "backend": "shared" if self.shared else "local",
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "shared_errors": self.shared_errors,
+            "local_buckets": len(self.local),
+        }
+
+
+def create_limiter(url: str = "") -> RateLimiter:
+    if url.startswith("redis://"):
+        return RateLimiter(RespBuckets(url))
+    return RateLimiter()
@@ -0,0 +1,366 @@
+"""
+WebSocket connection registry and fan-out
+Messages are serialized once and handed to each connection's bounded send
+queue; a per-connection writer task drains it, so one slow client never
+stalls the sender or the other recipients. Clients that fall too far behind
+are disconnected. With a broker, every message is also published on the
+recipient's channel so devices held by other workers get it too; each
+worker skips the copies it published itself.
+
+Clients that connect without a subprotocol get one JSON object per frame.
+The v2 subprotocols (JSON or msgpack) receive every frame as an array of
+events, so events that queue up under load are coalesced into one frame.
+
+A user may hold several sockets (one per device). Liveness is checked by a
+single heartbeat task walking a timer wheel: each tick visits one slot,
+pings its sockets and closes those that have been silent too long.
+"""
+
+import asyncio
+import json
+import logging
+import struct
+import os
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Set
+
+from fastapi import WebSocket
+
+from broker import Broker, user_channel
+
+try:
+    import msgpack
+except ImportError:  # optional: only the JSON protocols are offered without it
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Close code 1013 ("try again later") tells the client to reconnect
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# Close code 1001 ("going away") for sockets that stopped answering pings
+IDLE_CLOSE_CODE = 1001
+
+SUBPROTOCOL_JSON = "tinycafe.v2.json"
+SUBPROTOCOL_MSGPACK = "tinycafe.v2.msgpack"
+
+
+def encode(message: dict) -> str:
+    """Serialize once with the same settings as WebSocket.send_json"""
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def negotiate(requested: List[str]) -> Optional[str]:
+    """Pick the first subprotocol offered by the client that this server supports"""
+    supported = {SUBPROTOCOL_JSON} | ({SUBPROTOCOL_MSGPACK} if msgpack else set())
+    for protocol in requested:
+        if protocol in supported:
+            return protocol
+    return None
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process (Linux), 0 where unavailable"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def msgpack_array_header(n: int) -> bytes:
+    if n < 16:
+        return bytes([0x90 | n])
+    if n < 0x10000:
+        return b"\xdc" + struct.pack(">H", n)
+    return b"\xdd" + struct.pack(">I", n)
+
+
+class Payload:
+    """A server event, encoded at most once per wire format however many sockets it reaches"""
+
+    __slots__ = ("_message", "_json", "_msgpack")
+
+    def __init__(self, message: Optional[dict] = None, json_text: Optional[str] = None):
+        self._message = message
+        self._json = json_text
+        self._msgpack: Optional[bytes] = None
+
+    @property
+    def json(self) -> str:
+        if self._json is None:
+            self._json = encode(self._message)
+        return self._json
+
+    @property
+    def msgpack(self) -> bytes:
+        if self._msgpack is None:
+            if self._message is None:
+                self._message = json.loads(self._json)
+            self._msgpack = msgpack.packb(self._message)
+        return self._msgpack
+
+
+class Connection:
+    """One accepted socket with its own send queue and writer task"""
+
+    def __init__(self, user_id: str, websocket: WebSocket, queue_size: int, protocol: Optional[str] = None):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.protocol = protocol
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.task: Optional[asyncio.Task] = None
+        self.connected_at = time.monotonic()
+        self.last_seen = self.connected_at
+        self.slot: Optional[int] = None
+        self.sent = 0
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    @property
+    def batching(self) -> bool:
+        return self.protocol is not None
+
+    def frame(self, batch: List[Payload]):
+        """Build one wire frame by concatenating already-encoded events"""
+        if self.protocol == SUBPROTOCOL_MSGPACK:
+            return msgpack_array_header(len(batch)) + b"".join(p.msgpack for p in batch)
+        if self.protocol == SUBPROTOCOL_JSON:
+            return "[" + ",".join(p.json for p in batch) + "]"
+        return batch[0].json
+
+    def decode(self, frame: dict) -> List[dict]:
+        """Client events carried by one received frame"""
+        if frame.get("bytes") is not None:
+            if msgpack is None:
+                raise ValueError("Binary frames are not supported")
+            events = msgpack.unpackb(frame["bytes"])
+        else:
+            events = json.loads(frame.get("text") or "null")
+        if isinstance(events, dict):
+            events = [events]
+        if not isinstance(events, list) or not all(isinstance(e, dict) for e in events):
+            raise ValueError("Frames must carry event objects")
+        return events
+
+    def offer(self, payload: str) -> bool:
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+
+class ConnectionManager:
+    def __init__(
+        self,
+        queue_size: int = 256,
+        send_timeout: float = 5.0,
+        max_batch: int = 64,
+        broker: Optional[Broker] = None,
+        heartbeat_interval: float = 30.0,
+        idle_timeout: float = 75.0,
+        tick: float = 1.0,
+        max_per_user: int = 5
+    ):
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.max_batch = max_batch
+        self.broker = broker
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.max_per_user = max_per_user
+        # Tags broker messages so this worker skips the ones it already delivered locally
+        self.worker_id = uuid.uuid4().hex
+        self.active_connections: Dict[str, Set[Connection]] = {}
+        self.connection_count = 0
+        # Timer wheel: one revolution is one heartbeat interval
+        self._slots: List[Set[Connection]] = [set() for _ in range(max(1, round(heartbeat_interval / tick)))]
+        self._cursor = 0
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._baseline_rss = 0
+        self.delivered = 0
+        self.frames = 0
+        self.offline = 0
+        self.remote = 0
+        self.evicted = 0
+        self.idle_evicted = 0
+        self.pings = 0
+        self.fanouts = 0
+        self.max_fanout_ms = 0.0
+        if broker:
+            broker.set_handler(self._on_broker_message)
+
+    async def start(self):
+        self._baseline_rss = rss_bytes()
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+
+    async def connect(self, user_id: str, websocket: WebSocket, protocol: Optional[str] = None) -> Connection:
+        await websocket.accept(subprotocol=protocol)
+        connection = Connection(user_id, websocket, self.queue_size, protocol)
+        connection.task = asyncio.create_task(self._writer(connection))
+        devices = self.active_connections.setdefault(user_id, set())
+        if len(devices) >= self.max_per_user:
+            # Too many devices: the oldest socket makes room
+            self._close(min(devices, key=lambda c: c.connected_at), IDLE_CLOSE_CODE)
+            devices = self.active_connections.setdefault(user_id, set())
+        devices.add(connection)
+        self.connection_count += 1
+        # Scheduled in the slot visited last, i.e. one full heartbeat interval away
+        connection.slot = (self._cursor - 1) % len(self._slots)
+        self._slots[connection.slot].add(connection)
+        if self.broker and len(devices) == 1:
+            self.broker.subscribe(user_channel(user_id))
+        logger.info(f"User {user_id} connected to WebSocket ({len(devices)} devices)")
+        return connection
+
+    def disconnect(self, user_id: str, connection: Connection):
+        devices = self.active_connections.get(user_id)
+        if not devices or connection not in devices:
+            return
+        devices.discard(connection)
+        self.connection_count -= 1
+        if connection.slot is not None:
+            self._slots[connection.slot].discard(connection)
+        if connection.task:
+            connection.task.cancel()
+        if not devices:
+            del self.active_connections[user_id]
+            if self.broker:
+                self.broker.unsubscribe(user_channel(user_id))
+        logger.info(f"User {user_id} disconnected from WebSocket")
+
+    async def send_personal_message(self, message: dict, user_id: str):
+        self.fanout(Payload(message), (user_id,))
+
+    async def broadcast(self, message: dict, user_ids: Iterable[str]):
+        self.fanout(Payload(message), user_ids)
+
+    def reply(self, connection: Connection, message: dict):
+        """Answer on the socket an event arrived on"""
+        self._deliver(connection, Payload(message))
+
+    def fanout(self, payload: Payload, user_ids: Iterable[str]) -> int:
+        """Queue a payload for every connected recipient without waiting on sockets"""
+        started = time.perf_counter()
+        queued = 0
+        for user_id in user_ids:
+            devices = self.active_connections.get(user_id)
+            if devices:
+                for connection in list(devices):
+                    queued += self._deliver(connection, payload)
+            if self.broker:
+                # The user's other devices may be held by other workers
+                self.broker.publish(user_channel(user_id), f"{self.worker_id} {payload.json}")
+                self.remote += 1
+            elif not devices:
+                self.offline += 1
+        self.fanouts += 1
+        self.max_fanout_ms = max(self.max_fanout_ms, 1000 * (time.perf_counter() - started))
+        return queued
+
+    def _deliver(self, connection: Connection, payload: Payload) -> bool:
+        if connection.offer(payload):
+            return True
+        logger.warning(f"Evicting slow WebSocket consumer {connection.user_id}")
+        self.evicted += 1
+        self._close(connection)
+        return False
+
+    def _on_broker_message(self, channel: str, message: str):
+        origin, _, payload = message.partition(" ")
+        if origin == self.worker_id:
+            return
+        devices = self.active_connections.get(channel.split(":", 1)[1])
+        if devices:
+            shared = Payload(json_text=payload)
+            for connection in list(devices):
+                self._deliver(connection, shared)
+
+    def _close(self, connection: Connection, code: int = SLOW_CONSUMER_CLOSE_CODE):
+        self.disconnect(connection.user_id, connection)
+        if connection.task:
+            connection.task.cancel()
+        asyncio.create_task(self._close_socket(connection.websocket, code))
+
+    async def _close_socket(self, websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                self._heartbeat_slot(self._slots[self._cursor])
+            except Exception as e:
+                logger.error(f"WebSocket heartbeat failed: {e}")
+            self._cursor = (self._cursor + 1) % len(self._slots)
+
+    def _heartbeat_slot(self, slot: Set[Connection]):
+        if not slot:
+            return
+        now = time.monotonic()
+        ping = Payload({"type": "ping", "ts": time.time()})
+        # Survivors stay in this slot and come round again one revolution later
+        for connection in list(slot):
+            if now - connection.last_seen > self.idle_timeout:
+                logger.info(f"Closing idle WebSocket for {connection.user_id}")
+                self.idle_evicted += 1
+                self._close(connection, IDLE_CLOSE_CODE)
+            elif self._deliver(connection, ping):
+                self.pings += 1
+
+    async def _writer(self, connection: Connection):
+        websocket = connection.websocket
+        while True:
+            batch = [await connection.queue.get()]
+            if connection.batching:
+                while len(batch) < self.max_batch and not connection.queue.empty():
+                    batch.append(connection.queue.get_nowait())
+            frame = connection.frame(batch)
+            send = websocket.send_bytes if isinstance(frame, bytes) else websocket.send_text
+            try:
+                await asyncio.wait_for(send(frame), self.send_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"WebSocket send to {connection.user_id} timed out")
+                self.evicted += 1
+                self._close(connection)
+                return
+            except Exception as e:
+                logger.error(f"Failed to send message to {connection.user_id}: {e}")
+                self._close(connection)
+                return
+            connection.sent += len(batch)
+            self.delivered += len(batch)
+            self.frames += 1
+
+    def stats(self) -> dict:
+        depths = [c.queue.qsize() for devices in self.active_connections.values() for c in devices]
+        rss = rss_bytes()
+        return {
+            "connections": self.connection_count,
+            "users": len(self.active_connections),
+            "fanouts": self.fanouts,
+            "delivered": self.delivered,
+            "frames": self.frames,
+            "offline_recipients": self.offline,
+            "remote_recipients": self.remote,
+            "evicted": self.evicted,
+            "idle_evicted": self.idle_evicted,
+            "pings": self.pings,
+            "max_queue_depth": max(depths, default=0),
+            "max_fanout_ms": round(self.max_fanout_ms, 3),
+            "rss_bytes": rss,
+            # Process growth since the heartbeat started, spread over live sockets
+            "bytes_per_connection": (
+                max(0, rss - self._baseline_rss) // self.connection_count if self.connection_count else 0
+            ),
+        }
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Counter Reconciliation Script for Tiny Café
+Recomputes user_counters from the source collections (backfill or drift repair)
+Safe to run against a live database: users whose counters change while it
+counts are recounted. For an exact backfill, stop the API first; a request
+caught between its write and its counter update can be counted twice.
+"""
+
+import asyncio
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+from dotenv import load_dotenv
+from pathlib import Path
+
+from counters import reconcile_all
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+async def reconcile():
+    # Connect to MongoDB
+    mongo_url = os.environ['MONGO_URL']
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[os.environ['DB_NAME']]
+    
+    print("=" * 60)
+    print("Reconciling user counters")
+    print("=" * 60)
+    
+    total = await reconcile_all(db)
+    print(f"\n   ✓ Reconciled counters for {total} users")
+    
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(reconcile())
@@ -0,0 +1,65 @@
+"""
+Badge and achievement rules, indexed by the metric they track
+Built once from the catalog definitions so thresholds live in one place
+"""
+
+from bisect import bisect_right
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from catalog import ACHIEVEMENTS, BADGES
+
+METRICS = ("total_minutes", "streak", "level", "purchases", "friends")
+
+
+class Rule(NamedTuple):
+    rule_id: str
+    kind: str  # "badge" or "achievement"
+    metric: str
+    threshold: int
+    reward: int = 0
+
+
+class RuleRegistry:
+    """Rules grouped by (kind, metric) and sorted by threshold"""
+
+    def __init__(self, rules: List[Rule]):
+        self._by_id: Dict[Tuple[str, str], Rule] = {}
+        self._by_metric: Dict[Tuple[str, str], List[Rule]] = {}
+        for rule in rules:
+            if rule.metric not in METRICS:
+                raise ValueError(f"Unknown metric {rule.metric} for rule {rule.rule_id}")
+            self._by_id[(rule.kind, rule.rule_id)] = rule
+            self._by_metric.setdefault((rule.kind, rule.metric), []).append(rule)
+        self._thresholds: Dict[Tuple[str, str], List[int]] = {}
+        for key, group in self._by_metric.items():
+            group.sort(key=lambda r: r.threshold)
+            self._thresholds[key] = [r.threshold for r in group]
+
+    def get(self, kind: str, rule_id: str) -> Optional[Rule]:
+        return self._by_id.get((kind, rule_id))
+
+    def crossed(self, kind: str, metric: str, old: int, new: int) -> List[Rule]:
+        """Rules whose threshold lies in (old, new], i.e. newly reached by this change"""
+        thresholds = self._thresholds.get((kind, metric))
+        if not thresholds or new <= old:
+            return []
+        lo = bisect_right(thresholds, old)
+        hi = bisect_right(thresholds, new)
+        return self._by_metric[(kind, metric)][lo:hi]
+
+
+registry = RuleRegistry(
+    [Rule(b["badge_id"], "badge", b["requirement_type"], b["requirement_value"]) for b in BADGES]
+    + [Rule(a["id"], "achievement", a["type"], a["target"], a["reward"]) for a in ACHIEVEMENTS]
+)
+
+
+def user_metrics(user, counters: Dict[str, int]) -> Dict[str, int]:
+    """Current value of every metric from a user snapshot and its counters document"""
+    return {
+        "total_minutes": user.total_focus_minutes,
+        "streak": user.streak_days,
+        "level": user.level,
+        "purchases": counters["purchases"],
+        "friends": counters["friends"],
+    }
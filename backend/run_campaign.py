@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Push Campaign Script for Tiny Café
+Usage: python run_campaign.py <streak_at_risk|daily_quest_ready>
+       python run_campaign.py --resume <campaign_id>
+"""
+
+import asyncio
+import sys
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+from dotenv import load_dotenv
+from pathlib import Path
+
+from push_campaign import CAMPAIGNS, CampaignRunner
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+async def run_campaign(args):
+    # Connect to MongoDB
+    mongo_url = os.environ['MONGO_URL']
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[os.environ['DB_NAME']]
+    
+    runner = CampaignRunner(
+        db,
+        os.environ.get('VAPID_PRIVATE_KEY', ''),
+        {"sub": os.environ.get('VAPID_SUBJECT', 'mailto:support@tinycafe.app')},
+        processes=int(os.environ.get('CAMPAIGN_PROCESSES', str(os.cpu_count() or 1))),
+        batch_size=int(os.environ.get('CAMPAIGN_BATCH_SIZE', '1000')),
+        origin_rate=float(os.environ.get('CAMPAIGN_ORIGIN_RATE', '500'))
+    )
+    
+    if args[0] == "--resume":
+        campaign_id = args[1]
+    else:
+        campaign_id = await runner.create(args[0])
+    
+    print("=" * 60)
+    print(f"Running push campaign {campaign_id}")
+    print("=" * 60)
+    
+    report = await runner.run(campaign_id)
+    print(f"\n   ✓ {report['kind']}: scanned {report['scanned']} subscriptions")
+    print(f"   ✓ Sent {report['sent']}, failed {report['failed']}, pruned {report['pruned']}")
+    print(f"   ✓ {report['sends_per_second']} sends/sec ({report['sends_per_second_per_core']} per core)")
+    print(f"   - By status: {report['by_status']}")
+    
+    client.close()
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args or (args[0] == "--resume" and len(args) < 2) or (args[0] != "--resume" and args[0] not in CAMPAIGNS):
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(run_campaign(args))
@@ -3,6 +3,8 @@ from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
@@ -10,7 +12,15 @@ from pydantic import BaseModel, Field
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
-import httpx
+
+import counters
+from cache import TTLCache
+from catalog import Catalog, DAILY_QUEST_TEMPLATES, LANGUAGES, QUEST_TEMPLATES, localize
+from events import EventBus, FocusCompleted, FriendAdded, ItemPurchased, TodoCompleted
+from http_clients import create_upstream
+from leaderboard import Leaderboard, WINDOWS as LEADERBOARD_WINDOWS
+from rate_limit import create_limiter
+from rules import registry as rules, user_metrics
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -27,6 +37,12 @@ api_router = APIRouter(prefix="/api")
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+catalog = Catalog(db)
+events = EventBus(maxsize=int(os.environ.get('EVENT_QUEUE_SIZE', '10000')))
+leaderboard = Leaderboard(db, resync_seconds=float(os.environ.get('LEADERBOARD_RESYNC_SECONDS', '300')))
+limiter = create_limiter(os.environ.get('RATE_LIMIT_URL', ''))
+auth_provider = create_upstream("Auth provider", "AUTH_PROVIDER", "https://demobackend.emergentagent.com")
+
 # ==================== MODELS ====================
 
 class User(BaseModel):
@@ -124,40 +140,85 @@ class Badge(BaseModel):
 
 # ==================== AUTH HELPERS ====================
 
-async def get_current_user(request: Request) -> User:
-    """Get current user from session token (cookie or header)"""
+# Resolved sessions and user snapshots, shared by every authenticated request.
+# Writes that change a user must call invalidate_user(); the TTL bounds how long
+# another worker's write can go unnoticed here.
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', '30'))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', '50000'))
+
+session_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)  # token -> (user_id, expires_at)
+session_index = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)  # user_id -> cached tokens
+user_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)     # user_id -> User
+
+def get_session_token(request: Request) -> Optional[str]:
+    """Read the session token from the cookie or the Authorization header"""
     session_token = request.cookies.get("session_token")
     if not session_token:
         auth_header = request.headers.get("Authorization")
         if auth_header and auth_header.startswith("Bearer "):
             session_token = auth_header.split(" ")[1]
+    return session_token
+
+def invalidate_user(user_id: str):
+    """Drop the cached user snapshot after a write that changes the user"""
+    user_cache.pop(user_id)
+
+def invalidate_sessions(user_id: str):
+    """Drop every cached session token that resolves to user_id"""
+    for token in session_index.pop(user_id, None) or ():
+        session_cache.pop(token)
+
+async def get_current_user(request: Request) -> User:
+    """Get current user from session token (cookie or header)"""
+    # Memoized per request so internal handler calls don't authenticate twice
+    current_user = getattr(request.state, "current_user", None)
+    if current_user is not None:
+        return current_user
     
+    session_token = get_session_token(request)
     if not session_token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    session_doc = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
-    if not session_doc:
-        raise HTTPException(status_code=401, detail="Invalid session")
+    session = session_cache.get(session_token)
+    if session is None:
+        session_doc = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
+        if not session_doc:
+            raise HTTPException(status_code=401, detail="Invalid session")
+        
+        expires_at = session_doc["expires_at"]
+        if isinstance(expires_at, str):
+            expires_at = datetime.fromisoformat(expires_at)
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        
+        session = (session_doc["user_id"], expires_at)
+        session_cache.set(session_token, session)
+        tokens = session_index.get(session_doc["user_id"]) or set()
+        tokens.add(session_token)
+        session_index.set(session_doc["user_id"], tokens)
     
-    expires_at = session_doc["expires_at"]
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    user_id, expires_at = session
     if expires_at < datetime.now(timezone.utc):
+        session_cache.pop(session_token)
         raise HTTPException(status_code=401, detail="Session expired")
     
-    user_doc = await db.users.find_one({"user_id": session_doc["user_id"]}, {"_id": 0})
-    if not user_doc:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    # Convert datetime to string if needed
-    if user_doc.get("created_at") and not isinstance(user_doc["created_at"], str):
-        user_doc["created_at"] = user_doc["created_at"].isoformat()
-    if user_doc.get("last_study_date") and not isinstance(user_doc["last_study_date"], str):
-        user_doc["last_study_date"] = user_doc["last_study_date"].isoformat()
+    user = user_cache.get(user_id)
+    if user is None:
+        user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+        if not user_doc:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        # Convert datetime to string if needed
+        if user_doc.get("created_at") and not isinstance(user_doc["created_at"], str):
+            user_doc["created_at"] = user_doc["created_at"].isoformat()
+        if user_doc.get("last_study_date") and not isinstance(user_doc["last_study_date"], str):
+            user_doc["last_study_date"] = user_doc["last_study_date"].isoformat()
+        
+        user = User(**user_doc)
+        user_cache.set(user_id, user)
     
-    return User(**user_doc)
+    request.state.current_user = user
+    return user
 
 # ==================== AUTH ENDPOINTS ====================
 
@@ -170,31 +231,20 @@ async def create_session(request: Request, response: Response):
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id required")
     
-    async with httpx.AsyncClient() as client_http:
-        resp = await client_http.get(
-            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-            headers={"X-Session-ID": session_id}
-        )
-        if resp.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid session_id")
-        
-        user_data = resp.json()
+    resp = await auth_provider.get(
+        "/auth/v1/env/oauth/session-data",
+        headers={"X-Session-ID": session_id}
+    )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=401, detail="Invalid session_id")
     
-    user_id = f"user_{uuid.uuid4().hex[:12]}"
-    existing_user = await db.users.find_one({"email": user_data["email"]}, {"_id": 0})
+    user_data = resp.json()
     
-    if existing_user:
-        user_id = existing_user["user_id"]
-        await db.users.update_one(
-            {"user_id": user_id},
-            {"$set": {"name": user_data["name"], "picture": user_data.get("picture")}}
-        )
-    else:
-        new_user = {
-            "user_id": user_id,
-            "email": user_data["email"],
-            "name": user_data["name"],
-            "picture": user_data.get("picture"),
+    # One round trip finds or creates the user; defaults only apply on insert
+    user_update = {
+        "$set": {"name": user_data["name"], "picture": user_data.get("picture")},
+        "$setOnInsert": {
+            "user_id": f"user_{uuid.uuid4().hex[:12]}",
             "credits": 50,
             "level": 1,
             "xp": 0,
@@ -206,18 +256,42 @@ async def create_session(request: Request, response: Response):
             "language": "tr",
             "created_at": datetime.now(timezone.utc).isoformat()
         }
-        await db.users.insert_one(new_user)
+    }
+    try:
+        user_doc = await db.users.find_one_and_update(
+            {"email": user_data["email"]},
+            user_update,
+            projection={"_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # A concurrent first login for the same email inserted it; this now matches
+        user_doc = await db.users.find_one_and_update(
+            {"email": user_data["email"]},
+            user_update,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    user_id = user_doc["user_id"]
+    invalidate_user(user_id)
     
     session_token = user_data.get("session_token", f"session_{uuid.uuid4().hex}")
     expires_at = datetime.now(timezone.utc) + timedelta(days=7)
     
-    await db.user_sessions.delete_many({"user_id": user_id})
-    await db.user_sessions.insert_one({
+    # The previous session is swapped out in the same write (user_id is unique)
+    session_doc = {
         "user_id": user_id,
         "session_token": session_token,
         "expires_at": expires_at.isoformat(),
         "created_at": datetime.now(timezone.utc).isoformat()
-    })
+    }
+    try:
+        await db.user_sessions.replace_one({"user_id": user_id}, session_doc, upsert=True)
+    except DuplicateKeyError:
+        # A concurrent login for the same user inserted first; this now replaces it
+        await db.user_sessions.replace_one({"user_id": user_id}, session_doc, upsert=True)
+    invalidate_sessions(user_id)
     
     response.set_cookie(
         key="session_token",
@@ -229,7 +303,6 @@ async def create_session(request: Request, response: Response):
         max_age=7 * 24 * 60 * 60
     )
     
-    user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     return user_doc
 
 @api_router.get("/auth/me")
@@ -244,6 +317,9 @@ async def logout(request: Request, response: Response):
     session_token = request.cookies.get("session_token")
     if session_token:
         await db.user_sessions.delete_many({"session_token": session_token})
+        session = session_cache.pop(session_token)
+        if session:
+            invalidate_user(session[0])
     
     response.delete_cookie(key="session_token", path="/", samesite="none", secure=True)
     return {"message": "Logged out"}
@@ -273,15 +349,23 @@ async def create_todo(todo: TodoCreate, request: Request):
 async def update_todo(todo_id: str, update: TodoUpdate, request: Request):
     user = await get_current_user(request)
     update_data = {k: v for k, v in update.model_dump().items() if v is not None}
-    if update_data:
-        await db.todos.update_one(
-            {"todo_id": todo_id, "user_id": user.user_id},
-            {"$set": update_data}
-        )
-    todo_doc = await db.todos.find_one({"todo_id": todo_id, "user_id": user.user_id}, {"_id": 0})
-    if not todo_doc:
+    if not update_data:
+        todo_doc = await db.todos.find_one({"todo_id": todo_id, "user_id": user.user_id}, {"_id": 0})
+        if not todo_doc:
+            raise HTTPException(status_code=404, detail="Todo not found")
+        return Todo(**todo_doc)
+    
+    # The pre-image tells us whether this update is what completed the todo
+    previous = await db.todos.find_one_and_update(
+        {"todo_id": todo_id, "user_id": user.user_id},
+        {"$set": update_data},
+        projection={"_id": 0}
+    )
+    if not previous:
         raise HTTPException(status_code=404, detail="Todo not found")
-    return Todo(**todo_doc)
+    if update_data.get("completed") and not previous.get("completed"):
+        await events.publish(TodoCompleted(user_id=user.user_id, todo_id=todo_id))
+    return Todo(**{**previous, **update_data})
 
 @api_router.delete("/todos/{todo_id}")
 async def delete_todo(todo_id: str, request: Request):
@@ -306,115 +390,137 @@ async def start_focus_session(data: FocusSessionStart, request: Request):
     await db.focus_sessions.insert_one(session_doc)
     return {"session_id": session_doc["session_id"], "started_at": session_doc["started_at"]}
 
+def focus_completion_update(minutes: int, credits_earned: int, now: datetime) -> list:
+    """Pipeline update that credits a finished session and recomputes streak and level server-side"""
+    today = now.date().isoformat()
+    yesterday = (now.date() - timedelta(days=1)).isoformat()
+    last_study = {"$cond": [
+        {"$eq": [{"$type": "$last_study_date"}, "date"]},
+        {"$dateToString": {"format": "%Y-%m-%d", "date": "$last_study_date"}},
+        {"$substrCP": [{"$ifNull": ["$last_study_date", ""]}, 0, 10]}
+    ]}
+    level = {"$ifNull": ["$level", 1]}
+    # Level L needs L * 1000 XP, so the levels gained from x XP is the largest k with
+    # 1000 * (k*L + k*(k-1)/2) <= x: the positive root of that quadratic, floored.
+    levels_gained = {"$floor": {"$divide": [
+        {"$subtract": [
+            {"$sqrt": {"$add": [
+                {"$pow": [{"$subtract": [{"$multiply": [2, level]}, 1]}, 2]},
+                {"$divide": [{"$multiply": ["$xp", 8]}, 1000]}
+            ]}},
+            {"$subtract": [{"$multiply": [2, level]}, 1]}
+        ]},
+        2
+    ]}}
+    return [
+        {"$set": {
+            "credits": {"$add": [{"$ifNull": ["$credits", 0]}, credits_earned]},
+            "total_focus_minutes": {"$add": [{"$ifNull": ["$total_focus_minutes", 0]}, minutes]},
+            # XP calculation: 10 XP per minute
+            "xp": {"$add": [{"$ifNull": ["$xp", 0]}, minutes * 10]},
+            "streak_days": {"$let": {"vars": {"last": last_study}, "in": {"$switch": {
+                "branches": [
+                    {"case": {"$gte": ["$$last", today]}, "then": {"$ifNull": ["$streak_days", 0]}},
+                    {"case": {"$eq": ["$$last", yesterday]}, "then": {"$add": [{"$ifNull": ["$streak_days", 0]}, 1]}},
+                ],
+                "default": 1
+            }}}},
+            "last_study_date": today,
+            # Orders completions per user so a leaderboard snapshot knows which it includes
+            "focus_seq": {"$add": [{"$ifNull": ["$focus_seq", 0]}, 1]},
+        }},
+        {"$set": {"_levels_gained": {"$toInt": levels_gained}}},
+        {"$set": {
+            "level": {"$add": [level, "$_levels_gained"]},
+            "xp": {"$toInt": {"$subtract": ["$xp", {"$multiply": [1000, {"$add": [
+                {"$multiply": ["$_levels_gained", level]},
+                {"$divide": [{"$multiply": ["$_levels_gained", {"$subtract": ["$_levels_gained", 1]}]}, 2]}
+            ]}]}]}},
+        }},
+        {"$unset": "_levels_gained"},
+    ]
+
 @api_router.post("/focus/end/{session_id}")
 async def end_focus_session(session_id: str, data: FocusSessionEnd, request: Request):
     user = await get_current_user(request)
     
-    session_doc = await db.focus_sessions.find_one(
-        {"session_id": session_id, "user_id": user.user_id},
-        {"_id": 0}
-    )
-    if not session_doc:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
     # Calculate credits: 1 credit per minute, doubled if ad watched
     base_credits = data.actual_minutes
     multiplier = 2 if data.double_credits else 1
     credits_earned = base_credits * multiplier
+    now = datetime.now(timezone.utc)
     
-    # Update session
-    await db.focus_sessions.update_one(
-        {"session_id": session_id},
+    # Only an active session can be completed, so a session is never credited twice
+    session_doc = await db.focus_sessions.find_one_and_update(
+        {"session_id": session_id, "user_id": user.user_id, "status": "active"},
         {"$set": {
-            "ended_at": datetime.now(timezone.utc).isoformat(),
+            "ended_at": now.isoformat(),
             "actual_minutes": data.actual_minutes,
             "credits_earned": credits_earned,
             "double_credits": data.double_credits,
             "status": "completed"
-        }}
+        }},
+        projection={"_id": 0}
     )
+    if not session_doc:
+        if await db.focus_sessions.count_documents({"session_id": session_id, "user_id": user.user_id}, limit=1):
+            raise HTTPException(status_code=409, detail="Session already ended")
+        raise HTTPException(status_code=404, detail="Session not found")
     
-    # Update user stats
-    today = datetime.now(timezone.utc).date().isoformat()
-    last_study = user.last_study_date
-    
-    new_streak = user.streak_days
-    if last_study:
-        last_date = datetime.fromisoformat(last_study).date()
-        today_date = datetime.now(timezone.utc).date()
-        if (today_date - last_date).days == 1:
-            new_streak += 1
-        elif (today_date - last_date).days > 1:
-            new_streak = 1
-    else:
-        new_streak = 1
-    
-    # XP calculation: 10 XP per minute
-    xp_earned = data.actual_minutes * 10
-    new_xp = user.xp + xp_earned
-    new_level = user.level
-    
-    # Level up every 1000 XP
-    while new_xp >= new_level * 1000:
-        new_xp -= new_level * 1000
-        new_level += 1
-    
-    await db.users.update_one(
+    # Update user stats atomically; concurrent completions each add their own share
+    user_doc = await db.users.find_one_and_update(
         {"user_id": user.user_id},
-        {"$set": {
-            "credits": user.credits + credits_earned,
-            "total_focus_minutes": user.total_focus_minutes + data.actual_minutes,
-            "streak_days": new_streak,
-            "last_study_date": today,
-            "xp": new_xp,
-            "level": new_level
-        }}
+        focus_completion_update(data.actual_minutes, credits_earned, now),
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
-    
-    # Check for new badges
-    await check_and_award_badges(user.user_id)
+    if not user_doc:
+        raise HTTPException(status_code=404, detail="User not found")
+    invalidate_user(user.user_id)
+    leaderboard.record_minutes(user.user_id, data.actual_minutes, now, user_doc["focus_seq"])
+    # Counters move with the source write so a recount never sees one without the other
+    await counters.increment(db, user.user_id, focus_sessions=1)
+    
+    # Badges and quests are handled by event subscribers after the response
+    await events.publish(FocusCompleted(
+        user_id=user.user_id,
+        session_id=session_id,
+        minutes=data.actual_minutes,
+        credits_earned=credits_earned,
+        total_focus_minutes=user_doc["total_focus_minutes"],
+        streak_days=user_doc["streak_days"],
+        level=user_doc["level"],
+        previous_level=min(user.level, user_doc["level"])
+    ))
     
     return {
         "credits_earned": credits_earned,
-        "xp_earned": xp_earned,
-        "new_level": new_level,
-        "streak_days": new_streak
+        "xp_earned": data.actual_minutes * 10,
+        "new_level": user_doc["level"],
+        "streak_days": user_doc["streak_days"]
     }
 
-async def check_and_award_badges(user_id: str):
-    user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-    if not user_doc:
-        return
-    
-    existing_badges = await db.user_badges.find({"user_id": user_id}, {"_id": 0}).to_list(100)
-    existing_badge_ids = [b["badge_id"] for b in existing_badges]
-    
-    badges_to_check = [
-        {"badge_id": "first_focus", "requirement_type": "total_minutes", "requirement_value": 1},
-        {"badge_id": "hour_hero", "requirement_type": "total_minutes", "requirement_value": 60},
-        {"badge_id": "streak_starter", "requirement_type": "streak", "requirement_value": 3},
-        {"badge_id": "streak_master", "requirement_type": "streak", "requirement_value": 7},
-        {"badge_id": "level_5", "requirement_type": "level", "requirement_value": 5},
+async def award_badges(user_id: str, changes: dict) -> List[str]:
+    """Award badges whose thresholds were crossed; changes maps metric -> (old, new)"""
+    earned_at = datetime.now(timezone.utc).isoformat()
+    awards = [
+        {"user_id": user_id, "badge_id": rule.rule_id, "earned_at": earned_at}
+        for metric, (old, new) in changes.items()
+        for rule in rules.crossed("badge", metric, old, new)
     ]
-    
-    for badge in badges_to_check:
-        if badge["badge_id"] in existing_badge_ids:
-            continue
-        
-        earned = False
-        if badge["requirement_type"] == "total_minutes":
-            earned = user_doc.get("total_focus_minutes", 0) >= badge["requirement_value"]
-        elif badge["requirement_type"] == "streak":
-            earned = user_doc.get("streak_days", 0) >= badge["requirement_value"]
-        elif badge["requirement_type"] == "level":
-            earned = user_doc.get("level", 1) >= badge["requirement_value"]
-        
-        if earned:
-            await db.user_badges.insert_one({
-                "user_id": user_id,
-                "badge_id": badge["badge_id"],
-                "earned_at": datetime.now(timezone.utc).isoformat()
-            })
+    if not awards:
+        return []
+    try:
+        result = await db.user_badges.insert_many(awards, ordered=False)
+        inserted = len(result.inserted_ids)
+    except BulkWriteError as e:
+        # (user_id, badge_id) is unique; re-awarding an owned badge is a no-op
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        inserted = e.details.get("nInserted", 0)
+    if inserted:
+        await counters.increment(db, user_id, badges=inserted)
+    return [a["badge_id"] for a in awards]
 
 @api_router.get("/focus/history")
 async def get_focus_history(request: Request):
@@ -427,51 +533,32 @@ async def get_focus_history(request: Request):
 
 # ==================== SHOP ENDPOINTS ====================
 
+def validate_language(lang: Optional[str]):
+    if lang is not None and lang not in LANGUAGES:
+        raise HTTPException(status_code=400, detail=f"lang must be one of {', '.join(LANGUAGES)}")
+
+def catalog_response(request: Request, rendered) -> Response:
+    """Serve a prerendered catalog body, or 304 when the client's copy is current"""
+    body, etag = rendered
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @api_router.get("/shop/items", response_model=List[ShopItem])
-async def get_shop_items(request: Request):
+async def get_shop_items(request: Request, lang: Optional[str] = None):
     user = await get_current_user(request)
-    items = await db.shop_items.find({}, {"_id": 0}).to_list(100)
-    
-    if not items:
-        default_items = [
-            # Hot Drinks
-            {"item_id": "latte", "name_tr": "Sıcak Latte", "name_en": "Hot Latte", "description_tr": "Kremsi ve sıcacık", "description_en": "Creamy and warm", "price": 30, "category": "drinks", "image_url": "/assets/drinks/latte.jpg", "locked": False, "unlock_level": 1},
-            {"item_id": "cappuccino", "name_tr": "Cappuccino", "name_en": "Cappuccino", "description_tr": "Köpüklü kahve keyfi", "description_en": "Foamy coffee delight", "price": 35, "category": "drinks", "image_url": "/assets/drinks/cappuccino.jpg", "locked": False, "unlock_level": 1},
-            {"item_id": "mocha", "name_tr": "Mocha", "name_en": "Mocha", "description_tr": "Çikolatalı keyif", "description_en": "Chocolate delight", "price": 40, "category": "drinks", "image_url": "/assets/drinks/mocha.jpg", "locked": False, "unlock_level": 1},
-            {"item_id": "matcha", "name_tr": "Matcha Latte", "name_en": "Matcha Latte", "description_tr": "Yeşil çay enerjisi", "description_en": "Green tea energy", "price": 35, "category": "drinks", "image_url": "/assets/drinks/matcha.jpg", "locked": True, "unlock_level": 3},
-            {"item_id": "hot_chocolate", "name_tr": "Sıcak Çikolata", "name_en": "Hot Chocolate", "description_tr": "Tatlı sıcaklık", "description_en": "Sweet warmth", "price": 30, "category": "drinks", "image_url": "/assets/drinks/hot-chocolate.jpg", "locked": False, "unlock_level": 1},
-            {"item_id": "chai_latte", "name_tr": "Chai Latte", "name_en": "Chai Latte", "description_tr": "Baharatlı sıcaklık", "description_en": "Spiced warmth", "price": 35, "category": "drinks", "image_url": "/assets/drinks/chai-latte.jpg", "locked": True, "unlock_level": 4},
-            {"item_id": "espresso", "name_tr": "Espresso", "name_en": "Espresso", "description_tr": "Yoğun enerji", "description_en": "Intense energy", "price": 25, "category": "drinks", "image_url": "/assets/drinks/espresso.jpg", "locked": False, "unlock_level": 2},
-            {"item_id": "caramel_latte", "name_tr": "Karamelli Latte", "name_en": "Caramel Latte", "description_tr": "Tatlı karamel tadı", "description_en": "Sweet caramel taste", "price": 40, "category": "drinks", "image_url": "/assets/drinks/caramel-latte.jpg", "locked": True, "unlock_level": 5},
-            # Cold Drinks
-            {"item_id": "strawberry_smoothie", "name_tr": "Çilekli Smoothie", "name_en": "Strawberry Smoothie", "description_tr": "Ferahlatıcı meyve", "description_en": "Refreshing fruit", "price": 45, "category": "drinks", "image_url": "/assets/drinks/strawberry-smoothie.jpg", "locked": True, "unlock_level": 4},
-            {"item_id": "lemonade", "name_tr": "Limonata", "name_en": "Lemonade", "description_tr": "Serinletici", "description_en": "Cooling refreshment", "price": 25, "category": "drinks", "image_url": "/assets/drinks/lemonade.jpg", "locked": False, "unlock_level": 2},
-            # Desserts
-            {"item_id": "croissant", "name_tr": "Kruvasan", "name_en": "Croissant", "description_tr": "Tereyağlı lezzet", "description_en": "Buttery delight", "price": 30, "category": "treats", "image_url": "/assets/desserts/croissant.jpg", "locked": False, "unlock_level": 1},
-            {"item_id": "blueberry_donut", "name_tr": "Yaban Mersinli Donut", "name_en": "Blueberry Donut", "description_tr": "Meyveli tatlı", "description_en": "Fruity sweetness", "price": 25, "category": "treats", "image_url": "/assets/desserts/blueberry-donut.jpg", "locked": False, "unlock_level": 1},
-            {"item_id": "strawberry_donut", "name_tr": "Çilekli Donut", "name_en": "Strawberry Donut", "description_tr": "Tatlı bir mola", "description_en": "A sweet break", "price": 25, "category": "treats", "image_url": "/assets/desserts/strawberry-donut.jpg", "locked": False, "unlock_level": 1},
-            {"item_id": "cupcake", "name_tr": "Cupcake", "name_en": "Cupcake", "description_tr": "Minik mutluluk", "description_en": "Tiny happiness", "price": 30, "category": "treats", "image_url": "/assets/desserts/cupcake.jpg", "locked": False, "unlock_level": 1},
-            {"item_id": "macaron", "name_tr": "Makaron", "name_en": "Macaron", "description_tr": "Fransız şıklığı", "description_en": "French elegance", "price": 35, "category": "treats", "image_url": "/assets/desserts/macaron.jpg", "locked": True, "unlock_level": 3},
-            {"item_id": "chocolate_cake", "name_tr": "Çikolatalı Pasta", "name_en": "Chocolate Cake", "description_tr": "Çikolata cenneti", "description_en": "Chocolate heaven", "price": 50, "category": "treats", "image_url": "/assets/desserts/chocolate-cake.jpg", "locked": True, "unlock_level": 5},
-            {"item_id": "cheesecake", "name_tr": "Cheesecake Brownie", "name_en": "Cheesecake Brownie", "description_tr": "Kremsi lezzet", "description_en": "Creamy delight", "price": 45, "category": "treats", "image_url": "/assets/desserts/cheesecake-brownie.jpg", "locked": True, "unlock_level": 4},
-            {"item_id": "ice_cream", "name_tr": "Dondurma", "name_en": "Ice Cream", "description_tr": "Serinletici tatlı", "description_en": "Cool sweetness", "price": 30, "category": "treats", "image_url": "/assets/desserts/ice-cream.jpg", "locked": False, "unlock_level": 2},
-            {"item_id": "profiterole", "name_tr": "Profiterol", "name_en": "Profiterole", "description_tr": "Çikolatalı şölen", "description_en": "Chocolate feast", "price": 55, "category": "treats", "image_url": "/assets/desserts/profiterole.jpg", "locked": True, "unlock_level": 6},
-            {"item_id": "creme_brulee", "name_tr": "Krem Brûlée", "name_en": "Crème Brûlée", "description_tr": "Karamelize lezzet", "description_en": "Caramelized delight", "price": 50, "category": "treats", "image_url": "/assets/desserts/Creme-Brulee.jpg", "locked": True, "unlock_level": 5},
-        ]
-        for item in default_items:
-            await db.shop_items.insert_one(item)
-        items = default_items
-    
-    for item in items:
-        item["locked"] = item.get("unlock_level", 1) > user.level
-    
-    return items
+    validate_language(lang)
+    await catalog.ensure_loaded()
+    return catalog_response(request, catalog.render("shop", user.level, lang))
 
 @api_router.post("/shop/purchase")
 async def purchase_item(purchase: Purchase, request: Request):
     user = await get_current_user(request)
     
-    item = await db.shop_items.find_one({"item_id": purchase.item_id}, {"_id": 0})
+    await catalog.ensure_loaded()
+    item = catalog.shop_items.get(purchase.item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
     
@@ -481,13 +568,17 @@ async def purchase_item(purchase: Purchase, request: Request):
     if user.credits < item["price"]:
         raise HTTPException(status_code=400, detail="Not enough credits")
     
-    await db.users.update_one(
-        {"user_id": user.user_id},
+    # Guard on credits so a stale snapshot can't overspend
+    result = await db.users.update_one(
+        {"user_id": user.user_id, "credits": {"$gte": item["price"]}},
         {
             "$inc": {"credits": -item["price"]},
             "$push": {"owned_items": purchase.item_id}
         }
     )
+    invalidate_user(user.user_id)
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Not enough credits")
     
     await db.purchases.insert_one({
         "purchase_id": f"purchase_{uuid.uuid4().hex[:12]}",
@@ -497,6 +588,12 @@ async def purchase_item(purchase: Purchase, request: Request):
         "purchased_at": datetime.now(timezone.utc).isoformat()
     })
     
+    purchases = (await counters.increment(db, user.user_id, purchases=1))["purchases"]
+    
+    await events.publish(ItemPurchased(
+        user_id=user.user_id, item_id=purchase.item_id, price=item["price"], purchases=purchases
+    ))
+    
     return {"message": "Purchase successful", "item": item}
 
 @api_router.get("/shop/purchases")
@@ -507,13 +604,21 @@ async def get_purchases(request: Request):
 
 # ==================== COMMUNITY ENDPOINTS ====================
 
+def validate_leaderboard_window(window: str):
+    if window not in LEADERBOARD_WINDOWS:
+        raise HTTPException(status_code=400, detail=f"window must be one of {', '.join(LEADERBOARD_WINDOWS)}")
+
 @api_router.get("/community/leaderboard")
-async def get_leaderboard(request: Request):
-    users = await db.users.find(
-        {},
-        {"_id": 0, "user_id": 1, "name": 1, "picture": 1, "level": 1, "total_focus_minutes": 1, "streak_days": 1}
-    ).sort("total_focus_minutes", -1).to_list(20)
-    return users
+async def get_leaderboard(request: Request, window: str = "all", limit: int = 20):
+    validate_leaderboard_window(window)
+    limit = max(1, min(limit, 100))
+    return await leaderboard.top(window, limit)
+
+@api_router.get("/community/leaderboard/me")
+async def get_my_rank(request: Request, window: str = "all"):
+    user = await get_current_user(request)
+    validate_leaderboard_window(window)
+    return await leaderboard.rank_of(window, user.user_id)
 
 @api_router.get("/community/friends")
 async def get_friends(request: Request):
@@ -540,6 +645,7 @@ async def get_friends(request: Request):
 @api_router.post("/community/invite")
 async def invite_friend(data: FriendRequest, request: Request):
     user = await get_current_user(request)
+    await limiter.enforce("community_invite", user.user_id)
     
     target = await db.users.find_one({"email": data.target_email}, {"_id": 0})
     if not target:
@@ -570,48 +676,34 @@ async def invite_friend(data: FriendRequest, request: Request):
         {"user_id": user.user_id},
         {"$inc": {"credits": 25}}
     )
+    invalidate_user(user.user_id)
+    
+    friends = [
+        (await counters.increment(db, user_id, friends=1))["friends"]
+        for user_id in (user.user_id, target["user_id"])
+    ]
+    
+    await events.publish(FriendAdded(
+        user_id=user.user_id, friend_id=target["user_id"], friends=friends[0], friend_friends=friends[1]
+    ))
     
     return {"message": "Friend added! +25 bonus credits", "bonus_credits": 25}
 
 # ==================== MUSIC ENDPOINTS ====================
 
 @api_router.get("/music/tracks")
-async def get_music_tracks(request: Request):
+async def get_music_tracks(request: Request, lang: Optional[str] = None):
     user = await get_current_user(request)
-    tracks = await db.music_tracks.find({}, {"_id": 0}).to_list(100)
-    
-    if not tracks:
-        default_tracks = [
-            {"track_id": "lofi_chill", "name": "Cozy Cafe Vibes", "artist": "LoFi Dreams", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-1.mp3", "category": "lofi", "locked": False, "unlock_level": 1},
-            {"track_id": "ambient_rain", "name": "Rainy Day Study", "artist": "Ambient Sounds", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-2.mp3", "category": "ambient", "locked": False, "unlock_level": 1},
-            {"track_id": "piano_soft", "name": "Soft Piano Dreams", "artist": "Classical Focus", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-3.mp3", "category": "classical", "locked": False, "unlock_level": 1},
-            {"track_id": "nature_forest", "name": "Forest Whispers", "artist": "Nature Sounds", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-4.mp3", "category": "nature", "locked": True, "unlock_level": 3},
-            {"track_id": "jazz_smooth", "name": "Midnight Jazz", "artist": "Jazz Cafe", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-5.mp3", "category": "jazz", "locked": True, "unlock_level": 5},
-            {"track_id": "electronic_focus", "name": "Deep Focus Electronic", "artist": "Focus Beats", "url": "https://www.soundhelix.com/examples/mp3/SoundHelix-Song-6.mp3", "category": "electronic", "locked": True, "unlock_level": 7},
-        ]
-        for track in default_tracks:
-            await db.music_tracks.insert_one(track)
-        tracks = default_tracks
-    
-    for track in tracks:
-        track["locked"] = track.get("unlock_level", 1) > user.level
-    
-    return tracks
+    validate_language(lang)
+    await catalog.ensure_loaded()
+    return catalog_response(request, catalog.render("music", user.level, lang))
 
 # ==================== BADGES ENDPOINTS ====================
 
 @api_router.get("/badges")
-async def get_badges(request: Request):
-    badges = [
-        {"badge_id": "first_focus", "name_tr": "İlk Adım", "name_en": "First Step", "description_tr": "İlk odaklanma seansını tamamla", "description_en": "Complete your first focus session", "icon": "🌟", "requirement_type": "total_minutes", "requirement_value": 1},
-        {"badge_id": "hour_hero", "name_tr": "Saat Kahramanı", "name_en": "Hour Hero", "description_tr": "Toplam 1 saat odaklan", "description_en": "Focus for 1 hour total", "icon": "⏰", "requirement_type": "total_minutes", "requirement_value": 60},
-        {"badge_id": "streak_starter", "name_tr": "Seri Başlangıcı", "name_en": "Streak Starter", "description_tr": "3 günlük seri yap", "description_en": "Achieve a 3-day streak", "icon": "🔥", "requirement_type": "streak", "requirement_value": 3},
-        {"badge_id": "streak_master", "name_tr": "Seri Ustası", "name_en": "Streak Master", "description_tr": "7 günlük seri yap", "description_en": "Achieve a 7-day streak", "icon": "💪", "requirement_type": "streak", "requirement_value": 7},
-        {"badge_id": "level_5", "name_tr": "Seviye 5", "name_en": "Level 5", "description_tr": "Seviye 5'e ulaş", "description_en": "Reach level 5", "icon": "🏆", "requirement_type": "level", "requirement_value": 5},
-        {"badge_id": "shopaholic", "name_tr": "Alışveriş Delisi", "name_en": "Shopaholic", "description_tr": "10 ürün satın al", "description_en": "Purchase 10 items", "icon": "🛍️", "requirement_type": "purchases", "requirement_value": 10},
-        {"badge_id": "social_butterfly", "name_tr": "Sosyal Kelebek", "name_en": "Social Butterfly", "description_tr": "5 arkadaş ekle", "description_en": "Add 5 friends", "icon": "🦋", "requirement_type": "friends", "requirement_value": 5},
-    ]
-    return badges
+async def get_badges(request: Request, lang: Optional[str] = None):
+    validate_language(lang)
+    return catalog_response(request, catalog.render("badges", 1, lang))
 
 @api_router.get("/badges/earned")
 async def get_earned_badges(request: Request):
@@ -627,6 +719,7 @@ async def update_settings(settings: SettingsUpdate, request: Request):
     update_data = {k: v for k, v in settings.model_dump().items() if v is not None}
     if update_data:
         await db.users.update_one({"user_id": user.user_id}, {"$set": update_data})
+        invalidate_user(user.user_id)
     
     user_doc = await db.users.find_one({"user_id": user.user_id}, {"_id": 0})
     return user_doc
@@ -635,21 +728,15 @@ async def update_settings(settings: SettingsUpdate, request: Request):
 async def get_user_stats(request: Request):
     user = await get_current_user(request)
     
-    # Get session count
-    session_count = await db.focus_sessions.count_documents({"user_id": user.user_id, "status": "completed"})
-    purchase_count = await db.purchases.count_documents({"user_id": user.user_id})
-    friend_count = await db.friendships.count_documents({
-        "$or": [{"user_id": user.user_id}, {"friend_id": user.user_id}],
-        "status": "accepted"
-    })
-    badge_count = await db.user_badges.count_documents({"user_id": user.user_id})
+    # One indexed read of the maintained counters
+    user_counters = await counters.get_counters(db, user.user_id)
     
     return {
-        "total_sessions": session_count,
+        "total_sessions": user_counters["focus_sessions"],
         "total_focus_minutes": user.total_focus_minutes,
-        "total_purchases": purchase_count,
-        "total_friends": friend_count,
-        "total_badges": badge_count,
+        "total_purchases": user_counters["purchases"],
+        "total_friends": user_counters["friends"],
+        "total_badges": user_counters["badges"],
         "credits": user.credits,
         "level": user.level,
         "xp": user.xp,
@@ -660,110 +747,90 @@ async def get_user_stats(request: Request):
 
 # ==================== DAILY QUESTS ENDPOINTS ====================
 
+# Quest documents only hold template ids and progress; the text lives in QUEST_TEMPLATES
+
+async def ensure_daily_quests(user_id: str, today: str) -> dict:
+    """Fetch today's quest state, creating it with one upsert on the unique (user_id, date) key"""
+    query = {"user_id": user_id, "date": today}
+    try:
+        return await db.user_daily_quests.find_one_and_update(
+            query,
+            {"$setOnInsert": {
+                "quests": [
+                    {"quest_id": template["quest_id"], "progress": 0, "completed": False}
+                    for template in DAILY_QUEST_TEMPLATES
+                ],
+                "created_at": datetime.now(timezone.utc).isoformat()
+            }},
+            projection={"_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # A concurrent request inserted it first
+        return await db.user_daily_quests.find_one(query, {"_id": 0})
+
+def join_quest_templates(user_quests: dict, lang: Optional[str] = None) -> list:
+    quests = []
+    for state in user_quests["quests"]:
+        template = QUEST_TEMPLATES.get(state["quest_id"])
+        if not template:
+            continue
+        quests.append({
+            **localize(template, lang),
+            "progress": min(state["progress"], template["target"]),
+            "completed": state["completed"]
+        })
+    return quests
+
 @api_router.get("/quests/daily")
-async def get_daily_quests(request: Request):
+async def get_daily_quests(request: Request, lang: Optional[str] = None):
     user = await get_current_user(request)
+    validate_language(lang)
     today = datetime.now(timezone.utc).date().isoformat()
     
-    # Check if user has today's quests
-    user_quests = await db.user_daily_quests.find_one(
-        {"user_id": user.user_id, "date": today},
-        {"_id": 0}
-    )
-    
-    if not user_quests:
-        # Generate new daily quests
-        daily_quests = [
-            {
-                "quest_id": "daily_focus_30",
-                "type": "focus_time",
-                "title_tr": "30 Dakika Odaklan",
-                "title_en": "Focus for 30 Minutes",
-                "description_tr": "Bugün toplam 30 dakika çalış",
-                "description_en": "Study for 30 minutes total today",
-                "target": 30,
-                "progress": 0,
-                "reward_credits": 50,
-                "reward_xp": 100,
-                "completed": False
-            },
-            {
-                "quest_id": "daily_todo_3",
-                "type": "complete_todos",
-                "title_tr": "3 Görev Tamamla",
-                "title_en": "Complete 3 Tasks",
-                "description_tr": "Bugün 3 yapılacak görevi tamamla",
-                "description_en": "Complete 3 to-do items today",
-                "target": 3,
-                "progress": 0,
-                "reward_credits": 30,
-                "reward_xp": 60,
-                "completed": False
-            },
-            {
-                "quest_id": "daily_streak",
-                "type": "maintain_streak",
-                "title_tr": "Seri Devam",
-                "title_en": "Keep Streak",
-                "description_tr": "Günlük serini devam ettir",
-                "description_en": "Continue your daily streak",
-                "target": 1,
-                "progress": 0,
-                "reward_credits": 20,
-                "reward_xp": 40,
-                "completed": False
-            },
-        ]
-        
-        user_quests = {
-            "user_id": user.user_id,
-            "date": today,
-            "quests": daily_quests,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.user_daily_quests.insert_one(user_quests)
-    
-    return user_quests["quests"]
+    user_quests = await ensure_daily_quests(user.user_id, today)
+    return join_quest_templates(user_quests, lang)
 
 @api_router.post("/quests/claim/{quest_id}")
 async def claim_quest_reward(quest_id: str, request: Request):
     user = await get_current_user(request)
     today = datetime.now(timezone.utc).date().isoformat()
     
-    user_quests = await db.user_daily_quests.find_one(
-        {"user_id": user.user_id, "date": today},
-        {"_id": 0}
-    )
-    
-    if not user_quests:
-        raise HTTPException(status_code=404, detail="No quests found")
-    
-    quest = None
-    for q in user_quests["quests"]:
-        if q["quest_id"] == quest_id:
-            quest = q
-            break
-    
+    quest = QUEST_TEMPLATES.get(quest_id)
     if not quest:
         raise HTTPException(status_code=404, detail="Quest not found")
     
-    if quest["completed"]:
-        raise HTTPException(status_code=400, detail="Quest already claimed")
-    
-    if quest["progress"] < quest["target"]:
-        raise HTTPException(status_code=400, detail="Quest not completed")
-    
-    # Mark as completed
-    await db.user_daily_quests.update_one(
-        {"user_id": user.user_id, "date": today, "quests.quest_id": quest_id},
+    # Mark as completed only if it is finished and unclaimed, so a reward is paid once
+    result = await db.user_daily_quests.update_one(
+        {"user_id": user.user_id, "date": today, "quests": {"$elemMatch": {
+            "quest_id": quest_id,
+            "completed": False,
+            "progress": {"$gte": quest["target"]}
+        }}},
         {"$set": {"quests.$.completed": True}}
     )
     
+    if result.modified_count == 0:
+        user_quests = await db.user_daily_quests.find_one(
+            {"user_id": user.user_id, "date": today},
+            {"_id": 0}
+        )
+        if not user_quests:
+            raise HTTPException(status_code=404, detail="No quests found")
+        state = next((q for q in user_quests["quests"] if q["quest_id"] == quest_id), None)
+        if not state:
+            raise HTTPException(status_code=404, detail="Quest not found")
+        if state["completed"]:
+            raise HTTPException(status_code=400, detail="Quest already claimed")
+        raise HTTPException(status_code=400, detail="Quest not completed")
+    
     # Give rewards
     await db.users.update_one(
         {"user_id": user.user_id},
         {"$inc": {"credits": quest["reward_credits"], "xp": quest["reward_xp"]}}
     )
+    invalidate_user(user.user_id)
     
     return {
         "message": "Quest completed!",
@@ -772,63 +839,47 @@ async def claim_quest_reward(quest_id: str, request: Request):
     }
 
 # Helper to update quest progress
-async def update_quest_progress(user_id: str, quest_type: str, amount: int = 1):
+async def update_quest_progress(user_id: str, quest_type: str, source_id: str, amount: int = 1):
+    """Credit quest progress once per (quest_type, source_id), so redelivered events are no-ops"""
+    templates = [t for t in DAILY_QUEST_TEMPLATES if t["type"] == quest_type]
+    if not templates:
+        return
     today = datetime.now(timezone.utc).date().isoformat()
+    applied = f"{quest_type}:{source_id}"
     
-    user_quests = await db.user_daily_quests.find_one(
-        {"user_id": user_id, "date": today}
-    )
-    
-    if user_quests:
-        for i, quest in enumerate(user_quests["quests"]):
-            if quest["type"] == quest_type and not quest["completed"]:
-                new_progress = min(quest["progress"] + amount, quest["target"])
-                await db.user_daily_quests.update_one(
-                    {"user_id": user_id, "date": today},
-                    {"$set": {f"quests.{i}.progress": new_progress}}
-                )
+    # One update for every matching quest; quests stop counting once they reach their target
+    update = {
+        "$inc": {f"quests.$[q{i}].progress": amount for i in range(len(templates))},
+        "$push": {"applied": applied}
+    }
+    array_filters = [
+        {f"q{i}.quest_id": t["quest_id"], f"q{i}.completed": False, f"q{i}.progress": {"$lt": t["target"]}}
+        for i, t in enumerate(templates)
+    ]
+    query = {"user_id": user_id, "date": today, "applied": {"$ne": applied}}
+    result = await db.user_daily_quests.update_one(query, update, array_filters=array_filters)
+    if result.matched_count == 0:
+        # Either today's quests don't exist yet or this source was already counted
+        await ensure_daily_quests(user_id, today)
+        await db.user_daily_quests.update_one(query, update, array_filters=array_filters)
 
 # ==================== ACHIEVEMENTS ENDPOINTS ====================
 
 @api_router.get("/achievements")
-async def get_achievements(request: Request):
+async def get_achievements(request: Request, lang: Optional[str] = None):
     user = await get_current_user(request)
-    
-    achievements = [
-        {"id": "first_focus", "name_tr": "İlk Adım", "name_en": "First Step", "desc_tr": "İlk odaklanma seansını tamamla", "desc_en": "Complete your first focus session", "icon": "🌟", "type": "total_minutes", "target": 1, "reward": 50},
-        {"id": "hour_hero", "name_tr": "Saat Kahramanı", "name_en": "Hour Hero", "desc_tr": "Toplam 1 saat odaklan", "desc_en": "Focus for 1 hour total", "icon": "⏰", "type": "total_minutes", "target": 60, "reward": 100},
-        {"id": "focus_master", "name_tr": "Odak Ustası", "name_en": "Focus Master", "desc_tr": "Toplam 10 saat odaklan", "desc_en": "Focus for 10 hours total", "icon": "🎯", "type": "total_minutes", "target": 600, "reward": 500},
-        {"id": "streak_3", "name_tr": "Seri Başlangıcı", "name_en": "Streak Starter", "desc_tr": "3 günlük seri yap", "desc_en": "Achieve 3-day streak", "icon": "🔥", "type": "streak", "target": 3, "reward": 75},
-        {"id": "streak_7", "name_tr": "Haftalık Savaşçı", "name_en": "Weekly Warrior", "desc_tr": "7 günlük seri yap", "desc_en": "Achieve 7-day streak", "icon": "💪", "type": "streak", "target": 7, "reward": 200},
-        {"id": "streak_30", "name_tr": "Aylık Efsane", "name_en": "Monthly Legend", "desc_tr": "30 günlük seri yap", "desc_en": "Achieve 30-day streak", "icon": "👑", "type": "streak", "target": 30, "reward": 1000},
-        {"id": "level_5", "name_tr": "Çırak", "name_en": "Apprentice", "desc_tr": "Seviye 5'e ulaş", "desc_en": "Reach level 5", "icon": "⭐", "type": "level", "target": 5, "reward": 150},
-        {"id": "level_10", "name_tr": "Uzman", "name_en": "Expert", "desc_tr": "Seviye 10'a ulaş", "desc_en": "Reach level 10", "icon": "🏆", "type": "level", "target": 10, "reward": 400},
-        {"id": "collector", "name_tr": "Koleksiyoncu", "name_en": "Collector", "desc_tr": "10 ürün satın al", "desc_en": "Purchase 10 items", "icon": "🛍️", "type": "purchases", "target": 10, "reward": 200},
-        {"id": "social", "name_tr": "Sosyal Kelebek", "name_en": "Social Butterfly", "desc_tr": "5 arkadaş ekle", "desc_en": "Add 5 friends", "icon": "🦋", "type": "friends", "target": 5, "reward": 150},
-    ]
+    validate_language(lang)
+    achievements = catalog.achievements(lang)
     
     # Get user's earned achievements
     earned = await db.user_achievements.find({"user_id": user.user_id}, {"_id": 0}).to_list(100)
-    earned_ids = [e["achievement_id"] for e in earned]
+    earned_ids = {e["achievement_id"] for e in earned}
     
     # Calculate progress for each achievement
+    metrics = user_metrics(user, await counters.get_counters(db, user.user_id))
     for ach in achievements:
         ach["earned"] = ach["id"] in earned_ids
-        
-        if ach["type"] == "total_minutes":
-            ach["progress"] = min(user.total_focus_minutes, ach["target"])
-        elif ach["type"] == "streak":
-            ach["progress"] = min(user.streak_days, ach["target"])
-        elif ach["type"] == "level":
-            ach["progress"] = min(user.level, ach["target"])
-        elif ach["type"] == "purchases":
-            ach["progress"] = min(len(user.owned_items), ach["target"])
-        elif ach["type"] == "friends":
-            friend_count = await db.friendships.count_documents({
-                "$or": [{"user_id": user.user_id}, {"friend_id": user.user_id}],
-                "status": "accepted"
-            })
-            ach["progress"] = min(friend_count, ach["target"])
+        ach["progress"] = min(metrics[ach["type"]], ach["target"])
     
     return achievements
 
@@ -836,53 +887,92 @@ async def get_achievements(request: Request):
 async def claim_achievement(achievement_id: str, request: Request):
     user = await get_current_user(request)
     
-    # Check if already earned
-    existing = await db.user_achievements.find_one({
-        "user_id": user.user_id,
-        "achievement_id": achievement_id
-    })
-    
-    if existing:
-        raise HTTPException(status_code=400, detail="Achievement already claimed")
-    
-    # Get achievements list
-    achievements_resp = await get_achievements(request)
-    achievement = None
-    for ach in achievements_resp:
-        if ach["id"] == achievement_id:
-            achievement = ach
-            break
-    
-    if not achievement:
+    # Only the rule being claimed is evaluated
+    rule = rules.get("achievement", achievement_id)
+    if not rule:
         raise HTTPException(status_code=404, detail="Achievement not found")
     
-    if achievement["progress"] < achievement["target"]:
+    progress = user_metrics(user, await counters.get_counters(db, user.user_id))[rule.metric]
+    if progress < rule.threshold:
         raise HTTPException(status_code=400, detail="Achievement not completed")
     
-    # Record achievement
-    await db.user_achievements.insert_one({
-        "user_id": user.user_id,
-        "achievement_id": achievement_id,
-        "earned_at": datetime.now(timezone.utc).isoformat()
-    })
+    # Record achievement; (user_id, achievement_id) is unique so a claim can't be paid twice
+    try:
+        await db.user_achievements.insert_one({
+            "user_id": user.user_id,
+            "achievement_id": achievement_id,
+            "earned_at": datetime.now(timezone.utc).isoformat()
+        })
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Achievement already claimed")
     
     # Give reward
     await db.users.update_one(
         {"user_id": user.user_id},
-        {"$inc": {"credits": achievement["reward"]}}
+        {"$inc": {"credits": rule.reward}}
     )
-    
-    return {"message": "Achievement claimed!", "credits_earned": achievement["reward"]}
+    invalidate_user(user.user_id)
+    
+    return {"message": "Achievement claimed!", "credits_earned": rule.reward}
+
+# ==================== EVENT SUBSCRIBERS ====================
+
+@events.on(FocusCompleted)
+async def award_focus_badges(batch: List[FocusCompleted]):
+    for event in batch:
+        # Streak moves by one step at most, so only its new value can have been crossed
+        await award_badges(event.user_id, {
+            "total_minutes": (event.total_focus_minutes - event.minutes, event.total_focus_minutes),
+            "streak": (event.streak_days - 1, event.streak_days),
+            "level": (event.previous_level, event.level),
+        })
+
+@events.on(FocusCompleted)
+async def progress_focus_quests(batch: List[FocusCompleted]):
+    for event in batch:
+        await update_quest_progress(event.user_id, "focus_time", event.session_id, event.minutes)
+        await update_quest_progress(event.user_id, "maintain_streak", event.session_id, 1)
+
+@events.on(TodoCompleted)
+async def progress_todo_quests(batch: List[TodoCompleted]):
+    for event in batch:
+        await update_quest_progress(event.user_id, "complete_todos", event.todo_id, 1)
+
+@events.on(ItemPurchased)
+async def award_purchase_badges(batch: List[ItemPurchased]):
+    for event in batch:
+        await award_badges(event.user_id, {"purchases": (event.purchases - 1, event.purchases)})
+
+@events.on(FriendAdded)
+async def award_friend_badges(batch: List[FriendAdded]):
+    for event in batch:
+        await award_badges(event.user_id, {"friends": (event.friends - 1, event.friends)})
+        await award_badges(event.friend_id, {"friends": (event.friend_friends - 1, event.friend_friends)})
 
 @api_router.get("/")
 async def root():
     return {"message": "PoncikFocus API", "version": "1.0.0"}
 
+@api_router.get("/metrics")
+async def get_metrics():
+    """In-process cache and subsystem counters for this worker"""
+    return {
+        "auth_cache": {
+            "sessions": session_cache.stats(),
+            "users": user_cache.stats(),
+        },
+        "leaderboard": leaderboard.stats(),
+        "events": events.stats(),
+        "rate_limit": limiter.stats(),
+    }
+
 @api_router.post("/auth/test-login")
-async def test_login(response: Response):
+async def test_login(request: Request, response: Response):
     """Test login endpoint - creates a test user and logs them in"""
     import secrets
     
+    await limiter.enforce("test_login", request.client.host if request.client else "unknown")
+    
     # Create test user
     test_user = {
         "user_id": "test-user-" + secrets.token_hex(8),
@@ -957,6 +1047,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def start_background_services():
+    try:
+        await catalog.ensure_loaded()
+    except Exception as e:
+        # Retried lazily by the first catalog request
+        logger.error(f"Catalog load failed: {e}")
+    await leaderboard.start()
+    await events.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await events.stop()
+    await leaderboard.stop()
+    await auth_provider.close()
     client.close()
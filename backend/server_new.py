@@ -6,17 +6,31 @@ from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional, Dict, Union
 import uuid
 from datetime import datetime, timezone, timedelta
-import httpx
 import asyncio
 import json
 import base64
-from pywebpush import webpush, WebPushException
 import stripe
 import secrets
+import time
+
+import chat_inbox
+import chat_search
+import counters
+from broker import create_broker
+from billing import WebhookProcessor
+from cache import SingleFlight, TTLCache
+from chat_archive import create_archiver
+from entitlements import Entitlements
+from group_commit import GroupCommitWriter
+from http_clients import create_upstream
+from push_delivery import PushDelivery
+from rate_limit import create_limiter
+from spotify_tokens import SpotifyTokens
+from realtime import ConnectionManager, negotiate
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -28,6 +42,10 @@ db = client[os.environ['DB_NAME']]
 
 # Stripe setup
 stripe.api_key = os.environ.get('STRIPE_SECRET_KEY', '')
+if os.environ.get('STRIPE_API_BASE'):
+    # e.g. a local stripe-mock for development and tests
+    stripe.api_base = os.environ['STRIPE_API_BASE']
+CHECKOUT_REUSE_SECONDS = int(os.environ.get('CHECKOUT_REUSE_SECONDS', '1800'))
 
 # VAPID keys for push notifications
 VAPID_PUBLIC_KEY = os.environ.get('VAPID_PUBLIC_KEY', '')
@@ -38,6 +56,10 @@ VAPID_CLAIMS = {"sub": os.environ.get('VAPID_SUBJECT', 'mailto:support@tinycafe.
 SPOTIFY_CLIENT_ID = os.environ.get('SPOTIFY_CLIENT_ID', '')
 SPOTIFY_CLIENT_SECRET = os.environ.get('SPOTIFY_CLIENT_SECRET', '')
 SPOTIFY_REDIRECT_URI = os.environ.get('SPOTIFY_REDIRECT_URI', 'http://localhost:3000/spotify-callback')
+SPOTIFY_REFRESH_MIN_AGE = float(os.environ.get('SPOTIFY_REFRESH_MIN_AGE', '60'))
+
+# Free tier limits
+FREE_GROUP_LIMIT = 3
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -47,32 +69,70 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__)
 
 # WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-
-    async def connect(self, user_id: str, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        logger.info(f"User {user_id} connected to WebSocket")
-
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            logger.info(f"User {user_id} disconnected from WebSocket")
-
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_json(message)
-            except Exception as e:
-                logger.error(f"Failed to send message to {user_id}: {e}")
+# Set BROKER_URL (redis://host:port) to deliver across several workers
+broker = create_broker(os.environ.get('BROKER_URL', ''))
+manager = ConnectionManager(
+    queue_size=int(os.environ.get('WS_SEND_QUEUE_SIZE', '256')),
+    send_timeout=float(os.environ.get('WS_SEND_TIMEOUT', '5')),
+    max_batch=int(os.environ.get('WS_MAX_BATCH', '64')),
+    broker=broker,
+    heartbeat_interval=float(os.environ.get('WS_HEARTBEAT_SECONDS', '30')),
+    idle_timeout=float(os.environ.get('WS_IDLE_TIMEOUT', '75')),
+    max_per_user=int(os.environ.get('WS_MAX_CONNECTIONS_PER_USER', '5'))
+)
+
+# Set RATE_LIMIT_URL (redis://host:port) to share rate limits across workers
+limiter = create_limiter(os.environ.get('RATE_LIMIT_URL', ''))
 
-    async def broadcast(self, message: dict, user_ids: List[str]):
-        for user_id in user_ids:
-            await self.send_personal_message(message, user_id)
+# Optional group commit: batch chat_messages inserts arriving within a few milliseconds
+chat_writer = None
+if os.environ.get('CHAT_GROUP_COMMIT', '').lower() in ('1', 'true', 'yes'):
+    chat_writer = GroupCommitWriter(
+        db.chat_messages,
+        max_delay=float(os.environ.get('CHAT_GROUP_COMMIT_MS', '5')) / 1000,
+        max_batch=int(os.environ.get('CHAT_GROUP_COMMIT_BATCH', '500'))
+    )
+
+# Stripe checkout creation and webhook processing
+checkout_flight = SingleFlight()
+webhooks = WebhookProcessor(db)
+entitlements = Entitlements(
+    db,
+    broker=broker,
+    cache_ttl=float(os.environ.get('ENTITLEMENT_CACHE_TTL', '300')),
+    sweep_seconds=float(os.environ.get('PREMIUM_SWEEP_SECONDS', '300'))
+)
 
-manager = ConnectionManager()
+# Spotify accounts service (token exchange and refresh)
+spotify_accounts = create_upstream("Spotify", "SPOTIFY_ACCOUNTS", "https://accounts.spotify.com")
+spotify_tokens = SpotifyTokens(
+    db,
+    spotify_accounts,
+    SPOTIFY_CLIENT_ID,
+    SPOTIFY_CLIENT_SECRET,
+    refresh_margin=float(os.environ.get('SPOTIFY_REFRESH_MARGIN', '300')),
+    renew_seconds=float(os.environ.get('SPOTIFY_RENEW_SECONDS', '60')),
+    active_seconds=float(os.environ.get('SPOTIFY_RENEW_ACTIVE_SECONDS', '3600'))
+)
+
+# Web push delivery pool
+push_delivery = PushDelivery(
+    db,
+    VAPID_PRIVATE_KEY,
+    VAPID_CLAIMS,
+    workers=int(os.environ.get('PUSH_WORKERS', '8')),
+    queue_size=int(os.environ.get('PUSH_QUEUE_SIZE', '10000')),
+    max_retries=int(os.environ.get('PUSH_MAX_RETRIES', '3'))
+)
+
+# Cold archive of old chat history, enabled by CHAT_ARCHIVE_AFTER_DAYS
+archiver = create_archiver(db)
+
+# Group membership is read on every send; membership changes are rare
+group_members_cache = TTLCache(
+    maxsize=int(os.environ.get('GROUP_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('GROUP_CACHE_TTL', '30'))
+)
 
 # ==================== EXISTING MODELS ====================
 
@@ -99,6 +159,7 @@ class User(BaseModel):
     customization: Optional[Dict] = None
     spotify_access_token: Optional[str] = None
     spotify_refresh_token: Optional[str] = None
+    spotify_expires_at: Optional[str] = None
 
 class UserSession(BaseModel):
     user_id: str
@@ -125,7 +186,6 @@ class ChatMessage(BaseModel):
     sender_id: str
     sender_name: str
     message: str
-    read: bool = False
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class ChatSend(BaseModel):
@@ -175,7 +235,7 @@ class SpotifyCallback(BaseModel):
 
 # ==================== HELPER FUNCTIONS ====================
 
-async def get_user_from_session(request: Request) -> Optional[dict]:
+async def get_user_from_session(request: Union[Request, WebSocket]) -> Optional[dict]:
     """Extract user from session cookie"""
     session_token = request.cookies.get('session_token')
     if not session_token:
@@ -194,15 +254,7 @@ async def get_user_from_session(request: Request) -> Optional[dict]:
 
 def check_premium(user: dict) -> bool:
     """Check if user has active premium"""
-    if not user.get('is_premium'):
-        return False
-    
-    if user.get('premium_expires_at'):
-        expires = datetime.fromisoformat(user['premium_expires_at'].replace('Z', '+00:00'))
-        if expires < datetime.now(timezone.utc):
-            return False
-    
-    return True
+    return entitlements.is_premium(user)
 
 # ==================== CUSTOMIZATION ENDPOINTS ====================
 
@@ -305,28 +357,141 @@ async def get_chat_friends(request: Request):
     
     return friend_users
 
-@api_router.get("/chat/messages/{chat_id}")
-async def get_chat_messages(chat_id: str, request: Request):
-    """Get messages for a chat"""
+async def chat_participants(chat_id: str, sender_id: str) -> Optional[tuple]:
+    """Members of a chat and its member count, or None if the chat doesn't exist"""
+    if chat_id.startswith('group_'):
+        group_id = chat_id.replace('group_', '', 1)
+        members = group_members_cache.get(group_id)
+        if members is None:
+            group = await db.chat_groups.find_one({"group_id": group_id}, {"_id": 0, "members": 1})
+            if not group:
+                return None
+            members = group.get('members', [])
+            group_members_cache.set(group_id, members)
+        return members, len(members)
+    if chat_id.startswith('friend_'):
+        return [sender_id, chat_id.replace('friend_', '', 1)], 2
+    return None
+
+@api_router.get("/chat/inbox")
+async def get_chat_inbox(request: Request, limit: int = 50):
+    """Chat list with last message and unread count, most recent first"""
     user = await get_user_from_session(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    messages = await db.chat_messages.find(
-        {"chat_id": chat_id}
-    ).sort("created_at", 1).to_list(length=100)
-    
-    # Mark as read
-    await db.chat_messages.update_many(
-        {"chat_id": chat_id, "sender_id": {"$ne": user['user_id']}},
-        {"$set": {"read": True}}
-    )
+    return await chat_inbox.list_inbox(db, user['user_id'], max(1, min(limit, 100)))
+
+def encode_cursor(message: dict) -> str:
+    """Opaque keyset cursor for a message's (created_at, message_id) position"""
+    raw = f"{message['created_at']}|{message['message_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.split("|", 1)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return created_at, message_id
+
+def keyset_filter(op: str, cursor: str) -> dict:
+    """Messages strictly before ($lt) or after ($gt) the cursor position"""
+    created_at, message_id = decode_cursor(cursor)
+    return {"$or": [
+        {"created_at": {op: created_at}},
+        {"created_at": created_at, "message_id": {op: message_id}}
+    ]}
+
+def merge_history(archived: List[dict], hot: List[dict]) -> List[dict]:
+    """Archived messages precede hot ones; a message in both (interrupted archive run) appears once"""
+    archived_ids = {m['message_id'] for m in archived}
+    return archived + [m for m in hot if m['message_id'] not in archived_ids]
+
+@api_router.get("/chat/messages/{chat_id}")
+async def get_chat_messages(
+    chat_id: str,
+    request: Request,
+    response: Response,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = 50
+):
+    """Get a page of messages for a chat, newest page first, in chronological order
+    
+    `before` pages back through older history; `after` fetches what arrived since.
+    Cursors come from the X-Prev-Cursor / X-Next-Cursor response headers.
+    """
+    user = await get_user_from_session(request)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after")
+    limit = max(1, min(limit, 100))
+    stored_id = chat_inbox.storage_chat_id(chat_id, user['user_id'])
+    
+    # Keyset pagination on the (chat_id, created_at, message_id) index
+    query = {"chat_id": stored_id}
+    if after:
+        query.update(keyset_filter("$gt", after))
+        messages = await db.chat_messages.find(query, {"search_text": 0}).sort(
+            [("created_at", 1), ("message_id", 1)]
+        ).to_list(length=limit)
+        if archiver:
+            # A cursor inside archived history continues through the segments first
+            archived = await archiver.read_after(stored_id, decode_cursor(after), limit)
+            messages = merge_history(archived, messages)[:limit]
+    else:
+        if before:
+            query.update(keyset_filter("$lt", before))
+        messages = await db.chat_messages.find(query, {"search_text": 0}).sort(
+            [("created_at", -1), ("message_id", -1)]
+        ).to_list(length=limit)
+        messages.reverse()
+        if archiver and len(messages) < limit:
+            # Older history continues in archived segments
+            boundary = (messages[0]['created_at'], messages[0]['message_id']) if messages else (
+                decode_cursor(before) if before else None
+            )
+            archived = await archiver.read_before(stored_id, boundary, limit - len(messages))
+            messages = merge_history(archived, messages)
+    
+    if messages:
+        if after or len(messages) == limit:
+            response.headers["X-Prev-Cursor"] = encode_cursor(messages[0])
+        response.headers["X-Next-Cursor"] = encode_cursor(messages[-1])
+    elif after:
+        response.headers["X-Next-Cursor"] = after
+    
+    # Reading the newest page advances the watermark; older pages leave it alone
+    if messages and not before:
+        watermark = await chat_inbox.mark_read(db, user['user_id'], stored_id, messages[-1]['created_at'])
+    else:
+        watermark = await chat_inbox.get_watermark(db, user['user_id'], stored_id)
     
     for msg in messages:
-        msg['_id'] = str(msg['_id'])
+        if '_id' in msg:
+            msg['_id'] = str(msg['_id'])
+        msg['chat_id'] = chat_id
+        msg['read'] = chat_inbox.is_read(msg, user['user_id'], watermark)
     
     return messages
 
+@api_router.get("/chat/search")
+async def search_chat_messages(request: Request, q: str, page: int = 1, limit: int = 20):
+    """Ranked full-text search across the chats the user belongs to"""
+    user = await get_user_from_session(request)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Empty search query")
+    
+    chat_ids = await chat_search.user_chat_ids(db, user['user_id'])
+    found = await chat_search.search(db, chat_ids, q, max(1, min(page, 50)), max(1, min(limit, 50)))
+    for msg in found["results"]:
+        msg['chat_id'] = chat_inbox.client_chat_id(msg['chat_id'], user['user_id'])
+    return found
+
 @api_router.post("/chat/send")
 async def send_chat_message(chat: ChatSend, request: Request):
     """Send a chat message"""
@@ -334,45 +499,49 @@ async def send_chat_message(chat: ChatSend, request: Request):
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    # Anti-spam: Check recent messages
-    recent = await db.chat_messages.find(
-        {
-            "sender_id": user['user_id'],
-            "created_at": {"$gte": (datetime.now(timezone.utc) - timedelta(seconds=5)).isoformat()}
-        }
-    ).to_list(length=10)
-    
-    if len(recent) >= 3:
-        raise HTTPException(status_code=429, detail="Too many messages")
+    message = await post_chat_message(user, chat.chat_id, chat.message)
+    return {"success": True, "message": message.dict()}
+
+async def post_chat_message(user: dict, chat_id: str, text: str) -> ChatMessage:
+    """Store a message and push it to the participants; shared by HTTP and WebSocket sends"""
+    # Anti-spam: per-user token bucket, no database read on the send path
+    await limiter.enforce("chat_send", user['user_id'])
     
     # Create message
     message = ChatMessage(
-        chat_id=chat.chat_id,
+        chat_id=chat_id,
         sender_id=user['user_id'],
         sender_name=user['name'],
-        message=chat.message
+        message=text
     )
     
-    await db.chat_messages.insert_one(message.dict())
+    participants = await chat_participants(chat_id, user['user_id'])
+    # Both members of a one-to-one chat read and write it under one stored id
+    stored = {**message.dict(), "chat_id": chat_inbox.storage_chat_id(chat_id, user['user_id'])}
+    
+    if chat_writer:
+        await chat_writer.insert(chat_search.search_document(stored))
+    else:
+        await db.chat_messages.insert_one(chat_search.search_document(stored))
+    if participants:
+        await chat_inbox.record_message(db, stored, *participants)
     
     # Send via WebSocket to participants
-    if chat.chat_id.startswith('group_'):
-        # Get group members
-        group = await db.chat_groups.find_one({"group_id": chat.chat_id.replace('group_', '')})
-        if group:
+    if chat_id.startswith('group_'):
+        if participants:
             await manager.broadcast(
                 {"type": "new_message", "message": message.dict()},
-                group['members']
+                participants[0]
             )
-    elif chat.chat_id.startswith('friend_'):
+    elif chat_id.startswith('friend_'):
         # Send to friend
-        friend_id = chat.chat_id.replace('friend_', '')
+        friend_id = chat_id.replace('friend_', '')
         await manager.send_personal_message(
-            {"type": "new_message", "message": message.dict()},
+            {"type": "new_message", "message": {**message.dict(), "chat_id": f"friend_{user['user_id']}"}},
             friend_id
         )
     
-    return {"success": True, "message": message.dict()}
+    return message
 
 @api_router.post("/chat/groups/create")
 async def create_chat_group(group: GroupCreate, request: Request):
@@ -381,12 +550,10 @@ async def create_chat_group(group: GroupCreate, request: Request):
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    # Check premium for unlimited groups
-    if not check_premium(user):
-        # Check group limit for free users
-        user_groups = await db.chat_groups.count_documents({"created_by": user['user_id']})
-        if user_groups >= 3:
-            raise HTTPException(status_code=403, detail="Group limit reached. Upgrade to premium.")
+    # Check premium for unlimited groups; free users reserve a slot atomically
+    limit = None if check_premium(user) else FREE_GROUP_LIMIT
+    if not await counters.reserve(db, user['user_id'], "groups_created", limit):
+        raise HTTPException(status_code=403, detail="Group limit reached. Upgrade to premium.")
     
     # Create group
     chat_group = ChatGroup(
@@ -395,7 +562,12 @@ async def create_chat_group(group: GroupCreate, request: Request):
         created_by=user['user_id']
     )
     
-    await db.chat_groups.insert_one(chat_group.dict())
+    try:
+        await db.chat_groups.insert_one(chat_group.dict())
+    except Exception:
+        await counters.release(db, user['user_id'], "groups_created")
+        raise
+    await chat_inbox.add_members(db, f"group_{chat_group.group_id}", chat_group.members, len(chat_group.members))
     
     return {"success": True, "group": chat_group.dict()}
 
@@ -408,104 +580,155 @@ async def subscribe_premium(sub: PremiumSubscribe, request: Request):
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    # Calculate price and duration
+    # Calculate price
     if sub.plan == "monthly":
         price = 2999  # 29.99 TRY in cents
-        duration_days = 30
     elif sub.plan == "yearly":
         price = 19999  # 199.99 TRY in cents
-        duration_days = 365
     else:
         raise HTTPException(status_code=400, detail="Invalid plan")
     
-    # Create Stripe checkout session
+    # Concurrent clicks share one creation; a recent open session is handed back as-is
+    return await checkout_flight.do(
+        (user['user_id'], sub.plan),
+        lambda: get_or_create_checkout(user['user_id'], sub.plan, price)
+    )
+
+async def get_or_create_checkout(user_id: str, plan: str, price: int) -> dict:
+    now = datetime.now(timezone.utc)
+    recent = await db.premium_checkouts.find_one(
+        {
+            "user_id": user_id,
+            "plan": plan,
+            "status": "open",
+            "created_at": {"$gte": (now - timedelta(seconds=CHECKOUT_REUSE_SECONDS)).isoformat()}
+        },
+        {"_id": 0, "url": 1},
+        sort=[("created_at", -1)]
+    )
+    if recent:
+        return {"checkout_url": recent['url']}
+    
+    # Completed checkouts move the key on, so subscribing again doesn't replay a finished session
+    completed = await db.premium_checkouts.count_documents({"user_id": user_id, "plan": plan, "status": "completed"})
+    frontend_url = os.environ.get("FRONTEND_URL", "http://localhost:3000")
     try:
-        checkout_session = stripe.checkout.Session.create(
+        # The Stripe client is synchronous; keep it off the event loop
+        checkout_session = await asyncio.to_thread(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=[{
                 'price_data': {
                     'currency': 'try',
                     'product_data': {
-                        'name': f'Tiny Café Premium - {sub.plan.capitalize()}',
+                        'name': f'Tiny Café Premium - {plan.capitalize()}',
                         'description': 'Premium membership with exclusive features',
                     },
                     'unit_amount': price,
                     'recurring': {
-                        'interval': 'month' if sub.plan == 'monthly' else 'year',
+                        'interval': 'month' if plan == 'monthly' else 'year',
                     },
                 },
                 'quantity': 1,
             }],
             mode='subscription',
-            success_url=f'{os.environ.get("FRONTEND_URL", "http://localhost:3000")}/premium/success?session_id={{CHECKOUT_SESSION_ID}}',
-            cancel_url=f'{os.environ.get("FRONTEND_URL", "http://localhost:3000")}/premium/cancel',
-            client_reference_id=user['user_id'],
+            success_url=f'{frontend_url}/premium/success?session_id={{CHECKOUT_SESSION_ID}}',
+            cancel_url=f'{frontend_url}/premium/cancel',
+            client_reference_id=user_id,
             metadata={
-                'user_id': user['user_id'],
-                'plan': sub.plan
-            }
+                'user_id': user_id,
+                'plan': plan
+            },
+            # Other workers asking within the same window get the same session from Stripe
+            idempotency_key=f"checkout-{user_id}-{plan}-{completed}-{int(now.timestamp() // CHECKOUT_REUSE_SECONDS)}"
         )
-        
-        return {"checkout_url": checkout_session.url}
-    
     except Exception as e:
         logger.error(f"Stripe error: {e}")
         raise HTTPException(status_code=500, detail="Payment processing failed")
+    
+    await db.premium_checkouts.update_one(
+        {"session_id": checkout_session.id},
+        {"$setOnInsert": {
+            "session_id": checkout_session.id,
+            "user_id": user_id,
+            "plan": plan,
+            "url": checkout_session.url,
+            "status": "open",
+            "created_at": now.isoformat()
+        }},
+        upsert=True
+    )
+    return {"checkout_url": checkout_session.url}
 
 @api_router.post("/premium/webhook")
 async def premium_webhook(request: Request):
-    """Handle Stripe webhooks"""
+    """Handle Stripe webhooks: verify, record once, apply in the background"""
     payload = await request.body()
     sig_header = request.headers.get('stripe-signature')
     
     try:
-        event = stripe.Webhook.construct_event(
+        stripe.Webhook.construct_event(
             payload, sig_header, os.environ.get('STRIPE_WEBHOOK_SECRET', '')
         )
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         raise HTTPException(status_code=400, detail="Invalid signature")
     
-    # Handle subscription events
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        user_id = session['metadata']['user_id']
-        plan = session['metadata']['plan']
-        
-        # Calculate expiry
-        duration_days = 30 if plan == 'monthly' else 365
-        expires_at = (datetime.now(timezone.utc) + timedelta(days=duration_days)).isoformat()
-        
-        # Update user
-        await db.users.update_one(
-            {"user_id": user_id},
-            {
-                "$set": {
-                    "is_premium": True,
-                    "premium_expires_at": expires_at
-                }
+    recorded = await webhooks.record(json.loads(payload))
+    return {"success": True, "duplicate": not recorded}
+
+@webhooks.on('checkout.session.completed')
+async def apply_checkout_completed(event: dict):
+    session = event['data']['object']
+    user_id = session['metadata']['user_id']
+    plan = session['metadata']['plan']
+    
+    # Expiry counts from the event, so re-applying it gives the same result
+    duration_days = 30 if plan == 'monthly' else 365
+    expires_at = (datetime.fromtimestamp(event['created'], timezone.utc) + timedelta(days=duration_days)).isoformat()
+    
+    # Update user
+    await db.users.update_one(
+        {"user_id": user_id},
+        {
+            "$set": {
+                "is_premium": True,
+                "premium_expires_at": expires_at
             }
-        )
-        
-        # Create subscription record
-        subscription = PremiumSubscription(
-            user_id=user_id,
-            plan=plan,
-            stripe_subscription_id=session.get('subscription'),
-            expires_at=expires_at
-        )
-        await db.premium_subscriptions.insert_one(subscription.dict())
-    
-    elif event['type'] == 'customer.subscription.deleted':
-        subscription = event['data']['object']
-        
-        # Deactivate premium
-        await db.users.update_many(
-            {"stripe_subscription_id": subscription['id']},
-            {"$set": {"is_premium": False}}
-        )
+        }
+    )
     
-    return {"success": True}
+    # Create subscription record, once per checkout session
+    subscription = PremiumSubscription(
+        user_id=user_id,
+        plan=plan,
+        stripe_subscription_id=session.get('subscription'),
+        expires_at=expires_at
+    )
+    await db.premium_subscriptions.update_one(
+        {"checkout_session_id": session['id']},
+        {"$setOnInsert": {**subscription.dict(), "checkout_session_id": session['id']}},
+        upsert=True
+    )
+    await db.premium_checkouts.update_one({"session_id": session['id']}, {"$set": {"status": "completed"}})
+    entitlements.invalidate(user_id)
+
+@webhooks.on('customer.subscription.deleted')
+async def apply_subscription_deleted(event: dict):
+    subscription = event['data']['object']
+    
+    # Users don't carry the Stripe id; the subscription record maps it to the user
+    record = await db.premium_subscriptions.find_one_and_update(
+        {"stripe_subscription_id": subscription['id']},
+        {"$set": {"status": "canceled"}},
+        {"_id": 0, "user_id": 1, "expires_at": 1}
+    )
+    if not record:
+        logger.warning(f"Subscription {subscription['id']} deleted but not found")
+        return
+    
+    # Deactivate premium unless another subscription is still running
+    await entitlements.revoke([record['user_id']], record['expires_at'])
 
 @api_router.get("/premium/status")
 async def get_premium_status(request: Request):
@@ -514,11 +737,11 @@ async def get_premium_status(request: Request):
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    is_premium = check_premium(user)
+    entitlement = entitlements.get(user)
     
     return {
-        "is_premium": is_premium,
-        "expires_at": user.get('premium_expires_at')
+        "is_premium": check_premium(user),
+        "expires_at": entitlement.expires_at
     }
 
 # ==================== NOTIFICATION ENDPOINTS ====================
@@ -566,27 +789,26 @@ async def send_notification(notification: NotificationSend, request: Request):
     user = await get_user_from_session(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    await limiter.enforce("notifications_send", user['user_id'])
     
     # Get user's subscription
     sub_doc = await db.push_subscriptions.find_one({"user_id": notification.user_id})
     if not sub_doc:
         raise HTTPException(status_code=404, detail="User not subscribed")
     
-    try:
-        webpush(
-            subscription_info=sub_doc['subscription'],
-            data=json.dumps({
-                "title": notification.title,
-                "body": notification.body,
-                "icon": notification.icon
-            }),
-            vapid_private_key=VAPID_PRIVATE_KEY,
-            vapid_claims=VAPID_CLAIMS
-        )
-        return {"success": True}
-    except WebPushException as e:
-        logger.error(f"Push notification failed: {e}")
-        raise HTTPException(status_code=500, detail="Failed to send notification")
+    # Encryption and the push service round trip happen on the delivery pool
+    queued = push_delivery.enqueue(
+        notification.user_id,
+        sub_doc['subscription'],
+        json.dumps({
+            "title": notification.title,
+            "body": notification.body,
+            "icon": notification.icon
+        })
+    )
+    if not queued:
+        raise HTTPException(status_code=503, detail="Notification queue is full, try again later")
+    return {"success": True}
 
 # ==================== SPOTIFY ENDPOINTS ====================
 
@@ -598,35 +820,24 @@ async def spotify_callback(callback: SpotifyCallback, request: Request):
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     # Exchange code for tokens
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            'https://accounts.spotify.com/api/token',
-            data={
-                'grant_type': 'authorization_code',
-                'code': callback.code,
-                'redirect_uri': SPOTIFY_REDIRECT_URI,
-                'client_id': SPOTIFY_CLIENT_ID,
-                'client_secret': SPOTIFY_CLIENT_SECRET,
-            }
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Spotify auth failed")
-        
-        tokens = response.json()
-    
-    # Store tokens
-    await db.users.update_one(
-        {"user_id": user['user_id']},
-        {
-            "$set": {
-                "spotify_access_token": tokens['access_token'],
-                "spotify_refresh_token": tokens['refresh_token']
-            }
+    response = await spotify_accounts.post(
+        '/api/token',
+        data={
+            'grant_type': 'authorization_code',
+            'code': callback.code,
+            'redirect_uri': SPOTIFY_REDIRECT_URI,
+            'client_id': SPOTIFY_CLIENT_ID,
+            'client_secret': SPOTIFY_CLIENT_SECRET,
         }
     )
     
-    return {"success": True, "access_token": tokens['access_token']}
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Spotify auth failed")
+    
+    # Store tokens with their expiry
+    access = await spotify_tokens.store(user['user_id'], response.json())
+    
+    return {"success": True, "access_token": access.token}
 
 @api_router.get("/spotify/token")
 async def get_spotify_token(request: Request):
@@ -638,7 +849,9 @@ async def get_spotify_token(request: Request):
     if not user.get('spotify_access_token'):
         raise HTTPException(status_code=404, detail="Spotify not connected")
     
-    return {"access_token": user['spotify_access_token']}
+    # Cached until near expiry; the renewer normally refreshes it before then
+    access = await spotify_tokens.access_token(user)
+    return {"access_token": access.token, "expires_in": int(access.expires_ts - time.time())}
 
 @api_router.post("/spotify/refresh")
 async def refresh_spotify_token(request: Request):
@@ -647,49 +860,132 @@ async def refresh_spotify_token(request: Request):
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    if not user.get('spotify_refresh_token'):
-        raise HTTPException(status_code=404, detail="No refresh token")
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            'https://accounts.spotify.com/api/token',
-            data={
-                'grant_type': 'refresh_token',
-                'refresh_token': user['spotify_refresh_token'],
-                'client_id': SPOTIFY_CLIENT_ID,
-                'client_secret': SPOTIFY_CLIENT_SECRET,
-            }
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Refresh failed")
-        
-        tokens = response.json()
-    
-    # Update token
-    await db.users.update_one(
-        {"user_id": user['user_id']},
-        {"$set": {"spotify_access_token": tokens['access_token']}}
-    )
-    
-    return {"access_token": tokens['access_token']}
+    # Tabs refreshing together share one call; a token minted moments ago is handed back
+    access = await spotify_tokens.refresh(user, min_age=SPOTIFY_REFRESH_MIN_AGE)
+    return {"access_token": access.token, "expires_in": int(access.expires_ts - time.time())}
 
 # ==================== WEBSOCKET ====================
 
 @app.websocket("/ws/chat/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    """WebSocket endpoint for real-time chat"""
-    await manager.connect(user_id, websocket)
+    """WebSocket endpoint for real-time chat: send, typing and ack over one socket"""
+    # Authenticate once at the handshake; events on the socket reuse this user
+    user = await get_user_from_session(websocket)
+    if not user or user['user_id'] != user_id:
+        await websocket.close(code=1008)
+        return
+    
+    connection = await manager.connect(user_id, websocket, negotiate(websocket.scope.get('subprotocols', [])))
     try:
         while True:
-            data = await websocket.receive_text()
-            # Keep connection alive
-            await asyncio.sleep(0.1)
+            frame = await websocket.receive()
+            if frame['type'] == 'websocket.disconnect':
+                break
+            connection.touch()
+            try:
+                events = connection.decode(frame)
+            except ValueError as e:
+                manager.reply(connection, {"type": "error", "status": 400, "detail": str(e)})
+                continue
+            for event in events:
+                await handle_socket_event(connection, user, event)
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        pass
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
-        manager.disconnect(user_id)
+    finally:
+        manager.disconnect(user_id, connection)
+
+async def handle_socket_event(connection, user: dict, event: dict):
+    """Handle one client event and answer on the same socket"""
+    kind = event.get('type')
+    client_id = event.get('client_id')
+    try:
+        if kind == 'pong':
+            # Liveness is already recorded by touch()
+            return
+        elif kind == 'ping':
+            reply = {"type": "pong"}
+        elif kind == 'send':
+            chat = ChatSend(**event)
+            message = await post_chat_message(user, chat.chat_id, chat.message)
+            reply = {"type": "sent", "client_id": client_id, "message": message.dict()}
+        elif kind == 'typing':
+            await broadcast_typing(user, str(event['chat_id']))
+            return
+        elif kind == 'ack':
+            # The client has read everything up to created_at
+            chat_id = str(event['chat_id'])
+            last_read_at = await chat_inbox.mark_read(
+                db, user['user_id'], chat_inbox.storage_chat_id(chat_id, user['user_id']), str(event['created_at'])
+            )
+            reply = {"type": "acked", "client_id": client_id, "chat_id": chat_id, "last_read_at": last_read_at}
+        else:
+            reply = {"type": "error", "client_id": client_id, "status": 400, "detail": "Unknown event type"}
+    except HTTPException as e:
+        reply = {"type": "error", "client_id": client_id, "status": e.status_code, "detail": e.detail}
+    except (ValidationError, KeyError):
+        reply = {"type": "error", "client_id": client_id, "status": 400, "detail": "Invalid event"}
+    manager.reply(connection, reply)
+
+async def broadcast_typing(user: dict, chat_id: str):
+    """Relay a typing indicator to the other participants without storing anything"""
+    participants = await chat_participants(chat_id, user['user_id'])
+    if not participants:
+        return
+    recipients = [member for member in participants[0] if member != user['user_id']]
+    if chat_id.startswith('friend_'):
+        # The peer knows this chat by the sender's id
+        chat_id = f"friend_{user['user_id']}"
+    await manager.broadcast(
+        {"type": "typing", "chat_id": chat_id, "user_id": user['user_id'], "name": user['name']},
+        recipients
+    )
+
+@api_router.get("/metrics")
+async def get_metrics():
+    """In-process WebSocket and cache counters for this worker"""
+    return {
+        "websocket": manager.stats(),
+        "broker": broker.stats(),
+        "group_members_cache": group_members_cache.stats(),
+        "chat_group_commit": chat_writer.stats() if chat_writer else None,
+        "rate_limit": limiter.stats(),
+        "chat_archive": archiver.stats() if archiver else None,
+        "push": push_delivery.stats(),
+        "stripe_webhooks": webhooks.stats(),
+        "entitlements": entitlements.stats(),
+        "upstreams": {"spotify": spotify_accounts.stats()},
+        "spotify_tokens": spotify_tokens.stats(),
+    }
+
+@app.on_event("startup")
+async def start_realtime():
+    await broker.start()
+    await manager.start()
+    if chat_writer:
+        await chat_writer.start()
+    if archiver:
+        await archiver.start()
+    await push_delivery.start()
+    await webhooks.start()
+    await entitlements.start()
+    await spotify_tokens.start()
+
+@app.on_event("shutdown")
+async def shutdown_realtime():
+    await spotify_tokens.stop()
+    await entitlements.stop()
+    await webhooks.stop()
+    await spotify_accounts.close()
+    await push_delivery.stop()
+    if archiver:
+        await archiver.stop()
+    if chat_writer:
+        await chat_writer.stop()
+    await manager.stop()
+    await broker.stop()
+    client.close()
 
 # ==================== EXISTING ENDPOINTS (keep all existing ones) ====================
 # ... (all your existing endpoints remain here)
@@ -704,6 +1000,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Prev-Cursor", "X-Next-Cursor"],
 )
 
 if __name__ == "__main__":
@@ -0,0 +1,235 @@
+"""
+Spotify access tokens
+Tokens are stored on the user with their expiry (spotify_expires_at) and
+served from an in-memory cache until shortly before they lapse. Refreshes
+for one user are collapsed into a single call to Spotify, and a background
+renewer refreshes tokens nearing expiry in batches so /spotify/token
+rarely has to wait on the accounts service. Only tokens served within
+active_seconds (spotify_served_at) are renewed ahead of time, and each
+renewal is claimed with a short lease (spotify_refreshing_until) so one
+worker refreshes a given user however many run the renewer.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone, timedelta
+from typing import NamedTuple, Optional
+
+from fastapi import HTTPException
+
+from cache import SingleFlight, TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class AccessToken(NamedTuple):
+    token: str
+    expires_ts: float
+    issued_ts: float
+
+
+class SpotifyTokens:
+    def __init__(
+        self,
+        db,
+        accounts,
+        client_id: str,
+        client_secret: str,
+        refresh_margin: float = 300.0,
+        renew_seconds: float = 60.0,
+        active_seconds: float = 3600.0,
+        lease_seconds: float = 60.0,
+        batch_size: int = 100,
+        concurrency: int = 8,
+        cache_size: int = 10000
+    ):
+        self.db = db
+        self.accounts = accounts
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.renew_seconds = renew_seconds
+        self.active_seconds = active_seconds
+        self.lease_seconds = lease_seconds
+        # Serving is recorded at most this often per user
+        self.touch_seconds = min(300.0, active_seconds / 4)
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._cache = TTLCache(maxsize=cache_size, ttl=3600)
+        self._flight = SingleFlight()
+        self._task: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.renewed = 0
+        self.renew_skipped = 0
+        self.last_renewal: dict = {}
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def _fresh(self, token: Optional[AccessToken]) -> bool:
+        return token is not None and token.expires_ts - self.refresh_margin > time.time()
+
+    async def store(self, user_id: str, tokens: dict) -> AccessToken:
+        """Save a token response from Spotify; the refresh token is only replaced if a new one came back"""
+        now = time.time()
+        access = AccessToken(tokens['access_token'], now + int(tokens.get('expires_in', 3600)), now)
+        fields = {
+            "spotify_access_token": access.token,
+            "spotify_expires_at": datetime.fromtimestamp(access.expires_ts, timezone.utc).isoformat(),
+        }
+        if tokens.get('refresh_token'):
+            fields["spotify_refresh_token"] = tokens['refresh_token']
+        await self.db.users.update_one(
+            {"user_id": user_id}, {"$set": fields, "$unset": {"spotify_refreshing_until": ""}}
+        )
+        self._cache.set(user_id, access, ttl=access.expires_ts - now)
+        return access
+
+    async def access_token(self, user: dict) -> AccessToken:
+        """A token with at least refresh_margin seconds left, refreshing only when needed"""
+        await self._touch(user)
+        cached = self._cache.get(user['user_id'])
+        if self._fresh(cached):
+            return cached
+        if user.get('spotify_access_token') and user.get('spotify_expires_at'):
+            expires_ts = datetime.fromisoformat(user['spotify_expires_at']).timestamp()
+            stored = AccessToken(user['spotify_access_token'], expires_ts, 0.0)
+            if self._fresh(stored):
+                self._cache.set(user['user_id'], stored, ttl=expires_ts - time.time())
+                return stored
+        return await self.refresh(user)
+
+    async def _touch(self, user: dict):
+        """Mark the user's token as in use so the renewer keeps it fresh"""
+        now = datetime.now(timezone.utc)
+        if user.get('spotify_served_at', '') >= (now - timedelta(seconds=self.touch_seconds)).isoformat():
+            return
+        await self.db.users.update_one({"user_id": user['user_id']}, {"$set": {"spotify_served_at": now.isoformat()}})
+
+    async def refresh(self, user: dict, min_age: float = 0.0) -> AccessToken:
+        """Refresh once for all concurrent callers; a token issued within min_age seconds is reused"""
+        cached = self._cache.get(user['user_id'])
+        if self._fresh(cached) and time.time() - cached.issued_ts < min_age:
+            return cached
+        if not user.get('spotify_refresh_token'):
+            raise HTTPException(status_code=404, detail="No refresh token")
+        return await self._flight.do(
+            user['user_id'], lambda: self._refresh(user['user_id'], user['spotify_refresh_token'])
+        )
+
+    async def _refresh(self, user_id: str, refresh_token: str) -> AccessToken:
+        self.refreshes += 1
+        response = await self.accounts.post(
+            '/api/token',
+            data={
+                'grant_type': 'refresh_token',
+                'refresh_token': refresh_token,
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+            }
+        )
+        if response.status_code != 200:
+            self.refresh_failures += 1
+            if response.status_code == 400:
+                # Revoked grant: drop the expiry so the renewer stops retrying this user
+                await self.db.users.update_one(
+                    {"user_id": user_id}, {"$unset": {"spotify_expires_at": "", "spotify_refreshing_until": ""}}
+                )
+                self._cache.pop(user_id)
+            raise HTTPException(status_code=400, detail="Refresh failed")
+        return await self.store(user_id, response.json())
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.renew()
+            except Exception as e:
+                logger.error(f"Spotify token renewal failed: {e}")
+            await asyncio.sleep(self.renew_seconds)
+
+    async def renew(self) -> dict:
+        """Refresh every recently served token that would fall inside the margin before the next run"""
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        horizon = (now + timedelta(seconds=self.refresh_margin + self.renew_seconds)).isoformat()
+        active_since = (now - timedelta(seconds=self.active_seconds)).isoformat()
+        renewed = failed = skipped = 0
+        after: dict = {}
+        while True:
+            # Renewed users leave the window; the keyset only steps past ones that failed
+            batch = await self.db.users.find(
+                {
+                    "spotify_expires_at": {"$lt": horizon},
+                    "spotify_served_at": {"$gte": active_since},
+                    "spotify_refresh_token": {"$exists": True},
+                    **after
+                },
+                {"_id": 0, "user_id": 1, "spotify_refresh_token": 1, "spotify_expires_at": 1}
+            ).sort([("spotify_expires_at", 1), ("user_id", 1)]).limit(self.batch_size).to_list(length=self.batch_size)
+            if not batch:
+                break
+            results = await asyncio.gather(*(self._renew_one(user) for user in batch), return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    failed += 1
+                elif result is None:
+                    skipped += 1
+                else:
+                    renewed += 1
+            last = batch[-1]
+            after = {"$or": [
+                {"spotify_expires_at": {"$gt": last['spotify_expires_at']}},
+                {"spotify_expires_at": last['spotify_expires_at'], "user_id": {"$gt": last['user_id']}},
+            ]}
+        self.renewed += renewed
+        self.renew_skipped += skipped
+        self.last_renewal = {
+            "renewed": renewed,
+            "failed": failed,
+            "skipped": skipped,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        return self.last_renewal
+
+    async def _claim(self, user: dict) -> bool:
+        """Lease this user's renewal; False if another worker holds it or already renewed"""
+        now = datetime.now(timezone.utc)
+        claimed = await self.db.users.find_one_and_update(
+            {
+                "user_id": user['user_id'],
+                "spotify_expires_at": user['spotify_expires_at'],
+                "$or": [
+                    {"spotify_refreshing_until": {"$exists": False}},
+                    {"spotify_refreshing_until": {"$lt": now.isoformat()}},
+                ],
+            },
+            {"$set": {"spotify_refreshing_until": (now + timedelta(seconds=self.lease_seconds)).isoformat()}},
+            {"_id": 0, "user_id": 1}
+        )
+        return claimed is not None
+
+    async def _renew_one(self, user: dict) -> Optional[AccessToken]:
+        # A failed refresh keeps the lease until it lapses, which spaces out retries
+        if not await self._claim(user):
+            return None
+        async with self._semaphore:
+            return await self._flight.do(
+                user['user_id'], lambda: self._refresh(user['user_id'], user['spotify_refresh_token'])
+            )
+
+    def stats(self) -> dict:
+        return {
+            "cache": self._cache.stats(),
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "renewed": self.renewed,
+            "renew_skipped": self.renew_skipped,
+            "last_renewal": self.last_renewal,
+        }
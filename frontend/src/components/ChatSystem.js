@@ -48,7 +48,10 @@ export default function ChatSystem() {
 
       ws.onmessage = (event) => {
         const data = JSON.parse(event.data);
-        if (data.type === 'new_message') {
+        if (data.type === 'ping') {
+          // Answer server heartbeats so the socket isn't closed as idle
+          ws.send(JSON.stringify({ type: 'pong' }));
+        } else if (data.type === 'new_message') {
           setMessages(prev => [...prev, data.message]);
           scrollToBottom();
         }
@@ -0,0 +1,23 @@
+"""
+Shared test setup
+The backend modules read MONGO_URL/DB_NAME at import time and connect lazily,
+so tests import them with placeholder settings and swap each module's `db`
+for an in-memory mongomock-motor database.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tinycafe_test")
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()["tinycafe_test"]
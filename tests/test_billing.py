@@ -0,0 +1,227 @@
+"""
+Premium billing: webhook events apply once, checkouts are reused; the
+checkout flow runs against a local Stripe API stub
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import stripe
+from starlette.requests import Request
+
+import server_new
+from billing import WebhookProcessor
+
+EVENT = {
+    "id": "evt_1",
+    "type": "checkout.session.completed",
+    "data": {"object": {"metadata": {"user_id": "u1", "plan": "monthly"}}},
+}
+
+
+def processor(db) -> tuple:
+    webhooks = WebhookProcessor(db)
+    applied = []
+
+    @webhooks.on("checkout.session.completed")
+    async def handler(event: dict):
+        applied.append(event["id"])
+
+    return webhooks, applied
+
+
+async def drain(webhooks: WebhookProcessor):
+    while not webhooks._queue.empty():
+        await webhooks._apply(webhooks._queue.get_nowait())
+
+
+def test_redelivered_event_is_applied_once(db):
+    async def scenario():
+        await db.stripe_events.create_index("event_id", unique=True)
+        webhooks, applied = processor(db)
+        first = await webhooks.record(EVENT)
+        second = await webhooks.record(dict(EVENT))
+        await drain(webhooks)
+        return first, second, applied, webhooks.stats()
+
+    first, second, applied, stats = asyncio.run(scenario())
+    assert (first, second) == (True, False)
+    assert applied == ["evt_1"]
+    assert stats["duplicates"] == 1 and stats["applied"] == 1
+
+
+def test_event_claimed_by_two_workers_is_applied_once(db):
+    async def scenario():
+        await db.stripe_events.create_index("event_id", unique=True)
+        worker_a, applied_a = processor(db)
+        worker_b, applied_b = processor(db)
+        await worker_a.record(EVENT)
+        # The sweep on another worker picks the same event up
+        await asyncio.gather(worker_a._apply("evt_1"), worker_b._apply("evt_1"))
+        await worker_b._apply("evt_1")
+        status = (await db.stripe_events.find_one({"event_id": "evt_1"}))["status"]
+        return applied_a + applied_b, status
+
+    applied, status = asyncio.run(scenario())
+    assert applied == ["evt_1"]
+    assert status == "processed"
+
+
+# ==================== AGAINST A LOCAL STRIPE API ====================
+
+WEBHOOK_SECRET = "whsec_test"
+
+
+class StripeStub(ThreadingHTTPServer):
+    """Checkout Sessions endpoint that, like Stripe, replays the response for a repeated Idempotency-Key"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StripeHandler)
+        self.created = []
+        self.replayed = 0
+        self.by_key = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StripeHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        if self.path != "/v1/checkout/sessions":
+            return self._reply(404, {"error": {"message": f"Unrecognized request URL ({self.path})"}})
+        key = self.headers.get("Idempotency-Key")
+        with self.server.lock:
+            if key in self.server.by_key:
+                self.server.replayed += 1
+                return self._reply(200, self.server.by_key[key])
+            session_id = f"cs_test_{len(self.server.created) + 1}"
+            session = {
+                "id": session_id,
+                "object": "checkout.session",
+                "url": f"https://checkout.stripe.com/c/pay/{session_id}",
+                "client_reference_id": form["client_reference_id"][0],
+                "metadata": {"user_id": form["metadata[user_id]"][0], "plan": form["metadata[plan]"][0]},
+            }
+            self.server.created.append(session)
+            self.server.by_key[key] = session
+        self._reply(200, session)
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stripe_api(db, monkeypatch):
+    stub = StripeStub()
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    # What STRIPE_API_BASE configures at startup
+    monkeypatch.setattr(stripe, "api_base", stub.url)
+    monkeypatch.setattr(stripe, "api_key", "sk_test_stub")
+    monkeypatch.setenv("STRIPE_WEBHOOK_SECRET", WEBHOOK_SECRET)
+    monkeypatch.setattr(server_new, "db", db)
+    webhooks = WebhookProcessor(db)
+    webhooks._handlers = dict(server_new.webhooks._handlers)
+    monkeypatch.setattr(server_new, "webhooks", webhooks)
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+def signed_webhook(event: dict) -> Request:
+    payload = json.dumps(event).encode()
+    timestamp = int(time.time())
+    signature = hmac.new(WEBHOOK_SECRET.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    headers = [(b"stripe-signature", f"t={timestamp},v1={signature}".encode())]
+
+    async def receive():
+        return {"type": "http.request", "body": payload, "more_body": False}
+
+    return Request({"type": "http", "method": "POST", "path": "/api/premium/webhook", "headers": headers}, receive)
+
+
+def completed_event(event_id: str, session: dict) -> dict:
+    return {
+        "id": event_id,
+        "object": "event",
+        "type": "checkout.session.completed",
+        "created": int(time.time()),
+        "data": {"object": {**session, "subscription": "sub_test_1"}},
+    }
+
+
+def subscribe(user_id: str = "u1", plan: str = "monthly") -> dict:
+    return server_new.checkout_flight.do(
+        (user_id, plan), lambda: server_new.get_or_create_checkout(user_id, plan, 4999)
+    )
+
+
+def test_checkout_is_reused_within_reuse_window(stripe_api):
+    async def scenario():
+        first = await subscribe()
+        second = await subscribe()
+        other_plan = await subscribe(plan="yearly")
+        return first, second, other_plan
+
+    first, second, other_plan = asyncio.run(scenario())
+    assert first == second == {"checkout_url": "https://checkout.stripe.com/c/pay/cs_test_1"}
+    assert other_plan == {"checkout_url": "https://checkout.stripe.com/c/pay/cs_test_2"}
+    assert len(stripe_api.created) == 2 and stripe_api.replayed == 0
+
+
+def test_concurrent_subscribe_requests_share_one_checkout(stripe_api):
+    async def scenario():
+        return await asyncio.gather(*(subscribe() for _ in range(10)))
+
+    results = asyncio.run(scenario())
+    assert {result["checkout_url"] for result in results} == {"https://checkout.stripe.com/c/pay/cs_test_1"}
+    assert len(stripe_api.created) == 1
+
+
+def test_redelivered_webhook_applies_once_and_resubscribing_gets_a_new_session(db, stripe_api):
+    async def scenario():
+        await db.stripe_events.create_index("event_id", unique=True)
+        await db.users.insert_one({"user_id": "u1", "is_premium": False})
+        await subscribe()
+        event = completed_event("evt_1", stripe_api.created[0])
+        first = await server_new.premium_webhook(signed_webhook(event))
+        second = await server_new.premium_webhook(signed_webhook(event))
+        await drain(server_new.webhooks)
+        user = await db.users.find_one({"user_id": "u1"})
+        subscriptions = await db.premium_subscriptions.count_documents({"user_id": "u1"})
+        # Same reuse window: the completed session must not be handed back by key replay
+        again = await subscribe()
+        return first, second, server_new.webhooks.stats(), user, subscriptions, again
+
+    first, second, stats, user, subscriptions, again = asyncio.run(scenario())
+    assert (first["duplicate"], second["duplicate"]) == (False, True)
+    assert stats["applied"] == 1 and stats["duplicates"] == 1
+    assert user["is_premium"] and subscriptions == 1
+    assert again == {"checkout_url": "https://checkout.stripe.com/c/pay/cs_test_2"}
+    assert stripe_api.replayed == 0
+
+
+def test_bad_signature_is_rejected(stripe_api):
+    request = signed_webhook(completed_event("evt_2", {"id": "cs_x", "metadata": {}}))
+    request.scope["headers"] = [(b"stripe-signature", b"t=1,v1=deadbeef")]
+    with pytest.raises(server_new.HTTPException) as raised:
+        asyncio.run(server_new.premium_webhook(request))
+    assert raised.value.status_code == 400
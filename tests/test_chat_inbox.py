@@ -0,0 +1,145 @@
+"""
+Chat inbox for one-to-one chats: both members share one thread, keyed per viewer
+"""
+
+import asyncio
+
+import pytest
+from starlette.requests import Request
+from starlette.responses import Response
+
+import chat_inbox
+import server_new
+from rate_limit import RateLimiter
+
+ALICE = {"user_id": "user_alice", "name": "Alice"}
+BOB = {"user_id": "user_bob", "name": "Bob"}
+CAROL = {"user_id": "user_carol", "name": "Carol"}
+
+
+class InboxCollection:
+    """chat_inbox with BSON ordering for $max on subdocuments, which mongomock can't compare"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            update = {key: dict(value) for key, value in op._doc.items()}
+            current = await self.collection.find_one(op._filter) or {}
+            for field, value in list(update.get("$max", {}).items()):
+                if not isinstance(value, dict):
+                    continue
+                del update["$max"][field]
+                existing = current.get(field)
+                # Documents compare field by field in order; created_at leads
+                if existing is None or tuple(value.values()) > tuple(existing.values()):
+                    update.setdefault("$set", {})[field] = value
+            await self.collection.update_one(op._filter, {k: v for k, v in update.items() if v}, upsert=op._upsert)
+
+
+class Database:
+    def __init__(self, db):
+        self.db = db
+        self.chat_inbox = InboxCollection(db.chat_inbox)
+
+    def __getattr__(self, name):
+        return self.db[name]
+
+
+def request_as(user: dict) -> Request:
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": [], "query_string": b""})
+    request.state.user = user
+    return request
+
+
+@pytest.fixture
+def app_db(db, monkeypatch):
+    async def current_user(request):
+        return request.state.user
+
+    db = Database(db)
+    monkeypatch.setattr(server_new, "db", db)
+    monkeypatch.setattr(server_new, "chat_writer", None)
+    monkeypatch.setattr(server_new, "archiver", None)
+    monkeypatch.setattr(server_new, "limiter", RateLimiter())
+    monkeypatch.setattr(server_new, "get_user_from_session", current_user)
+    return db
+
+
+async def inbox(user: dict) -> dict:
+    entries = await server_new.get_chat_inbox(request_as(user))
+    return {entry["chat_id"]: entry for entry in entries}
+
+
+async def read(user: dict, chat_id: str) -> list:
+    return await server_new.get_chat_messages(chat_id, request_as(user), Response())
+
+
+def test_direct_chat_ids_agree_from_both_sides():
+    stored = chat_inbox.storage_chat_id("friend_user_bob", "user_alice")
+    assert stored == chat_inbox.storage_chat_id("friend_user_alice", "user_bob")
+    assert chat_inbox.client_chat_id(stored, "user_alice") == "friend_user_bob"
+    assert chat_inbox.client_chat_id(stored, "user_bob") == "friend_user_alice"
+    assert chat_inbox.client_chat_id("group_g1", "user_alice") == "group_g1"
+
+
+def test_two_users_send_read_and_unread_clears(app_db):
+    async def scenario():
+        await server_new.post_chat_message(ALICE, "friend_user_bob", "hi bob")
+        await server_new.post_chat_message(ALICE, "friend_user_bob", "are you there?")
+        before = await inbox(BOB)
+        sender_view = await inbox(ALICE)
+
+        messages = await read(BOB, "friend_user_alice")
+        after = await inbox(BOB)
+
+        await server_new.post_chat_message(BOB, "friend_user_alice", "yes")
+        alice_before = await inbox(ALICE)
+        alice_thread = await read(ALICE, "friend_user_bob")
+        alice_after = await inbox(ALICE)
+        return before, sender_view, messages, after, alice_before, alice_thread, alice_after
+
+    before, sender_view, messages, after, alice_before, alice_thread, alice_after = asyncio.run(scenario())
+    # No thread with themselves: each side sees the other
+    assert list(before) == ["friend_user_alice"] and before["friend_user_alice"]["unread_count"] == 2
+    assert list(sender_view) == ["friend_user_bob"] and sender_view["friend_user_bob"]["unread_count"] == 0
+    assert [m["message"] for m in messages] == ["hi bob", "are you there?"]
+    assert {m["chat_id"] for m in messages} == {"friend_user_alice"}
+    assert after["friend_user_alice"]["unread_count"] == 0
+
+    assert alice_before["friend_user_bob"]["unread_count"] == 1
+    assert [m["message"] for m in alice_thread] == ["hi bob", "are you there?", "yes"]
+    assert alice_after["friend_user_bob"]["unread_count"] == 0
+
+
+def test_search_scope_excludes_other_users_direct_messages(app_db):
+    async def scenario():
+        await server_new.post_chat_message(CAROL, "friend_user_bob", "secret plan")
+        await server_new.post_chat_message(ALICE, "friend_user_bob", "public plan")
+        return await server_new.chat_search.user_chat_ids(app_db, "user_alice")
+
+    chat_ids = asyncio.run(scenario())
+    assert chat_ids == [chat_inbox.direct_chat_id("user_alice", "user_bob")]
+
+
+def test_legacy_friend_messages_are_rekeyed(app_db):
+    async def scenario():
+        await app_db.chat_messages.insert_many([
+            {"chat_id": "friend_user_bob", "sender_id": "user_alice", "message_id": "m1",
+             "sender_name": "Alice", "message": "old hi", "created_at": "2024-01-01T00:00:00"},
+            {"chat_id": "friend_user_alice", "sender_id": "user_bob", "message_id": "m2",
+             "sender_name": "Bob", "message": "old hello", "created_at": "2024-01-01T00:01:00"},
+        ])
+        await app_db.chat_inbox.insert_one({"user_id": "user_bob", "chat_id": "friend_user_bob", "unread_count": 1})
+        moved = await chat_inbox.migrate_direct_chats(app_db)
+        await chat_inbox.rebuild_all(app_db)
+        return moved, await inbox(BOB), await read(BOB, "friend_user_alice")
+
+    moved, bob_inbox, thread = asyncio.run(scenario())
+    assert moved == 2
+    assert list(bob_inbox) == ["friend_user_alice"]
+    assert [m["message"] for m in thread] == ["old hi", "old hello"]
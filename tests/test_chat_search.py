@@ -0,0 +1,58 @@
+"""
+Chat search: normalization and the missing-index error
+"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import OperationFailure
+
+import chat_search
+
+
+def test_normalize_folds_turkish_letters_and_punctuation():
+    assert chat_search.normalize("İstanbul'da ÇAY içtik!") == "istanbul da cay ictik"
+    assert chat_search.normalize("IŞIK") == "isik"
+
+
+class Cursor:
+    def __init__(self, error):
+        self.error = error
+
+    def sort(self, *args):
+        return self
+
+    def skip(self, *args):
+        return self
+
+    def limit(self, *args):
+        return self
+
+    async def to_list(self, length):
+        raise self.error
+
+
+class Messages:
+    def __init__(self, error):
+        self.error = error
+
+    def find(self, *args):
+        return Cursor(self.error)
+
+
+def search_with(error):
+    db = type("DB", (), {"chat_messages": Messages(error)})()
+    return asyncio.run(chat_search.search(db, ["group_g1"], "merhaba", 1, 20))
+
+
+def test_missing_text_index_is_a_clear_503():
+    with pytest.raises(HTTPException) as raised:
+        search_with(OperationFailure("text index required for $text query", code=27))
+    assert raised.value.status_code == 503
+    assert raised.value.detail == "Chat search is not available yet"
+
+
+def test_other_database_errors_are_not_masked():
+    with pytest.raises(OperationFailure):
+        search_with(OperationFailure("not authorized", code=13))
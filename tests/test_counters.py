@@ -0,0 +1,77 @@
+"""
+Counter reconciliation on a live database: increments that land mid-run are kept
+"""
+
+import asyncio
+
+import counters
+
+
+async def seed(db, sessions: int):
+    await db.user_counters.create_index("user_id", unique=True)
+    await db.users.insert_many([{"user_id": "u1"}, {"user_id": "u2"}])
+    await db.focus_sessions.insert_many(
+        [{"user_id": "u1", "status": "completed"} for _ in range(sessions)]
+    )
+
+
+async def complete_session(db, user_id: str):
+    """What end_focus_session does: source write, then the counter"""
+    await db.focus_sessions.insert_one({"user_id": user_id, "status": "completed"})
+    await counters.increment(db, user_id, focus_sessions=1)
+
+
+def test_reconcile_all_backfills_from_sources(db):
+    async def scenario():
+        await seed(db, 3)
+        total = await counters.reconcile_all(db)
+        return total, await counters.get_counters(db, "u1"), await counters.get_counters(db, "u2")
+
+    total, u1, u2 = asyncio.run(scenario())
+    assert total == 2
+    assert u1["focus_sessions"] == 3 and u2["focus_sessions"] == 0
+
+
+def test_increment_during_reconcile_all_is_not_lost(db, monkeypatch):
+    grouped_counts = counters._grouped_counts
+    raced = []
+
+    async def racing_grouped_counts(collection, pipeline):
+        counts = await grouped_counts(collection, pipeline)
+        if not raced:
+            # A session completes after focus_sessions was counted
+            raced.append(True)
+            await complete_session(db, "u1")
+        return counts
+
+    async def scenario():
+        await seed(db, 3)
+        await counters.reconcile_all(db)
+        monkeypatch.setattr(counters, "_grouped_counts", racing_grouped_counts)
+        await counters.reconcile_all(db)
+        return await counters.get_counters(db, "u1")
+
+    assert asyncio.run(scenario())["focus_sessions"] == 4
+
+
+def test_reconcile_user_recounts_when_counters_move(db, monkeypatch):
+    count_user = counters._count_user
+    raced = []
+
+    async def racing_count_user(db_, user_id):
+        counts = await count_user(db_, user_id)
+        if not raced:
+            raced.append(True)
+            await db.focus_sessions.insert_one({"user_id": user_id, "status": "completed"})
+            await db.user_counters.update_one({"user_id": user_id}, {"$inc": {"focus_sessions": 1}})
+        return counts
+
+    async def scenario():
+        await seed(db, 2)
+        await counters.reconcile_user(db, "u1")
+        monkeypatch.setattr(counters, "_count_user", racing_count_user)
+        counts = await counters.reconcile_user(db, "u1")
+        return counts, await counters.get_counters(db, "u1")
+
+    counts, stored = asyncio.run(scenario())
+    assert counts["focus_sessions"] == stored["focus_sessions"] == 3
@@ -0,0 +1,122 @@
+"""
+Entitlements: cached per user, invalidated on every worker, and revoked
+only when no other subscription is still running
+"""
+
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server_new
+from broker import Broker
+from entitlements import Entitlements
+
+
+def expiry(days: float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
+
+
+class PeerBroker(Broker):
+    """Stands in for one worker's RESP broker: a publish reaches every peer"""
+
+    def __init__(self, peers: list):
+        super().__init__()
+        self.peers = peers
+        peers.append(self)
+
+    def publish(self, channel: str, payload: str):
+        data = self._wrap(payload)
+        for peer in self.peers:
+            peer._dispatch(channel, data)
+
+
+def test_invalidation_reaches_every_worker(db):
+    peers = []
+    workers = [Entitlements(db, broker=PeerBroker(peers), sweep_seconds=3600) for _ in range(2)]
+    user = {"user_id": "u1", "is_premium": True, "premium_expires_at": expiry(30)}
+
+    async def scenario():
+        for worker in workers:
+            await worker.start()
+        try:
+            first = [worker.is_premium(user) for worker in workers]
+            # Served from the cache until someone invalidates it
+            cached = [worker.is_premium({**user, "is_premium": False}) for worker in workers]
+            workers[0].invalidate("u1")
+            after = [worker.is_premium({**user, "is_premium": False}) for worker in workers]
+            return first, cached, after
+        finally:
+            for worker in workers:
+                await worker.stop()
+
+    first, cached, after = asyncio.run(scenario())
+    assert first == cached == [True, True]
+    assert after == [False, False]
+
+
+def test_cached_entitlement_lapses_at_expiry(db):
+    entitlements = Entitlements(db)
+    user = {"user_id": "u1", "is_premium": True, "premium_expires_at": expiry(-1)}
+    assert not entitlements.is_premium(user)
+    assert not entitlements.is_premium({"user_id": "u2"})
+
+
+def test_sweep_expires_lapsed_subscriptions_and_keeps_renewed_users(db):
+    entitlements = Entitlements(db)
+
+    async def scenario():
+        await db.users.insert_many([
+            {"user_id": "lapsed", "is_premium": True, "premium_expires_at": expiry(-2)},
+            {"user_id": "renewed", "is_premium": True, "premium_expires_at": expiry(-2)},
+            {"user_id": "current", "is_premium": True, "premium_expires_at": expiry(20)},
+        ])
+        await db.premium_subscriptions.insert_many([
+            {"user_id": "lapsed", "status": "active", "expires_at": expiry(-2)},
+            {"user_id": "renewed", "status": "active", "expires_at": expiry(-2)},
+            {"user_id": "renewed", "status": "active", "expires_at": expiry(28)},
+            {"user_id": "current", "status": "active", "expires_at": expiry(20)},
+        ])
+        entitlements.is_premium({"user_id": "lapsed", "is_premium": True, "premium_expires_at": expiry(10)})
+        result = await entitlements.sweep()
+        users = {u["user_id"]: u["is_premium"] async for u in db.users.find()}
+        statuses = sorted([[s["user_id"], s["status"]] async for s in db.premium_subscriptions.find()])
+        return result, users, statuses
+
+    result, users, statuses = asyncio.run(scenario())
+    assert (result["subscriptions"], result["users"]) == (2, 1)
+    assert users == {"lapsed": False, "renewed": True, "current": True}
+    assert statuses == [
+        ["current", "active"], ["lapsed", "expired"], ["renewed", "active"], ["renewed", "expired"]
+    ]
+    # The revoked user's cached entitlement went with it
+    assert not entitlements.is_premium({"user_id": "lapsed", "is_premium": False})
+
+
+@pytest.fixture
+def billing(db, monkeypatch):
+    monkeypatch.setattr(server_new, "db", db)
+    monkeypatch.setattr(server_new, "entitlements", Entitlements(db))
+    return db
+
+
+def deleted(subscription_id: str) -> dict:
+    return {"type": "customer.subscription.deleted", "data": {"object": {"id": subscription_id}}}
+
+
+def test_cancellation_keeps_premium_while_another_subscription_runs(billing):
+    async def scenario():
+        await billing.users.insert_many([
+            {"user_id": "both", "is_premium": True, "premium_expires_at": expiry(300)},
+            {"user_id": "single", "is_premium": True, "premium_expires_at": expiry(20)},
+        ])
+        await billing.premium_subscriptions.insert_many([
+            {"user_id": "both", "stripe_subscription_id": "sub_monthly", "status": "active", "expires_at": expiry(20)},
+            {"user_id": "both", "stripe_subscription_id": "sub_yearly", "status": "active", "expires_at": expiry(300)},
+            {"user_id": "single", "stripe_subscription_id": "sub_single", "status": "active", "expires_at": expiry(20)},
+        ])
+        await server_new.apply_subscription_deleted(deleted("sub_monthly"))
+        await server_new.apply_subscription_deleted(deleted("sub_single"))
+        return {u["user_id"]: u["is_premium"] async for u in billing.users.find()}
+
+    assert asyncio.run(scenario()) == {"both": True, "single": False}
@@ -0,0 +1,53 @@
+"""
+EventBus delivery: one bad event in a batch fails alone
+"""
+
+import asyncio
+
+from events import EventBus, TodoCompleted
+
+
+def test_poison_event_does_not_drop_the_rest_of_its_batch():
+    delivered = []
+    calls = []
+
+    async def handler(events):
+        calls.append(len(events))
+        if any(event.todo_id == "bad" for event in events):
+            raise ValueError("cannot handle bad")
+        delivered.extend(event.todo_id for event in events)
+
+    async def scenario():
+        bus = EventBus(max_retries=2, retry_backoff=0.001)
+        bus.subscribe(TodoCompleted, handler)
+        for todo_id in ["t1", "bad", "t2", "t3"]:
+            await bus.publish(TodoCompleted(user_id="u1", todo_id=todo_id))
+        await bus.start()
+        await bus.stop()
+        return bus.stats()["TodoCompleted:handler"]
+
+    stats = asyncio.run(scenario())
+    assert delivered == ["t1", "t2", "t3"]
+    # Three attempts at the batch, then one per event
+    assert calls == [4, 4, 4, 1, 1, 1, 1]
+    assert stats["handled"] == 3 and stats["failed"] == 1 and stats["retries"] == 2
+
+
+def test_failing_single_event_is_retried_then_counted():
+    attempts = []
+
+    async def handler(events):
+        attempts.append(len(events))
+        raise RuntimeError("down")
+
+    async def scenario():
+        bus = EventBus(max_retries=2, retry_backoff=0.001)
+        bus.subscribe(TodoCompleted, handler)
+        await bus.start()
+        await bus.publish(TodoCompleted(user_id="u1", todo_id="t1"))
+        await bus.stop()
+        return bus.stats()["TodoCompleted:handler"]
+
+    stats = asyncio.run(scenario())
+    assert attempts == [1, 1, 1]
+    assert stats["failed"] == 1 and stats["handled"] == 0
@@ -0,0 +1,209 @@
+"""
+Focus session completion: the guarded status transition, concurrent
+completions and the server-side level/streak pipeline
+"""
+
+import asyncio
+import copy
+import math
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+
+NOW = datetime(2026, 3, 10, 12, 0, tzinfo=timezone.utc)
+
+
+# ==================== PIPELINE EVALUATOR ====================
+# mongomock can't evaluate $type/$sqrt/$pow in update pipelines, so the users
+# collection is replaced by this small in-memory evaluator of the same stages
+
+def evaluate(expr, doc: dict, variables: dict):
+    if isinstance(expr, str) and expr.startswith("$$"):
+        return variables[expr[2:]]
+    if isinstance(expr, str) and expr.startswith("$"):
+        return doc.get(expr[1:])
+    if isinstance(expr, list):
+        return [evaluate(e, doc, variables) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    (op, args), = expr.items()
+    value = lambda e: evaluate(e, doc, variables)
+    if op == "$let":
+        scope = {**variables, **{k: value(v) for k, v in args["vars"].items()}}
+        return evaluate(args["in"], doc, scope)
+    if op == "$switch":
+        for branch in args["branches"]:
+            if value(branch["case"]):
+                return value(branch["then"])
+        return value(args["default"])
+    if op == "$cond":
+        return value(args[1]) if value(args[0]) else value(args[2])
+    if op == "$ifNull":
+        first = value(args[0])
+        return value(args[1]) if first is None else first
+    if op == "$type":
+        found = value(args)
+        return "date" if isinstance(found, datetime) else "string" if isinstance(found, str) else "missing"
+    if op == "$dateToString":
+        return value(args["date"]).strftime(args["format"])
+    if op == "$substrCP":
+        text, start, length = value(args)
+        return text[start:start + length]
+    values = value(args)
+    operators = {
+        "$add": lambda v: sum(v),
+        "$subtract": lambda v: v[0] - v[1],
+        "$multiply": lambda v: math.prod(v),
+        "$divide": lambda v: v[0] / v[1],
+        "$pow": lambda v: v[0] ** v[1],
+        "$sqrt": math.sqrt,
+        "$floor": math.floor,
+        "$toInt": int,
+        "$eq": lambda v: v[0] == v[1],
+        "$gte": lambda v: v[0] >= v[1],
+    }
+    return operators[op](values)
+
+
+def apply_pipeline(doc: dict, pipeline: list) -> dict:
+    doc = copy.deepcopy(doc)
+    for stage in pipeline:
+        if "$set" in stage:
+            doc.update({field: evaluate(expr, doc, {}) for field, expr in stage["$set"].items()})
+        elif "$unset" in stage:
+            doc.pop(stage["$unset"], None)
+    return doc
+
+
+class PipelineUsers:
+    """users collection stand-in; each update applies without yielding, like a single server-side write"""
+
+    def __init__(self, docs):
+        self.docs = {doc["user_id"]: copy.deepcopy(doc) for doc in docs}
+
+    async def find_one_and_update(self, filter, update, projection=None, return_document=None, **kwargs):
+        await asyncio.sleep(0)
+        doc = self.docs.get(filter["user_id"])
+        if doc is None:
+            return None
+        self.docs[filter["user_id"]] = apply_pipeline(doc, update)
+        return copy.deepcopy(self.docs[filter["user_id"]])
+
+
+def old_level_up(level: int, xp: int, minutes: int):
+    """The read-modify-write loop end_focus_session used before the pipeline update"""
+    new_xp = xp + minutes * 10
+    while new_xp >= level * 1000:
+        new_xp -= level * 1000
+        level += 1
+    return level, new_xp
+
+
+# ==================== LEVEL PIPELINE ====================
+
+@pytest.mark.parametrize("level", [1, 2, 3, 7, 25])
+def test_level_matches_loop_at_threshold_boundaries(level):
+    # Just below, on and just above every threshold up to three levels ahead
+    thresholds = [sum(level + i for i in range(k)) * 1000 for k in range(1, 4)]
+    for threshold in thresholds:
+        for xp_total in (threshold - 10, threshold, threshold + 10):
+            for minutes in (0, 1, 10):
+                xp = xp_total - minutes * 10
+                if xp < 0:
+                    continue
+                doc = apply_pipeline(
+                    {"user_id": "u", "level": level, "xp": xp},
+                    server.focus_completion_update(minutes, minutes, NOW)
+                )
+                assert (doc["level"], doc["xp"]) == old_level_up(level, xp, minutes), (level, xp, minutes)
+
+
+def test_streak_continues_resets_and_holds():
+    update = server.focus_completion_update(5, 5, NOW)
+    yesterday = apply_pipeline({"user_id": "u", "streak_days": 4, "last_study_date": "2026-03-09"}, update)
+    today = apply_pipeline({"user_id": "u", "streak_days": 4, "last_study_date": "2026-03-10"}, update)
+    gap = apply_pipeline({"user_id": "u", "streak_days": 4, "last_study_date": "2026-03-01"}, update)
+    legacy_date = apply_pipeline(
+        {"user_id": "u", "streak_days": 4, "last_study_date": datetime(2026, 3, 9, tzinfo=timezone.utc)}, update
+    )
+    assert [d["streak_days"] for d in (yesterday, today, gap, legacy_date)] == [5, 4, 1, 5]
+    assert today["last_study_date"] == "2026-03-10"
+
+
+# ==================== END SESSION ====================
+
+@pytest.fixture
+def app_db(db, monkeypatch):
+    users = PipelineUsers([{
+        "user_id": "user_1", "email": "a@example.com", "name": "A",
+        "credits": 0, "level": 1, "xp": 0, "streak_days": 0, "total_focus_minutes": 0,
+    }])
+
+    class Database:
+        def __getattr__(self, name):
+            return users if name == "users" else db[name]
+
+    monkeypatch.setattr(server, "db", Database())
+    monkeypatch.setattr(server.leaderboard, "record_minutes", lambda *args: None)
+    return users
+
+
+def request_for(user_doc: dict) -> Request:
+    request = Request({"type": "http", "headers": []})
+    request.state.current_user = server.User(**user_doc)
+    return request
+
+
+async def start_sessions(n: int) -> list:
+    ids = []
+    for _ in range(n):
+        started = await server.start_focus_session(
+            server.FocusSessionStart(duration_minutes=25), request_for(current_user())
+        )
+        ids.append(started["session_id"])
+    return ids
+
+
+def current_user() -> dict:
+    return {"user_id": "user_1", "email": "a@example.com", "name": "A"}
+
+
+def test_ending_a_session_twice_is_rejected(app_db):
+    async def scenario():
+        [session_id] = await start_sessions(1)
+        end = server.FocusSessionEnd(actual_minutes=25, double_credits=False)
+        await server.end_focus_session(session_id, end, request_for(current_user()))
+        with pytest.raises(HTTPException) as second:
+            await server.end_focus_session(session_id, end, request_for(current_user()))
+        return second.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 409
+    assert app_db.docs["user_1"]["credits"] == 25
+
+
+def test_parallel_completions_do_not_lose_credits(app_db):
+    async def scenario():
+        session_ids = await start_sessions(20)
+        end = server.FocusSessionEnd(actual_minutes=30, double_credits=True)
+        # The same sessions ended twice over, all at once
+        results = await asyncio.gather(*(
+            server.end_focus_session(session_id, end, request_for(current_user()))
+            for session_id in session_ids * 2
+        ), return_exceptions=True)
+        return results
+
+    results = asyncio.run(scenario())
+    completed = [r for r in results if isinstance(r, dict)]
+    rejected = [r for r in results if isinstance(r, HTTPException)]
+    assert len(completed) == 20
+    assert len(rejected) == 20 and {r.status_code for r in rejected} == {409}
+
+    user = app_db.docs["user_1"]
+    assert user["credits"] == 20 * 60
+    assert user["total_focus_minutes"] == 20 * 30
+    assert (user["level"], user["xp"]) == old_level_up(1, 0, 20 * 30)
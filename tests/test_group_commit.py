@@ -0,0 +1,73 @@
+"""
+GroupCommitWriter: every buffered insert ends with an outcome
+"""
+
+import asyncio
+
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from group_commit import GroupCommitWriter
+
+
+class FakeCollection:
+    def __init__(self, error=None, delay: float = 0.0):
+        self.error = error
+        self.delay = delay
+        self.docs = []
+
+    async def insert_many(self, docs, ordered=True):
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        self.docs.extend(docs)
+
+
+async def insert_all(writer: GroupCommitWriter, n: int) -> list:
+    await writer.start()
+    try:
+        return await asyncio.wait_for(
+            asyncio.gather(*(writer.insert({"n": i}) for i in range(n)), return_exceptions=True), 1
+        )
+    finally:
+        await writer.stop()
+
+
+def test_batch_is_acknowledged_together():
+    collection = FakeCollection()
+    results = asyncio.run(insert_all(GroupCommitWriter(collection), 5))
+    assert results == [None] * 5
+    assert [doc["n"] for doc in collection.docs] == list(range(5))
+
+
+def test_duplicate_fails_only_its_sender():
+    class FirstCallDuplicate(FakeCollection):
+        async def insert_many(self, docs, ordered=True):
+            if not self.docs and len(docs) == 4:
+                self.docs.extend(docs[:2])
+                raise BulkWriteError({"writeErrors": [{"index": 2, "code": 11000, "errmsg": "duplicate"}]})
+            self.docs.extend(docs)
+
+    collection = FirstCallDuplicate()
+    results = asyncio.run(insert_all(GroupCommitWriter(collection), 4))
+    assert results[:2] == [None, None] and results[3] is None
+    assert isinstance(results[2], OperationFailure)
+    assert [doc["n"] for doc in collection.docs] == [0, 1, 3]
+
+
+def test_write_concern_error_fails_the_whole_batch():
+    error = BulkWriteError({"writeErrors": [], "writeConcernErrors": [{"code": 64, "errmsg": "waiting for replication timed out"}]})
+    results = asyncio.run(insert_all(GroupCommitWriter(FakeCollection(error)), 3))
+    assert all(isinstance(r, BulkWriteError) for r in results)
+
+
+def test_stop_during_a_write_fails_waiting_senders():
+    async def scenario():
+        writer = GroupCommitWriter(FakeCollection(delay=10), max_delay=0)
+        await writer.start()
+        pending = asyncio.gather(*(writer.insert({"n": i}) for i in range(3)), return_exceptions=True)
+        await asyncio.sleep(0.05)
+        writer._task.cancel()
+        return await asyncio.wait_for(pending, 1)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, OperationFailure) for r in results)
@@ -0,0 +1,70 @@
+"""
+Leaderboard ranking structure and top-N caching
+"""
+
+import asyncio
+import random
+
+from leaderboard import Leaderboard, RankedSet, SortedKeys
+
+
+def test_sorted_keys_match_a_sorted_list_through_splits_and_removals():
+    rng = random.Random(7)
+    keys = SortedKeys(load=4)
+    reference = []
+    for _ in range(2000):
+        if reference and rng.random() < 0.4:
+            key = rng.choice(reference)
+            keys.remove(key)
+            reference.remove(key)
+        else:
+            key = (rng.randint(-50, 0), f"u{rng.randint(0, 10 ** 6)}")
+            if key in reference:
+                continue
+            keys.add(key)
+            reference.append(key)
+        reference.sort()
+        assert len(keys) == len(reference)
+    assert keys.head(len(reference)) == reference
+    for position, key in enumerate(reference):
+        assert keys.index(key) == position
+
+
+def test_ranked_set_ranks_by_score_then_member():
+    ranked = RankedSet()
+    ranked.load([("a", 10), ("b", 30), ("c", 20)])
+    assert ranked.incr("a", 25) == 0
+    assert ranked.incr("d", 20) == 3
+    assert ranked.top(4) == [("a", 35), ("b", 30), ("c", 20), ("d", 20)]
+    assert ranked.rank("d") == 3 and ranked.rank("missing") is None
+
+
+class RacingUsers:
+    """users collection whose profile read lets a completion land mid-load"""
+
+    def __init__(self, on_read):
+        self.on_read = on_read
+
+    def find(self, query, projection):
+        async def cursor():
+            self.on_read()
+            for user_id in query["user_id"]["$in"]:
+                yield {"user_id": user_id, "name": user_id}
+        return cursor()
+
+
+def test_head_read_before_a_concurrent_update_is_not_cached():
+    leaderboard = Leaderboard(db=None)
+    leaderboard._loaded = True
+    leaderboard._sets["all"].load([("a", 30), ("b", 20)])
+    leaderboard._keys = {"all": "all"}
+    leaderboard.db = type("DB", (), {"users": RacingUsers(lambda: leaderboard.record_minutes("b", 50))})()
+
+    async def scenario():
+        stale = await leaderboard.top("all", 2)
+        leaderboard.db.users.on_read = lambda: None
+        return stale, await leaderboard.top("all", 2)
+
+    stale, fresh = asyncio.run(scenario())
+    assert [entry["user_id"] for entry in stale] == ["a", "b"]
+    assert [(entry["user_id"], entry["minutes"]) for entry in fresh] == [("b", 70), ("a", 30)]
@@ -0,0 +1,204 @@
+"""
+PushDelivery outcome handling: prune gone subscriptions, retry transient
+failures with backoff, drop everything else; unit-level and against a
+local push service
+"""
+
+import asyncio
+import base64
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from push_delivery import PushDelivery, PushJob
+
+SUBSCRIPTION = {"endpoint": "https://push.example.com/send/abc", "keys": {"p256dh": "k", "auth": "a"}}
+
+
+def delivery(db, **kwargs) -> PushDelivery:
+    return PushDelivery(db, "private-key", {"sub": "mailto:test@example.com"}, retry_backoff=1.0, **kwargs)
+
+
+def settle(push: PushDelivery, job: PushJob, status, retry_after=None) -> list:
+    """Run _settle and return the (delay, job) retries it scheduled"""
+    scheduled = []
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        loop.call_later = lambda delay, callback, *args: scheduled.append((delay, *args))
+        await push._settle(job, status, retry_after)
+
+    asyncio.run(scenario())
+    return scheduled
+
+
+@pytest.mark.parametrize("status", [404, 410])
+def test_gone_subscription_is_pruned_by_endpoint(db, status):
+    async def seed():
+        await db.push_subscriptions.insert_many([
+            {"user_id": "u1", "subscription": SUBSCRIPTION},
+            {"user_id": "u1", "subscription": {**SUBSCRIPTION, "endpoint": "https://push.example.com/send/new"}},
+        ])
+
+    asyncio.run(seed())
+    push = delivery(db)
+    assert settle(push, PushJob("u1", SUBSCRIPTION, "{}"), status) == []
+
+    remaining = asyncio.run(db.push_subscriptions.find({}, {"_id": 0}).to_list(10))
+    assert [doc["subscription"]["endpoint"] for doc in remaining] == ["https://push.example.com/send/new"]
+    assert push.pruned == 1
+
+
+@pytest.mark.parametrize("status", [429, 500, 503, "network"])
+def test_transient_failure_is_retried_with_exponential_backoff(db, status):
+    push = delivery(db)
+    delays = [settle(push, PushJob("u1", SUBSCRIPTION, "{}", attempt), status)[0] for attempt in range(3)]
+    assert [delay for delay, _ in delays] == [1.0, 2.0, 4.0]
+    assert [job.attempt for _, job in delays] == [1, 2, 3]
+    assert push.retries == 3
+
+
+def test_retry_after_header_extends_the_backoff(db):
+    push = delivery(db)
+    [(delay, job)] = settle(push, PushJob("u1", SUBSCRIPTION, "{}"), 429, retry_after="30")
+    assert delay == 30.0
+
+
+def test_retries_stop_after_max_retries(db):
+    push = delivery(db, max_retries=2)
+    assert settle(push, PushJob("u1", SUBSCRIPTION, "{}", attempt=2), 503) == []
+    assert push.retries == 0
+
+
+@pytest.mark.parametrize("status", [400, 401, 403, 413])
+def test_other_client_errors_are_dropped(db, status):
+    asyncio.run(db.push_subscriptions.insert_one({"user_id": "u1", "subscription": SUBSCRIPTION}))
+    push = delivery(db)
+    assert settle(push, PushJob("u1", SUBSCRIPTION, "{}"), status) == []
+    assert asyncio.run(db.push_subscriptions.count_documents({})) == 1
+    assert push.retries == 0 and push.pruned == 0
+
+
+def test_requeued_job_is_sent_again(db):
+    async def scenario():
+        push = PushDelivery(db, "private-key", {"sub": "mailto:test@example.com"}, workers=1, retry_backoff=0.01)
+        statuses = iter([503, 201])
+        sent = []
+
+        def fake_send(job):
+            sent.append(job.attempt)
+            return next(statuses), None
+
+        push._send = fake_send
+        await push.start()
+        push.enqueue("u1", SUBSCRIPTION, "{}")
+        for _ in range(100):
+            if len(sent) == 2:
+                break
+            await asyncio.sleep(0.01)
+        await push.stop()
+        return sent, push.stats()
+
+    sent, stats = asyncio.run(scenario())
+    assert sent == [0, 1]
+    assert stats["by_status"] == {"503": 1, "201": 1}
+
+
+# ==================== AGAINST A LOCAL PUSH SERVICE ====================
+
+class PushService(ThreadingHTTPServer):
+    """Stub push service: /status/<code> answers that code, /flaky/<name> fails once with 503"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), PushHandler)
+        self.received = []
+        self.seen = set()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.received.append(
+            (self.path, self.headers.get("Content-Encoding"), self.headers.get("Authorization"), body)
+        )
+        kind, _, name = self.path.strip("/").partition("/")
+        if kind == "flaky":
+            status = 201 if name in self.server.seen else 503
+            self.server.seen.add(name)
+        else:
+            status = int(name)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def browser_subscription(endpoint: str) -> dict:
+    """A subscription with real keys, as a browser would hand it over"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    public = key.public_key().public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+    return {"endpoint": endpoint, "keys": {"p256dh": b64(public), "auth": b64(os.urandom(16))}}
+
+
+@pytest.fixture
+def push_service():
+    service = PushService()
+    thread = threading.Thread(target=service.serve_forever, daemon=True)
+    thread.start()
+    yield service
+    service.shutdown()
+    service.server_close()
+
+
+def test_delivery_against_a_push_service(db, push_service):
+    vapid_key = b64(ec.generate_private_key(ec.SECP256R1()).private_numbers().private_value.to_bytes(32, "big"))
+    endpoints = {
+        "ok": f"{push_service.url}/status/201",
+        "gone": f"{push_service.url}/status/410",
+        "down": f"{push_service.url}/status/503",
+        "flaky": f"{push_service.url}/flaky/a",
+        "bad": f"{push_service.url}/status/400",
+    }
+    subscriptions = {name: browser_subscription(url) for name, url in endpoints.items()}
+
+    async def scenario():
+        await db.push_subscriptions.insert_many(
+            [{"user_id": name, "subscription": sub} for name, sub in subscriptions.items()]
+        )
+        push = PushDelivery(
+            db, vapid_key, {"sub": "mailto:test@example.com"}, workers=2, max_retries=2, retry_backoff=0.01
+        )
+        await push.start()
+        for name, sub in subscriptions.items():
+            push.enqueue(name, sub, '{"title": "Break time"}')
+        # ok, gone, bad once; flaky twice; down once plus two retries
+        for _ in range(300):
+            if len(push_service.received) >= 8 and push.queue.empty():
+                break
+            await asyncio.sleep(0.01)
+        await push.stop()
+        remaining = {doc["user_id"] for doc in await db.push_subscriptions.find({}).to_list(10)}
+        return push.stats(), remaining
+
+    stats, remaining = asyncio.run(scenario())
+    assert stats["by_status"] == {"201": 2, "410": 1, "503": 4, "400": 1}
+    assert stats["retries"] == 3 and stats["pruned"] == 1
+    assert remaining == {"ok", "down", "flaky", "bad"}
+    # Every request was an encrypted payload signed with the VAPID key
+    assert {encoding for _, encoding, _, _ in push_service.received} == {"aes128gcm"}
+    assert all(auth.startswith("vapid t=") for _, _, auth, _ in push_service.received)
+    assert b"Break time" not in b"".join(body for _, _, _, body in push_service.received)
@@ -0,0 +1,128 @@
+"""
+Rate limiting: chat keeps its 3-per-5s cap on both backends; shared checks are pipelined
+"""
+
+import asyncio
+import random
+
+from broker import read_reply
+from rate_limit import LIMITS, LocalBuckets, RateLimiter, RespBuckets
+
+WINDOW = 5.0
+
+
+def most_in_any_window(times: list) -> int:
+    return max(sum(1 for t in times if start <= t < start + WINDOW) for start in times)
+
+
+def attempts(seed: int, count: int = 400) -> list:
+    """Send attempts at random gaps, with some clients hammering and some typing normally"""
+    rng = random.Random(seed)
+    now, times = 0.0, []
+    for _ in range(count):
+        now += rng.choice([0.0, 0.01, 0.2, 0.5, 1.0, 2.5, 5.0])
+        times.append(now)
+    return times
+
+
+def test_chat_send_local_allows_at_most_three_per_window():
+    limit = LIMITS["chat_send"]
+    for seed in range(20):
+        buckets = LocalBuckets()
+        allowed = [t for t in attempts(seed) if buckets.take("chat_send:u1", limit, t)[0]]
+        assert most_in_any_window(allowed) <= 3
+    buckets = LocalBuckets()
+    # Once quiet, a short burst still goes through
+    assert [buckets.take("chat_send:u2", limit, 0.0)[0] for _ in range(3)] == [True, True, False]
+
+
+class RespStub:
+    """Single-connection RESP server running the token bucket script's logic in Python"""
+
+    def __init__(self, reply_delay: float = 0.0):
+        self.reply_delay = reply_delay
+        self.buckets = {}
+        self.commands = 0
+        self.max_queued = 0
+        self.server = None
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return f"redis://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _eval(self, key: str, rate: float, burst: int, now: float) -> list:
+        tokens, ts = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + max(0.0, now - ts) * rate)
+        allowed = 0
+        if tokens >= 1:
+            tokens -= 1
+            allowed = 1
+        self.buckets[key] = (tokens, now)
+        return [allowed, tokens]
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                command = await read_reply(reader)
+                self.commands += 1
+                # Commands already buffered behind this one were sent without waiting for a reply
+                self.max_queued = max(self.max_queued, 1 + reader._buffer.count(b"*7\r\n"))
+                await asyncio.sleep(self.reply_delay)
+                _, _, _, key, rate, burst, now = command
+                allowed, tokens = self._eval(key, float(rate), int(burst), float(now))
+                body = str(tokens).encode()
+                writer.write(b"*2\r\n:%d\r\n$%d\r\n%s\r\n" % (allowed, len(body), body))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+
+
+def test_chat_send_shared_allows_at_most_three_per_window():
+    limit = LIMITS["chat_send"]
+
+    async def scenario():
+        stub = RespStub()
+        buckets = RespBuckets(await stub.start())
+        results = []
+        for seed in range(5):
+            allowed = [t for t in attempts(seed, 200) if (await buckets.take(f"chat_send:u{seed}", limit, t))[0]]
+            results.append(most_in_any_window(allowed))
+        await stub.stop()
+        return results
+
+    assert max(asyncio.run(scenario())) <= 3
+
+
+def test_concurrent_shared_checks_are_pipelined():
+    async def scenario():
+        stub = RespStub(reply_delay=0.02)
+        limiter = RateLimiter(RespBuckets(await stub.start(), timeout=2.0))
+        waits = await asyncio.gather(*(limiter.check("chat_send", f"u{i}") for i in range(20)))
+        await stub.stop()
+        return waits, stub, limiter.stats()
+
+    waits, stub, stats = asyncio.run(scenario())
+    assert waits == [0.0] * 20
+    assert stub.commands == 20 and stats["shared_errors"] == 0
+    # Checks went out without waiting for earlier replies (one at a time would be 1)
+    assert stub.max_queued >= 10
+
+
+def test_lost_connection_fails_waiting_checks_over_to_local_buckets():
+    async def scenario():
+        stub = RespStub(reply_delay=0.05)
+        limiter = RateLimiter(RespBuckets(await stub.start(), timeout=2.0))
+        checks = asyncio.gather(*(limiter.check("chat_send", f"u{i}") for i in range(5)))
+        await asyncio.sleep(0.01)
+        limiter.shared._conn.writer.transport.abort()
+        waits = await checks
+        await stub.stop()
+        return waits, limiter.stats()
+
+    waits, stats = asyncio.run(scenario())
+    assert waits == [0.0] * 5
+    assert stats["shared_errors"] == 5
@@ -0,0 +1,76 @@
+"""
+Spotify token renewal: one refresh per user across workers, only for tokens in use
+"""
+
+import asyncio
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
+
+from spotify_tokens import SpotifyTokens
+
+
+class FakeAccounts:
+    def __init__(self):
+        self.refreshed = []
+
+    async def post(self, path: str, data: dict):
+        self.refreshed.append(data['refresh_token'])
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(
+            status_code=200,
+            json=lambda: {"access_token": f"new-{data['refresh_token']}", "expires_in": 3600}
+        )
+
+
+def at(seconds: float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()
+
+
+def user(user_id: str, served_ago: float = None) -> dict:
+    doc = {
+        "user_id": user_id,
+        "spotify_access_token": "old",
+        "spotify_refresh_token": f"rt-{user_id}",
+        "spotify_expires_at": at(60),
+    }
+    if served_ago is not None:
+        doc["spotify_served_at"] = at(-served_ago)
+    return doc
+
+
+def test_workers_renewing_together_refresh_each_token_once(db):
+    async def scenario():
+        await db.users.insert_many([user(f"u{i}", served_ago=30) for i in range(5)])
+        accounts = FakeAccounts()
+        workers = [SpotifyTokens(db, accounts, "id", "secret") for _ in range(3)]
+        results = await asyncio.gather(*(worker.renew() for worker in workers))
+        return accounts.refreshed, results
+
+    refreshed, results = asyncio.run(scenario())
+    assert sorted(refreshed) == [f"rt-u{i}" for i in range(5)]
+    assert sum(result["renewed"] for result in results) == 5
+
+
+def test_only_recently_served_tokens_are_renewed(db):
+    async def scenario():
+        await db.users.insert_many([user("active", served_ago=60), user("idle", served_ago=86400), user("never")])
+        accounts = FakeAccounts()
+        await SpotifyTokens(db, accounts, "id", "secret", active_seconds=3600).renew()
+        return accounts.refreshed
+
+    assert asyncio.run(scenario()) == ["rt-active"]
+
+
+def test_serving_a_token_marks_it_active(db):
+    async def scenario():
+        doc = user("u1")
+        doc["spotify_expires_at"] = at(3600)
+        await db.users.insert_one(doc)
+        tokens = SpotifyTokens(db, FakeAccounts(), "id", "secret")
+        access = await tokens.access_token(doc)
+        stored = await db.users.find_one({"user_id": "u1"})
+        return access, stored
+
+    access, stored = asyncio.run(scenario())
+    assert access.token == "old"
+    assert stored["spotify_served_at"] <= at(0)